@@ -1,12 +1,15 @@
 import asyncio
 from collections import namedtuple
+import fcntl
 import hashlib
 import logging
 import os
 import tempfile
+import time
 
 from pulpcore.app.models import Artifact
 from pulpcore.exceptions import DigestValidationError, SizeValidationError
+from pulpcore.plugin import metrics
 
 
 log = logging.getLogger(__name__)
@@ -50,21 +53,33 @@ class BaseDownloader:
     instantiator to define the file to receive data allows the streamer to receive the data instead
     of having it written to disk.
 
+    With the ``resume_path`` keyword argument, the data is written to ``resume_path`` with a
+    ``.part`` suffix instead, and the file is renamed to ``resume_path`` once it has been
+    validated. A downloader created later with the same ``resume_path`` reuses the validated file
+    without downloading it again, or continues from the end of the partial file if the subclass
+    supports it. See :meth:`~pulpcore.plugin.download.BaseDownloader.resume_offset`.
+
     The call to :meth:`~pulpcore.plugin.download.BaseDownloader.finalize` ensures that all
     data written to the file-like object is quiesced to disk before the file-like object has
     `close()` called on it.
 
+    The downloaded bytes, the duration of successful downloads, and the downloads failing
+    validation are counted per host in :mod:`pulpcore.plugin.metrics`.
+
     Attributes:
         url (str): The url to download.
+        host (str): The host of `url`, as labeled in the metrics.
         expected_digests (dict): Keyed on the algorithm name provided by hashlib and stores the
             value of the expected digest. e.g. {'md5': '912ec803b2ce49e4a541068d495ab570'}
         expected_size (int): The number of bytes the download is expected to have.
         path (str): The full path to the file containing the downloaded data if no
             ``custom_file_object`` option was specified, otherwise None.
+        resume_path (str): The full path the validated download is kept at, or None if the
+            download is not resumable.
     """
 
     def __init__(self, url, custom_file_object=None, expected_digests=None, expected_size=None,
-                 semaphore=None):
+                 semaphore=None, resume_path=None):
         """
         Create a BaseDownloader object. This is expected to be called by all subclasses.
 
@@ -78,11 +93,20 @@ class BaseDownloader:
             expected_size (int): The number of bytes the download is expected to have.
             semaphore (asyncio.Semaphore): A semaphore the downloader must acquire before running.
                 Useful for limiting the number of outstanding downloaders in various ways.
+            resume_path (str): An optional path to keep the download at, so an interrupted download
+                can be resumed by a later downloader. It is ignored if ``custom_file_object`` is
+                given.
         """
         self.url = url
+        self.resume_path = None
         if custom_file_object:
             self._writer = custom_file_object
             self.path = None
+        elif resume_path:
+            # The partial file is opened in run(), once the data it already holds has been read
+            self.resume_path = resume_path
+            self._writer = None
+            self.path = resume_path + '.part'
         else:
             self._writer = tempfile.NamedTemporaryFile(dir=os.getcwd(), delete=False)
             self.path = self._writer.name
@@ -94,6 +118,8 @@ class BaseDownloader:
             self.semaphore = asyncio.Semaphore()  # This will always be acquired
         self._digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
         self._size = 0
+        self.host = metrics.host_label(url)
+        self._bytes_counter = metrics.download_bytes.labels(self.host)
 
     async def handle_data(self, data):
         """
@@ -109,6 +135,7 @@ class BaseDownloader:
         """
         self._writer.write(data)
         self._record_size_and_digests_for_data(data)
+        self._bytes_counter.inc(len(data))
 
     async def finalize(self):
         """
@@ -127,9 +154,91 @@ class BaseDownloader:
         """
         self._writer.flush()
         os.fsync(self._writer.fileno())
-        self._writer.close()
-        self.validate_digests()
-        self.validate_size()
+        try:
+            self.validate_digests()
+            self.validate_size()
+            if self.resume_path:
+                # Rename while the partial file is still locked by this downloader
+                os.rename(self.path, self.resume_path)
+                self.path = self.resume_path
+        except (DigestValidationError, SizeValidationError):
+            metrics.download_digest_failures.labels(self.host).inc()
+            if self.resume_path:
+                # Don't resume from invalid data
+                os.remove(self.path)
+            raise
+        finally:
+            self._writer.close()
+
+    @property
+    def resume_offset(self):
+        """
+        The number of bytes already written by a previous downloader with the same `resume_path`.
+
+        Subclasses able to request the data from an offset should start at `resume_offset`, and
+        call :meth:`~pulpcore.plugin.download.BaseDownloader.restart` if the data is sent from the
+        beginning anyway. Subclasses that are not able to do so should call
+        :meth:`~pulpcore.plugin.download.BaseDownloader.restart` before handling any data.
+        """
+        return self._size if self.resume_path else 0
+
+    def restart(self):
+        """
+        Discard the data written so far, so the download can be handled again from the beginning.
+        """
+        self._writer.seek(0)
+        self._writer.truncate()
+        self._digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
+        self._size = 0
+
+    def _record_file(self, path):
+        """
+        Record the size and digests of the data in the file at `path`.
+
+        Args:
+            path (str): The path of the file to read.
+        """
+        with open(path, 'rb') as f_handle:
+            for chunk in iter(lambda: f_handle.read(1048576), b''):  # 1 megabyte
+                self._record_size_and_digests_for_data(chunk)
+
+    async def _resume(self):
+        """
+        Reuse the data kept at `resume_path` by a previous downloader.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult` if a validated download is present at
+            `resume_path`, otherwise None after the partial file has been opened for appending.
+            The partial file is locked until the download is finalized. If it is already locked,
+            the download is written to a temporary file and is not resumable.
+        """
+        loop = asyncio.get_event_loop()
+        if os.path.exists(self.resume_path):
+            await loop.run_in_executor(None, self._record_file, self.resume_path)
+            try:
+                self.validate_digests()
+                self.validate_size()
+            except (DigestValidationError, SizeValidationError):
+                os.remove(self.resume_path)
+                self._digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
+                self._size = 0
+            else:
+                log.debug('Reusing the download of %s at %s', self.url, self.resume_path)
+                self.path = self.resume_path
+                return DownloadResult(url=self.url, artifact_attributes=self.artifact_attributes,
+                                      path=self.path, headers=None)
+        self._writer = open(self.path, 'ab')
+        try:
+            fcntl.flock(self._writer, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another downloader is writing the partial file, download to a file of our own
+            self._writer.close()
+            self._writer = tempfile.NamedTemporaryFile(dir=os.getcwd(), delete=False)
+            self.path = self._writer.name
+            self.resume_path = None
+            return None
+        await loop.run_in_executor(None, self._record_file, self.path)
+        return None
 
     def fetch(self):
         """
@@ -201,6 +310,9 @@ class BaseDownloader:
         contained in `_run()`. This ensures that the semaphore stays acquired even as the `backoff`
         decorator on `_run()`, handles backoff-and-retry logic.
 
+        If `resume_path` is set and a validated download is already present there, it is returned
+        without calling `_run()`.
+
         Args:
             extra_data (dict): Extra data passed to the downloader.
 
@@ -209,7 +321,14 @@ class BaseDownloader:
 
         """
         async with self.semaphore:
-            return await self._run(extra_data=extra_data)
+            if self.resume_path:
+                result = await self._resume()
+                if result:
+                    return result
+            started_at = time.monotonic()
+            result = await self._run(extra_data=extra_data)
+            metrics.download_duration.labels(self.host).observe(time.monotonic() - started_at)
+            return result
 
     async def _run(self, extra_data=None):
         """
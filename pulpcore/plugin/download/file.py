@@ -43,6 +43,8 @@ class FileDownloader(BaseDownloader):
             extra_data (dict): Extra data passed to the downloader.
         """
         async with aiofiles.open(self._path, 'rb') as f_handle:
+            if self.resume_offset:
+                await f_handle.seek(self.resume_offset)
             while True:
                 chunk = await f_handle.read(1048576)  # 1 megabyte
                 if not chunk:
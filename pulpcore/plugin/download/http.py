@@ -3,6 +3,8 @@ import logging
 import aiohttp
 import backoff
 
+from pulpcore.plugin import metrics
+
 from .base import BaseDownloader, DownloadResult
 
 
@@ -32,6 +34,36 @@ def http_giveup(exc):
     return exc.code not in [429, 502, 503, 504]
 
 
+def _record_retry(details):
+    """
+    Count a retry of an :class:`HttpDownloader` in the metrics, as a `backoff` handler.
+
+    Args:
+        details (dict): The details of the retry passed by `backoff`.
+    """
+    downloader = details['args'][0]
+    metrics.download_retries.labels(downloader.host).inc()
+
+
+def _content_range_start(headers):
+    """
+    Return the first byte position of the `Content-Range` of a partial response.
+
+    Args:
+        headers (multidict.CIMultiDictProxy): The headers of the response.
+
+    Returns:
+        int: The first byte position, or None if the header is missing or not a byte range.
+    """
+    unit, _, byte_range = headers.get('Content-Range', '').partition(' ')
+    if unit != 'bytes':
+        return None
+    try:
+        return int(byte_range.split('-', 1)[0])
+    except ValueError:
+        return None
+
+
 class HttpDownloader(BaseDownloader):
     """
     An HTTP/HTTPS Downloader built on `aiohttp`.
@@ -163,8 +195,38 @@ class HttpDownloader(BaseDownloader):
         return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
                               url=self.url, headers=response.headers)
 
+    async def _run_from_offset(self):
+        """
+        Continue a partial download with a request for the data after `resume_offset`.
+
+        The partial data is discarded if the server sends the whole file instead. It is discarded
+        too, and the whole file is requested again, if the server can't satisfy the range request
+        or sends a range that doesn't start at `resume_offset`.
+
+        Returns:
+             DownloadResult: The result of the download, or None if the partial data was discarded
+                 and the whole file must be requested.
+        """
+        headers = {'Range': 'bytes={offset}-'.format(offset=self.resume_offset)}
+        async with self.session.get(self.url, headers=headers) as response:
+            if response.status == 416:
+                # Range Not Satisfiable, the partial data doesn't match the file anymore
+                self.restart()
+                return None
+            response.raise_for_status()
+            if response.status != 206:
+                self.restart()
+            elif _content_range_start(response.headers) != self.resume_offset:
+                self.restart()
+                return None
+            to_return = await self._handle_response(response)
+            await response.release()
+        if self._close_session_on_finalize:
+            await self.session.close()
+        return to_return
+
     @backoff.on_exception(backoff.expo, aiohttp.ClientResponseError,
-                          max_tries=10, giveup=http_giveup)
+                          max_tries=10, giveup=http_giveup, on_backoff=_record_retry)
     async def _run(self, extra_data=None):
         """
         Download, validate, and compute digests on the `url`. This is a coroutine.
@@ -173,12 +235,20 @@ class HttpDownloader(BaseDownloader):
         some 5XX errors. It retries with exponential backoff 10 times before allowing
         a final exception to be raised.
 
+        If `resume_path` is set and a partial download is present, only the remaining data is
+        requested with a `Range` header. This is also the case for retries after some data was
+        received.
+
         This method provides the same return object type and documented in
         :meth:`~pulpcore.plugin.download.BaseDownloader._run`.
 
         Args:
             extra_data (dict): Extra data passed by the downloader.
         """
+        if self.resume_offset:
+            to_return = await self._run_from_offset()
+            if to_return:
+                return to_return
         async with self.session.get(self.url) as response:
             response.raise_for_status()
             to_return = await self._handle_response(response)
@@ -0,0 +1,412 @@
+"""
+An in-process registry of metrics about Stages API pipelines and downloaders.
+
+The metrics are updated by :class:`~pulpcore.plugin.stages.Stage`,
+:func:`~pulpcore.plugin.stages.create_pipeline`, and the downloaders, and are always collected.
+Updating a metric costs a dict lookup at most, and the queue depths are only read when the metrics
+are exported.
+
+They are exported in the OpenMetrics text format, either with :meth:`MetricsRegistry.write_textfile`
+for a textfile collector, or served by an `aiohttp` application with :func:`metrics_handler`. If
+the `METRICS_TEXTFILE` setting is set, :func:`~pulpcore.plugin.stages.create_pipeline` writes the
+metrics there periodically while it runs. A `{pid}` in the path is replaced by the process id, so
+several workers can share the setting.
+"""
+from bisect import bisect_left
+from gettext import gettext as _
+import os
+import tempfile
+import threading
+from urllib.parse import urlsplit
+import weakref
+
+from aiohttp import web
+
+
+#: (str): The content type of the OpenMetrics text format.
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{name}="{value}"'.format(name=name, value=_escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    The base class of the metrics, holding one child per combination of label values.
+
+    Args:
+        name (str): The name of the metric, without the `_total` suffix of counters.
+        documentation (str): The help text of the metric.
+        labelnames (tuple): The names of the labels of the metric. Defaults to no labels.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        Return the child of the metric for label values, to be kept for updating it cheaply.
+
+        Args:
+            values: The values of the labels, in the order of `labelnames`.
+
+        Returns:
+            The child, with the methods of the metric type.
+
+        Raises:
+            ValueError: When the number of values doesn't match the number of labels.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(_('{name} has {count} labels.').format(
+                name=self.name, count=len(self.labelnames)))
+        values = tuple(str(value) for value in values)
+        try:
+            return self._children[values]
+        except KeyError:
+            with self._lock:
+                return self._children.setdefault(values, self._make_child())
+
+    def clear(self):
+        """
+        Remove all children of the metric.
+        """
+        with self._lock:
+            self._children.clear()
+
+    def _make_child(self):
+        raise NotImplementedError()
+
+    def _samples(self, values, child):
+        raise NotImplementedError()
+
+    def export(self):
+        """
+        Return the metric in the OpenMetrics text format.
+
+        Returns:
+            str: The lines of the metric family.
+        """
+        lines = [
+            '# TYPE {name} {type}'.format(name=self.name, type=self.type),
+            '# HELP {name} {help}'.format(name=self.name, help=_escape(self.documentation)),
+        ]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            for suffix, extra, value in self._samples(values, child):
+                lines.append('{name}{suffix}{labels} {value}'.format(
+                    name=self.name, suffix=suffix,
+                    labels=_format_labels(self.labelnames, values, extra),
+                    value=_format_value(value)))
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Increase the counter by `amount`.
+        """
+        with self._lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count, exported with a `_total` suffix.
+    """
+
+    type = 'counter'
+
+    def _make_child(self):
+        return _CounterChild()
+
+    def _samples(self, values, child):
+        return [('_total', (), child.value)]
+
+
+class _GaugeChild:
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        """
+        Set the gauge to `value`.
+        """
+        self.value = value
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, usually set when the metrics are exported.
+    """
+
+    type = 'gauge'
+
+    def _make_child(self):
+        return _GaugeChild()
+
+    def _samples(self, values, child):
+        return [('', (), child.value)]
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Record an observed value.
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class _NullChild:
+    """
+    A child of any type of metric ignoring its updates.
+    """
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+#: The child updated by the objects whose metrics aren't labeled yet, ignoring the updates.
+null_child = _NullChild()
+
+
+class Histogram(Metric):
+    """
+    The distribution of observed values in cumulative buckets.
+
+    Args:
+        name (str): The name of the metric.
+        documentation (str): The help text of the metric.
+        labelnames (tuple): The names of the labels of the metric. Defaults to no labels.
+        buckets (tuple): The increasing upper bounds of the buckets. A `+Inf` bucket is added.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(1, 10, 100, 1000)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def _make_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _samples(self, values, child):
+        samples = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets, child.counts):
+            count += bucket_count
+            samples.append(('_bucket', [('le', _format_value(bound))], count))
+        samples.append(('_count', (), count))
+        samples.append(('_sum', (), child.sum))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    A set of metrics exported together.
+
+    Collectors are called before each export, to set the gauges reporting the current state of
+    something, e.g. the depth of queues.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(_('A metric named {name} is registered already.').format(
+                    name=metric.name))
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Register a :class:`Counter`.
+
+        Raises:
+            ValueError: When a metric named `name` is registered already.
+        """
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        """
+        Register a :class:`Gauge`.
+
+        Raises:
+            ValueError: When a metric named `name` is registered already.
+        """
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=(1, 10, 100, 1000)):
+        """
+        Register a :class:`Histogram`.
+
+        Raises:
+            ValueError: When a metric named `name` is registered already.
+        """
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """
+        Add a function called without arguments before each export.
+
+        Args:
+            collector (callable): The function.
+        """
+        self._collectors.append(collector)
+
+    def export(self):
+        """
+        Return all metrics in the OpenMetrics text format.
+
+        Returns:
+            str: The exposition, ending with `# EOF`.
+        """
+        for collector in self._collectors:
+            collector()
+        families = [metric.export() for name, metric in sorted(self._metrics.items())]
+        return '\n'.join(families + ['# EOF']) + '\n'
+
+    def write_textfile(self, path):
+        """
+        Write all metrics in the OpenMetrics text format to `path`, atomically.
+
+        Args:
+            path (str): The path of the file. A `{pid}` in it is replaced by the process id.
+        """
+        path = path.format(pid=os.getpid())
+        directory = os.path.dirname(path) or '.'
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as textfile:
+            textfile.write(self.export())
+        os.chmod(textfile.name, 0o644)
+        os.replace(textfile.name, path)
+
+
+#: (:class:`MetricsRegistry`): The registry of the metrics of this process.
+registry = MetricsRegistry()
+
+stage_items = registry.counter(
+    'pulp_stage_items', 'The number of items passed on by each stage.', ['stage'])
+stage_batch_size = registry.histogram(
+    'pulp_stage_batch_size', 'The number of items in the batches served by each stage.',
+    ['stage'], buckets=(1, 10, 50, 100, 200, 500, 1000, 5000))
+stage_queue_depth = registry.gauge(
+    'pulp_stage_queue_depth', 'The number of items waiting in the queues feeding each stage.',
+    ['stage'])
+download_bytes = registry.counter(
+    'pulp_download_bytes', 'The number of bytes downloaded from each host.', ['host'])
+download_duration = registry.histogram(
+    'pulp_download_duration_seconds', 'The time downloads from each host took, with retries.',
+    ['host'], buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+download_retries = registry.counter(
+    'pulp_download_retries', 'The number of retried requests to each host.', ['host'])
+download_digest_failures = registry.counter(
+    'pulp_download_digest_failures',
+    'The number of downloads from each host whose digest or size was wrong.', ['host'])
+
+#: (weakref.WeakKeyDictionary): The stage label of each queue of the running pipelines.
+_queues = weakref.WeakKeyDictionary()
+
+
+def stage_label(stage):
+    """
+    Return the label of a stage in the metrics, which is the qualified name of its class.
+
+    Args:
+        stage (:class:`~pulpcore.plugin.stages.Stage`): The stage.
+
+    Returns:
+        str: The label.
+    """
+    return '.'.join([stage.__class__.__module__, stage.__class__.__name__])
+
+
+def host_label(url):
+    """
+    Return the label of the host of a url in the metrics.
+
+    Args:
+        url (str): The url.
+
+    Returns:
+        str: The host name, or an empty string for urls without one, like `file://` urls.
+    """
+    return urlsplit(url).hostname or ''
+
+
+def track_queue(queue, stage):
+    """
+    Report the depth of a queue feeding a stage with `pulp_stage_queue_depth`, while it exists.
+
+    Args:
+        queue (asyncio.Queue): The queue.
+        stage (:class:`~pulpcore.plugin.stages.Stage`): The stage the queue feeds.
+    """
+    _queues[queue] = stage_label(stage)
+
+
+def _collect_queue_depths():
+    # stages whose queues are gone are reported as empty
+    depths = dict.fromkeys((values[0] for values in list(stage_queue_depth._children)), 0)
+    for queue, label in list(_queues.items()):
+        depths[label] = depths.get(label, 0) + queue.qsize()
+    for label, depth in depths.items():
+        stage_queue_depth.labels(label).set(depth)
+
+
+registry.add_collector(_collect_queue_depths)
+
+
+async def metrics_handler(request):
+    """
+    An `aiohttp` handler serving the metrics of this process in the OpenMetrics text format.
+
+    >>> app.router.add_get('/metrics', metrics_handler)
+    """
+    return web.Response(body=registry.export().encode(), headers={'Content-Type': CONTENT_TYPE})
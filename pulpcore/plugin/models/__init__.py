@@ -21,6 +21,6 @@ from pulpcore.app.models import (  # noqa
     RepositoryVersion
 )
 
-from .content import ContentGuard  # noqa
+from .content import ContentGuard, bulk_create_content  # noqa
 from .publisher import Publisher  # noqa
 from .remote import Remote  # noqa
@@ -1,3 +1,8 @@
+from gettext import gettext as _
+
+import django
+from django.db import NotSupportedError, router, transaction
+
 from pulpcore.app import models
 
 
@@ -29,3 +34,129 @@ class ContentGuard(models.ContentGuard):
             PermissionError: When not authorized.
         """
         raise NotImplementedError()
+
+
+def bulk_create_content(units, batch_size=None, ignore_conflicts=False):
+    """
+    Insert unsaved instances of a multi-table inherited Content model in bulk.
+
+    Django's `bulk_create()` refuses multi-table inherited models such as the subclasses of
+    :class:`~pulpcore.plugin.models.Content`. This inserts the master
+    :class:`~pulpcore.plugin.models.Content` rows first, wires their primary keys into `units`,
+    and then inserts the detail rows. Each batch takes two INSERT statements.
+
+    Like `bulk_create()`, `save()` is not called on `units` and no signals are sent. The `_type`
+    field is filled in the same way `save()` would fill it.
+
+    With `ignore_conflicts` the detail rows are inserted with conflict-ignoring semantics. Units
+    which conflict with existing rows are left unsaved, their master rows are deleted, and they are
+    omitted from the returned list. Existing units can then be fetched by their natural keys.
+
+    The detail rows are inserted and the master rows of conflicting units are deleted with the
+    private `QuerySet._batched_insert()` and `QuerySet._raw_delete()`, whose signatures this relies
+    on. They hold from Django 2.0 to 4.0, and `ignore_conflicts` requires Django 2.2 or later.
+    Django 4.1 replaced the `ignore_conflicts` argument of `_batched_insert()`.
+
+    Example:
+        >>> units = [MyContent(name=name) for name in names]
+        >>> inserted = bulk_create_content(units, ignore_conflicts=True)
+
+    Args:
+        units (iterable): Unsaved instances of a single subclass of
+            :class:`~pulpcore.plugin.models.Content`.
+        batch_size (int): How many units are inserted by a single statement. Defaults to as many
+            as the database backend allows.
+        ignore_conflicts (bool): If True, skip units conflicting with existing rows instead of
+            raising. Defaults to False.
+
+    Returns:
+        list: The units that were inserted, with their primary keys set.
+
+    Raises:
+        ValueError: When `units` are not instances of a single model with exactly one concrete
+            parent model.
+        django.db.IntegrityError: When a unit conflicts with an existing row and
+            `ignore_conflicts` is False.
+        django.db.NotSupportedError: When the database backend cannot return the primary keys of
+            bulk inserted rows, or when `ignore_conflicts` is used before Django 2.2.
+    """
+    if ignore_conflicts and django.VERSION < (2, 2):
+        raise NotSupportedError(_('Ignoring conflicts requires Django 2.2 or later.'))
+    units = list(units)
+    if not units:
+        return units
+    model = type(units[0])
+    if any(type(unit) is not model for unit in units):
+        raise ValueError(_('All units must be instances of the same Content model.'))
+    parents = model._meta.get_parent_list()
+    if len(parents) != 1:
+        msg = _('{model} must inherit from exactly one concrete model.')
+        raise ValueError(msg.format(model=model.__name__))
+    master = parents[0]
+    master_pk = master._meta.pk
+    master_fields = [field for field in master._meta.concrete_fields if field is not master_pk]
+    parent_link = model._meta.get_ancestor_link(master)
+    using = router.db_for_write(model)
+
+    with transaction.atomic(using=using, savepoint=False):
+        master_units = []
+        for unit in units:
+            if not unit._type:
+                # The same default MasterModel.save() uses
+                unit._type = '{app_label}.{type}'.format(app_label=model._meta.app_label,
+                                                         type=model.TYPE)
+            master_units.append(
+                master(**{field.attname: getattr(unit, field.attname) for field in master_fields})
+            )
+        master._base_manager.db_manager(using).bulk_create(master_units, batch_size=batch_size)
+
+        for unit, master_unit in zip(units, master_units):
+            if master_unit.pk is None:
+                raise NotSupportedError(
+                    _('The database backend does not return primary keys from bulk inserts.')
+                )
+            for field in master_fields:
+                setattr(unit, field.attname, getattr(master_unit, field.attname))
+            setattr(unit, master_pk.attname, master_unit.pk)
+            setattr(unit, parent_link.attname, master_unit.pk)
+
+        detail_kwargs = {'ignore_conflicts': True} if ignore_conflicts else {}
+        model._base_manager.db_manager(using).all()._batched_insert(
+            units, model._meta.local_concrete_fields, batch_size, **detail_kwargs
+        )
+
+        if ignore_conflicts:
+            unit_pks = [unit.pk for unit in units]
+            inserted_pks = set(
+                model._base_manager.db_manager(using).filter(pk__in=unit_pks)
+                .values_list('pk', flat=True)
+            )
+            conflicting_pks = [pk for pk in unit_pks if pk not in inserted_pks]
+            if conflicting_pks:
+                master._base_manager.db_manager(using).filter(
+                    pk__in=conflicting_pks
+                )._raw_delete(using)
+
+    inserted = []
+    for unit in units:
+        if ignore_conflicts and unit.pk not in inserted_pks:
+            _reset_pk(unit)
+        else:
+            unit._state.adding = False
+            unit._state.db = using
+            inserted.append(unit)
+    return inserted
+
+
+def _reset_pk(unit):
+    """
+    Clear the primary keys of a model instance which was not inserted.
+
+    Args:
+        unit (:class:`django.db.models.Model`): The instance to reset, including the primary keys of
+            any multi-table inheritance parents.
+    """
+    unit.pk = None
+    for parent in unit._meta.get_parent_list():
+        setattr(unit, parent._meta.pk.attname, None)
+    unit._state.adding = True
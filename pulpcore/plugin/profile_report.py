@@ -0,0 +1,327 @@
+"""
+Report the bottleneck of Stages API pipelines from the profile dbs of the `PROFILE_STAGES_API`
+profiler.
+
+Run it with the paths of one or more profile dbs::
+
+    $ python -m pulpcore.plugin.profile_report /var/lib/pulp/debug/<job id> [--json]
+
+The stages of all the dbs are matched on their name and position in the pipeline, so the dbs of
+several runs of the same pipeline are reported together.
+
+If the profiler dropped samples because it could not write them fast enough, the report says so:
+its statistics are then computed from the samples that were kept.
+"""
+from gettext import gettext as _
+import argparse
+import json
+import math
+import sqlite3
+import sys
+
+
+#: (float): The relative difference between the mean queue length and the one predicted by
+#: Little's law above which the samples of a queue are reported as inconsistent.
+LITTLE_TOLERANCE = 0.25
+
+#: (float): The share of the longest mean waiting time from which stages are candidates for the
+#: bottleneck.
+BOTTLENECK_TOLERANCE = 0.9
+
+
+def percentile(values, share):
+    """
+    Return the nearest-rank percentile of sorted values.
+
+    Args:
+        values (list): The sorted values.
+        share (float): The percentile, between 0 and 1.
+
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    rank = max(1, math.ceil(len(values) * share))
+    return values[rank - 1]
+
+
+def summarize(values):
+    """
+    Return the mean, median, 95th and 99th percentiles and maximum of values.
+
+    Args:
+        values (list): The values.
+
+    Returns:
+        dict: The statistics, which are None if there are no values.
+    """
+    values = sorted(values)
+    return {
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': values[-1] if values else None,
+    }
+
+
+def read_profile(db_path, stages, dropped):
+    """
+    Add the samples of a profile db to the samples of the stages, keyed on (num, name).
+
+    Args:
+        db_path (str): The path of the profile db.
+        stages (dict): The samples of the stages read so far.
+        dropped (dict): The number of rows dropped by the profiler read so far, per table.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        keys = {}
+        for uuid, name, num in conn.execute('SELECT uuid, name, num FROM stages'):
+            key = keys[uuid] = (num, name)
+            stages.setdefault(key, {
+                'waiting_times': [], 'service_times': [], 'lengths': [], 'duration': 0.0,
+                'batches': [],
+            })
+        for uuid, waiting_time, service_time in conn.execute(
+                'SELECT uuid, waiting_time, service_time FROM traffic'):
+            samples = stages[keys[uuid]]
+            samples['waiting_times'].append(waiting_time)
+            samples['service_times'].append(service_time)
+        for uuid, length, interarrival_time in conn.execute(
+                'SELECT uuid, length, interarrival_time FROM system'):
+            samples = stages[keys[uuid]]
+            samples['lengths'].append(length)
+            # the first interarrival time is measured from the creation of the queue
+            samples['duration'] += interarrival_time
+        tables = {table for table, in conn.execute("SELECT name FROM sqlite_master")}
+        if 'batch_queries' in tables:
+            # profile dbs written before the queries of batches were recorded lack the table
+            for uuid, size, queries, db_time, service_time in conn.execute(
+                    'SELECT uuid, size, queries, db_time, service_time FROM batch_queries'):
+                stages[keys[uuid]]['batches'].append((size, queries, db_time, service_time))
+        if 'dropped_rows' in tables:
+            for table, count in conn.execute('SELECT name, count FROM dropped_rows'):
+                dropped[table] = dropped.get(table, 0) + count
+    finally:
+        conn.close()
+
+
+def analyze_stage(num, name, samples):
+    """
+    Return the statistics of a stage and of the queue feeding it.
+
+    The `utilization` is the mean number of items in service in the stage, so it is above 1 for
+    stages serving items concurrently. It is None for stages that don't pass items on, whose
+    service isn't measured. The service time of a stage includes the time it waited to
+    put items into a full downstream queue.
+
+    Little's law says the mean queue length is the arrival rate times the mean waiting time. The
+    `little_error` is their relative difference: the samples of queues whose waiting time can't be
+    measured, such as the one of the last stage, or of queues that are not in a steady state, may
+    not satisfy it.
+
+    The `batch_queries` are the number of SQL queries per batch and per item, and the share of the
+    service time of the batches spent in the database, or None if the stage didn't serve batches.
+    More than about one query per item points to queries made for each item of a batch.
+
+    Args:
+        num (int): The position of the stage in the pipeline.
+        name (str): The name of the stage.
+        samples (dict): The samples of the stage read by :func:`read_profile`.
+
+    Returns:
+        dict: The statistics of the stage.
+    """
+    duration = samples['duration']
+    arrivals = len(samples['lengths'])
+    arrival_rate = arrivals / duration if duration else None
+    waiting_time = summarize(samples['waiting_times'])
+    service_time = summarize(samples['service_times'])
+    queue_length = summarize(samples['lengths'])
+    utilization = None
+    if duration and samples['service_times']:
+        utilization = sum(samples['service_times']) / duration
+
+    little_length = little_error = None
+    if arrival_rate is not None and waiting_time['mean'] is not None:
+        little_length = arrival_rate * waiting_time['mean']
+        largest = max(little_length, queue_length['mean'])
+        little_error = abs(little_length - queue_length['mean']) / largest if largest else 0.0
+    # the waiting time of the queue as given by Little's law, for queues where it isn't measured
+    little_waiting_time = queue_length['mean'] / arrival_rate if arrival_rate else None
+
+    batch_queries = None
+    if samples['batches']:
+        sizes, queries, db_times, service_times = zip(*samples['batches'])
+        batch_service_time = sum(service_times)
+        batch_queries = {
+            'batches': len(sizes),
+            'queries_per_batch': summarize(queries),
+            'queries_per_item': sum(queries) / sum(sizes) if sum(sizes) else None,
+            'db_time': sum(db_times),
+            'db_time_share': sum(db_times) / batch_service_time if batch_service_time else None,
+        }
+
+    return {
+        'num': num,
+        'name': name,
+        'items': len(samples['service_times']),
+        'arrivals': arrivals,
+        'duration': duration,
+        'arrival_rate': arrival_rate,
+        'utilization': utilization,
+        'waiting_time': waiting_time,
+        'service_time': service_time,
+        'queue_length': queue_length,
+        'little_queue_length': little_length,
+        'little_error': little_error,
+        'little_consistent': little_error is None or little_error <= LITTLE_TOLERANCE,
+        'little_waiting_time': little_waiting_time,
+        'batch_queries': batch_queries,
+    }
+
+
+def find_bottleneck(stages):
+    """
+    Return the bottleneck stage of a pipeline.
+
+    Items pile up in front of the bottleneck: by Little's law, it is the stage items wait for the
+    longest in its queue, given as the mean queue length over the arrival rate. The stages upstream
+    of the bottleneck wait to put items into full queues, so their queues are as long: the
+    bottleneck is the last stage whose mean waiting time is within `BOTTLENECK_TOLERANCE` of the
+    longest.
+
+    Args:
+        stages (list): The statistics of the stages in pipeline order, from :func:`analyze_stage`.
+
+    Returns:
+        dict: The statistics of the bottleneck stage, or None if no queue had arrivals.
+    """
+    candidates = [stage for stage in stages if stage['little_waiting_time'] is not None]
+    if not candidates:
+        return None
+    longest = max(stage['little_waiting_time'] for stage in candidates)
+    if not longest:
+        # no item ever waited, so the busiest stage limits the pipeline
+        return max(candidates, key=lambda stage: stage['utilization'] or 0.0)
+    return [stage for stage in candidates
+            if stage['little_waiting_time'] >= longest * BOTTLENECK_TOLERANCE][-1]
+
+
+def analyze(db_paths):
+    """
+    Analyze profile dbs of the same pipeline.
+
+    Args:
+        db_paths (list): The paths of the profile dbs.
+
+    Returns:
+        dict: The statistics of each stage in pipeline order as `stages`, the name of the
+        bottleneck stage as `bottleneck`, and the number of rows dropped by the profiler per table
+        as `dropped_rows`.
+    """
+    samples = {}
+    dropped = {}
+    for db_path in db_paths:
+        read_profile(db_path, samples, dropped)
+    stages = [analyze_stage(num, name, samples[(num, name)]) for num, name in sorted(samples)]
+    bottleneck = find_bottleneck(stages)
+    return {
+        'profiles': list(db_paths),
+        'stages': stages,
+        'bottleneck': bottleneck['name'] if bottleneck else None,
+        'dropped_rows': dropped,
+    }
+
+
+def _format_stats(stats, unit=''):
+    if stats['mean'] is None:
+        return _('n/a')
+    return _('mean {mean:.4f}{unit} p50 {p50:.4f}{unit} p95 {p95:.4f}{unit} '
+             'p99 {p99:.4f}{unit}').format(unit=unit, **stats)
+
+
+def _format_share(share):
+    return _('n/a') if share is None else '{share:.1%}'.format(share=share)
+
+
+def _format_number(number):
+    return _('n/a') if number is None else '{number:.2f}'.format(number=number)
+
+
+def format_report(report):
+    """
+    Return the text report of the statistics returned by :func:`analyze`.
+
+    Args:
+        report (dict): The statistics.
+
+    Returns:
+        str: The report.
+    """
+    lines = []
+    for table, count in sorted(report['dropped_rows'].items()):
+        lines.append(_('Warning: the profiler dropped {count} rows of the {table} table, the '
+                       'statistics are computed from incomplete samples.').format(
+            count=count, table=table))
+    for stage in report['stages']:
+        lines.append('{num} {name}'.format(**stage))
+        if stage['utilization'] is not None:
+            lines.append(_('    utilization      {utilization:.2f} over {duration:.2f}s, '
+                           '{items} items served').format(**stage))
+        lines.append(_('    waiting time     {stats}').format(
+            stats=_format_stats(stage['waiting_time'], 's')))
+        lines.append(_('    service time     {stats}').format(
+            stats=_format_stats(stage['service_time'], 's')))
+        if stage['arrival_rate'] is not None:
+            lines.append(_('    queue length     {stats} max {max}').format(
+                stats=_format_stats(stage['queue_length']), **stage['queue_length']))
+            lines.append(_('    arrival rate     {arrival_rate:.2f}/s, {arrivals} '
+                           'arrivals').format(**stage))
+        if stage['little_error'] is not None:
+            lines.append(_("    Little's law     L={length:.2f} vs lambda*W={little:.2f}, "
+                           "{verdict}").format(
+                length=stage['queue_length']['mean'], little=stage['little_queue_length'],
+                verdict=_('consistent') if stage['little_consistent'] else _('inconsistent')))
+        batch_queries = stage['batch_queries']
+        if batch_queries is not None:
+            lines.append(_('    queries/batch    {stats}').format(
+                stats=_format_stats(batch_queries['queries_per_batch'])))
+            lines.append(_('    db time          {db_time:.2f}s, {share} of the batch service '
+                           'time, {per_item} queries/item').format(
+                db_time=batch_queries['db_time'],
+                share=_format_share(batch_queries['db_time_share']),
+                per_item=_format_number(batch_queries['queries_per_item'])))
+    if report['bottleneck']:
+        lines.append(_('Bottleneck: {name}').format(name=report['bottleneck']))
+    else:
+        lines.append(_('Bottleneck: unknown, no queue had arrivals'))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """
+    Print the report of the profile dbs given on the command line.
+
+    Args:
+        argv (list): The command line arguments. Defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(
+        description=_('Report the bottleneck of a Stages API pipeline from its profile dbs.'))
+    parser.add_argument('db_paths', nargs='+', metavar='db_path',
+                        help=_('The path to a sqlite3 profile db.'))
+    parser.add_argument('--json', action='store_true',
+                        help=_('Print the report as JSON.'))
+    args = parser.parse_args(argv)
+    report = analyze(args.db_paths)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
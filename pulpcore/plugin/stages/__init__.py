@@ -1,4 +1,14 @@
-from .api import create_pipeline, EndStage, Stage  # noqa
+from .api import (  # noqa
+    BatchSizeController,
+    create_pipeline,
+    EndStage,
+    ItemBatch,
+    ProcessPoolStage,
+    ReplicatedStage,
+    RoutingStage,
+    Stage,
+)
+from .artifact_cache import ArtifactCache  # noqa
 from .artifact_stages import (  # noqa
     ArtifactDownloader,
     ArtifactSaver,
@@ -10,7 +20,10 @@ from .association_stages import (  # noqa
     ContentUnassociation,
     RemoveDuplicates
 )
+from .bloom_filter import ArtifactBloomFilter, shared_artifact_bloom_filter  # noqa
 from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures  # noqa
 from .declarative_version import DeclarativeVersion  # noqa
 from .models import DeclarativeArtifact, DeclarativeContent  # noqa
 from .profiler import ProfilingQueue, create_profile_db_and_connection  # noqa
+from .queues import estimate_size, WeightedQueue  # noqa
+from .tracing import start_tracing, stop_tracing, Tracer  # noqa
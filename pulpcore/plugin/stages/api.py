@@ -1,11 +1,28 @@
 import asyncio
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
 import logging
+import multiprocessing
+import os
 
 from gettext import gettext as _
 
 from django.conf import settings
+from django.db import connection, connections
 
-from .profiler import ProfilingQueue
+from pulpcore.plugin import metrics
+
+from . import tracing
+from .models import DeclarativeContent
+from .profiler import (
+    flush_profile_db,
+    ProfilingQueue,
+    QueryCounter,
+    record_batch_queries,
+    record_batch_size,
+)
+from .queues import make_queue_like, WeightedQueue
 
 
 log = logging.getLogger(__name__)
@@ -16,11 +33,56 @@ class Stage:
     The base class for all Stages API stages.
 
     To make a stage, inherit from this class and implement :meth:`run` on the subclass.
+
+    The batching behavior of :meth:`batches` can be configured per stage instance. This is how
+    :meth:`~pulpcore.plugin.stages.DeclarativeVersion.pipeline_stages` bounds the batches of the
+    stages that query the database.
+
+    Stages that query the database should do so through :meth:`run_database`. If
+    `database_thread` is True, those calls run on a thread dedicated to this stage, which holds its
+    own database connection. The event loop then keeps serving the other stages, such as in-flight
+    downloads, and the next batch accumulates while the current one is written.
+
+    Args:
+        batch_minsize (int): The default `minsize` of :meth:`batches`. Defaults to 50.
+        batch_maxsize (int): The default `maxsize` of :meth:`batches`. Defaults to None.
+        batch_max_wait (float): The default `max_wait` of :meth:`batches`. Defaults to None.
+        batch_controller (:class:`~pulpcore.plugin.stages.BatchSizeController`): The default
+            `controller` of :meth:`batches`. Defaults to None.
+        database_thread (bool): If True, :meth:`run_database` runs functions on a dedicated
+            thread. Defaults to False.
     """
 
-    def __init__(self):
+    # The defaults of the attributes set by __init__, for stages not calling it
+    _in_q = None
+    _out_q = None
+    batch_minsize = 50
+    batch_maxsize = None
+    batch_max_wait = None
+    batch_controller = None
+    database_thread = False
+    _database_executor = None
+    #: (:class:`~pulpcore.plugin.stages.profiler.QueryCounter`): The query counter of the
+    #: batch being served, when profiling.
+    _query_counter = None
+    #: (float): The number of seconds :meth:`put` and :meth:`put_many` waited on a full `_out_q`.
+    _put_blocked_time = 0.0
+    # The metrics of the stage, which ignore their updates until _connect() labels them
+    _items_counter = metrics.null_child
+    _batch_size_histogram = metrics.null_child
+
+    def __init__(self, batch_minsize=50, batch_maxsize=None, batch_max_wait=None,
+                 batch_controller=None, database_thread=False):
         self._in_q = None
         self._out_q = None
+        self.batch_minsize = batch_minsize
+        self.batch_maxsize = batch_maxsize
+        self.batch_max_wait = batch_max_wait
+        self.batch_controller = batch_controller
+        self.database_thread = database_thread
+        self._database_executor = None
+        self._query_counter = None
+        self._put_blocked_time = 0.0
 
     def _connect(self, in_q, out_q):
         """
@@ -32,6 +94,9 @@ class Stage:
         """
         self._in_q = in_q
         self._out_q = out_q
+        label = metrics.stage_label(self)
+        self._items_counter = metrics.stage_items.labels(label)
+        self._batch_size_histogram = metrics.stage_batch_size.labels(label)
 
     async def __call__(self):
         """
@@ -40,10 +105,55 @@ class Stage:
         It calls :meth:`run` and signals the next stage that its work is finished.
         """
         log.debug(_('%(name)s - begin.'), {'name': self})
-        await self.run()
+        try:
+            await self.run()
+        finally:
+            self._close_database_thread()
         await self._out_q.put(None)
         log.debug(_('%(name)s - put end-marker.'), {'name': self})
 
+    async def run_database(self, func, *args, **kwargs):
+        """
+        Coroutine calling `func` with `args` and `kwargs`, which may query the database.
+
+        If `database_thread` is set, `func` runs on the thread dedicated to this stage, and the
+        event loop is free to run other stages until it returns. All calls of one stage run on the
+        same thread, in order, so they share a database connection and can rely on connection
+        state like temporary tables. Otherwise `func` is called directly.
+
+        Args:
+            func (callable): The function to call.
+            args: positional arguments passed to `func`.
+            kwargs: keyword arguments passed to `func`.
+
+        Returns:
+            The return value of `func`.
+        """
+        if not self.database_thread:
+            return func(*args, **kwargs)
+        if self._database_executor is None:
+            self._database_executor = ThreadPoolExecutor(max_workers=1)
+        query_counter = self._query_counter
+
+        def call():
+            if query_counter is None:
+                return func(*args, **kwargs)
+            with connection.execute_wrapper(query_counter):
+                return func(*args, **kwargs)
+
+        return await asyncio.get_event_loop().run_in_executor(self._database_executor, call)
+
+    def _close_database_thread(self):
+        """
+        Close the database connection of the dedicated thread, and let the thread exit.
+
+        This does not wait for a call that is still running, e.g. if the stage was cancelled.
+        """
+        if self._database_executor is not None:
+            self._database_executor.submit(connections.close_all)
+            self._database_executor.shutdown(wait=False)
+            self._database_executor = None
+
     async def run(self):
         """
         The coroutine that is run as part of this stage.
@@ -54,6 +164,24 @@ class Stage:
         """
         raise NotImplementedError(_('A plugin writer must implement this method'))
 
+    async def fingerprint(self):
+        """
+        Return a fingerprint of the upstream metadata the content of this stage is declared from.
+
+        Only the first stage of a :class:`~pulpcore.plugin.stages.DeclarativeVersion` is asked for
+        its fingerprint, before the pipeline runs. If it equals the fingerprint recorded by the
+        last sync of the repository, and the repository has no newer version, the sync is skipped.
+
+        A fingerprint may combine the `ETag` and `Last-Modified` headers of the metadata, or its
+        digest, with the url of the remote. It must change whenever :meth:`run` could declare
+        different content. The metadata downloaded to compute it can be kept for :meth:`run`.
+
+        Returns:
+            str: The fingerprint, or None if the upstream metadata can't be fingerprinted. The
+            default implementation returns None.
+        """
+        return None
+
     async def items(self):
         """
         Asynchronous iterator yielding items of :class:`DeclarativeContent` from `self._in_q`.
@@ -78,19 +206,47 @@ class Stage:
             content = await self._in_q.get()
             if content is None:
                 break
-            log.debug(_('%(name)s - next: %(content)s.'), {'name': self, 'content': content})
-            yield content
+            for item in (content if type(content) is ItemBatch else (content,)):
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(_('%(name)s - next: %(content)s.'), {'name': self, 'content': item})
+                if tracing.TRACER is not None:
+                    tracing.trace_get(item, self)
+                yield item
 
-    async def batches(self, minsize=50):
+    async def batches(self, minsize=None, maxsize=None, max_wait=None, controller=None):
         """
         Asynchronous iterator yielding batches of :class:`DeclarativeContent` from `self._in_q`.
 
         The iterator will try to get as many instances of
         :class:`DeclarativeContent` as possible without blocking, but
-        at least `minsize` instances.
+        at least `minsize` instances and at most `maxsize` instances.
+
+        If `max_wait` is set, a batch smaller than `minsize` is yielded anyway once `max_wait`
+        seconds have passed since its first instance arrived.
+
+        Lists of items passed on at once with :meth:`put_many` are unpacked, and split if they don't
+        fit into a batch of `maxsize`.
+
+        If a `controller` is given, the time from yielding a batch until the next batch is
+        requested is reported to it as the service time of that batch, less the time :meth:`put`
+        and :meth:`put_many` waited on a full downstream queue meanwhile, and the batch size is
+        additionally bounded by its :attr:`~pulpcore.plugin.stages.BatchSizeController.size`.
+        When profiling is enabled, each size chosen by the controller is recorded too.
+
+        When profiling is enabled, the number of SQL queries the stage executes while serving each
+        batch, and the time they take, are recorded as well. Queries run with
+        :meth:`run_database` are counted.
+
+        Each argument that is not specified defaults to the corresponding `batch_minsize`,
+        `batch_maxsize`, `batch_max_wait`, or `batch_controller` of this stage.
 
         Args:
             minsize (int): The minimum batch size to yield (unless it is the final batch)
+            maxsize (int): The maximum batch size to yield. None means unbounded.
+            max_wait (float): The maximum number of seconds to wait for a batch to reach `minsize`.
+                None means no time limit.
+            controller (:class:`~pulpcore.plugin.stages.BatchSizeController`): An optional
+                controller adjusting the batch size to the measured service time.
 
         Yields:
             A list of :class:`DeclarativeContent` instances
@@ -103,46 +259,148 @@ class Stage:
                         async for batch in self.batches():
                             for d_content in batch:
                                 # process declarative content
-                                await self.put(d_content)
+                            await self.put_many(batch)
 
         """
+        if minsize is None:
+            minsize = self.batch_minsize
+        if maxsize is None:
+            maxsize = self.batch_maxsize
+        if max_wait is None:
+            max_wait = self.batch_max_wait
+        if controller is None:
+            controller = self.batch_controller
+
+        def current_maxsize():
+            if controller is None:
+                return maxsize
+            if maxsize is None:
+                return controller.size
+            return min(maxsize, controller.size)
+
+        target_maxsize = current_maxsize()
+        loop = asyncio.get_event_loop()
         batch = []
         shutdown = False
         no_block = False
+        #: (float): The loop time at which the current batch is due, if `max_wait` is set.
+        deadline = None
+        #: (:class:`asyncio.Task`): A get from `self._in_q` that outlived a `max_wait` timeout.
+        get_task = None
 
         def add_to_batch(content):
             nonlocal batch
             nonlocal shutdown
             nonlocal no_block
+            nonlocal deadline
             if content is None:
                 shutdown = True
                 log.debug(_('%(name)s - shutdown.'), {'name': self})
+                return
+            if not batch and max_wait is not None:
+                deadline = loop.time() + max_wait
+            if type(content) is ItemBatch:
+                for item in content:
+                    if not item.does_batch:
+                        no_block = True
+                batch.extend(content)
             else:
                 if not content.does_batch:
                     no_block = True
                 batch.append(content)
 
-        while not shutdown:
-            content = await self._in_q.get()
-            add_to_batch(content)
+        def is_full():
+            return target_maxsize is not None and len(batch) >= target_maxsize
+
+        def is_ready():
+            if target_maxsize is None:
+                return len(batch) >= minsize
+            return len(batch) >= min(minsize, target_maxsize)
+
+        try:
             while not shutdown:
-                try:
-                    content = self._in_q.get_nowait()
-                except asyncio.QueueEmpty:
-                    break
+                timed_out = False
+                if batch and deadline is not None:
+                    if get_task is None:
+                        get_task = asyncio.ensure_future(self._in_q.get())
+                    done, _pending = await asyncio.wait(
+                        [get_task], timeout=max(deadline - loop.time(), 0)
+                    )
+                    if done:
+                        content = get_task.result()
+                        get_task = None
+                        add_to_batch(content)
+                    else:
+                        timed_out = True
+                elif get_task is not None:
+                    content = await get_task
+                    get_task = None
+                    add_to_batch(content)
                 else:
+                    content = await self._in_q.get()
                     add_to_batch(content)
+                while not shutdown and not is_full():
+                    try:
+                        content = self._in_q.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    else:
+                        add_to_batch(content)
 
-            if batch and (len(batch) >= minsize or shutdown or no_block):
-                log.debug(
-                    _('%(name)s - next batch[%(length)d].'),
-                    {
-                        'name': self,
-                        'length': len(batch),
-                    })
-                yield batch
-                batch = []
-                no_block = False
+                while batch and (is_ready() or shutdown or no_block or timed_out):
+                    if target_maxsize is not None and len(batch) > target_maxsize:
+                        next_batch = batch[:target_maxsize]
+                        batch = batch[target_maxsize:]
+                    else:
+                        next_batch = batch
+                        batch = []
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug(
+                            _('%(name)s - next batch[%(length)d].'),
+                            {
+                                'name': self,
+                                'length': len(next_batch),
+                            })
+                    self._batch_size_histogram.observe(len(next_batch))
+                    if tracing.TRACER is not None:
+                        for item in next_batch:
+                            tracing.trace_get(item, self)
+                    yielded_at = loop.time()
+                    blocked_before = self._put_blocked_time
+                    if settings.PROFILE_STAGES_API:
+                        # not execute_wrapper(), which removes the last wrapper, as the stages
+                        # sharing this thread don't remove theirs in reverse order
+                        query_counter = self._query_counter = QueryCounter()
+                        connection.execute_wrappers.append(query_counter)
+                        try:
+                            yield next_batch
+                        finally:
+                            connection.execute_wrappers.remove(query_counter)
+                            self._query_counter = None
+                        service_time = loop.time() - yielded_at
+                        record_batch_queries(
+                            self._in_q, len(next_batch), query_counter, service_time
+                        )
+                    else:
+                        yield next_batch
+                        service_time = loop.time() - yielded_at
+                    if controller is not None:
+                        # waiting on a full downstream queue isn't caused by the batch size
+                        handling_time = service_time - (self._put_blocked_time - blocked_before)
+                        controller.record(len(next_batch), handling_time)
+                        target_maxsize = current_maxsize()
+                        if settings.PROFILE_STAGES_API:
+                            record_batch_size(
+                                self._in_q, len(next_batch), controller.size, handling_time
+                            )
+                    if batch:
+                        no_block = any(not item.does_batch for item in batch)
+                    else:
+                        no_block = False
+                        deadline = None
+        finally:
+            if get_task is not None:
+                get_task.cancel()
 
     async def put(self, item):
         """
@@ -156,14 +414,673 @@ class Stage:
         """
         if item is None:
             raise ValueError(_('(None) not permitted.'))
+        if tracing.TRACER is not None:
+            tracing.trace_put(item)
+        await self._put_out(item)
+        self._items_counter.inc()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(_('%(name)s - put: %(content)s'), {'name': self, 'content': item})
+
+    async def _put_out(self, item):
+        """
+        Put `item` into `_out_q`, adding the time waited on a full queue to `_put_blocked_time`.
+        """
+        if not self._out_q.full():
+            await self._out_q.put(item)
+            return
+        loop = asyncio.get_event_loop()
+        blocked_at = loop.time()
         await self._out_q.put(item)
-        log.debug(_('%(name)s - put: %(content)s'), {'name': self, 'content': item})
+        self._put_blocked_time += loop.time() - blocked_at
+
+    async def _pass_on(self, item):
+        """
+        Pass on an item taken from a queue, which may be a list of items put with :meth:`put_many`.
+        """
+        if type(item) is ItemBatch:
+            await self.put_many(item)
+        else:
+            await self.put(item)
+
+    async def put_many(self, items):
+        """
+        Coroutine to pass a list of items to the next stage at once.
+
+        The items take a single place in the queue to the next stage, whose :meth:`items` and
+        :meth:`batches` iterators unpack them again. This saves a queue operation per item for
+        stages handling items in batches. They still count as `len(items)` towards the `maxsize`
+        of a :class:`~pulpcore.plugin.stages.WeightedQueue`, the queues built by
+        :func:`~pulpcore.plugin.stages.create_pipeline`.
+
+        Args:
+            items (list): Handled instances of :class:`pulpcore.plugin.stages.DeclarativeContent`
+
+        Raises:
+            ValueError: When one of `items` is None.
+        """
+        if any(item is None for item in items):
+            raise ValueError(_('(None) not permitted.'))
+        if not items:
+            return
+        if tracing.TRACER is not None:
+            for item in items:
+                tracing.trace_put(item)
+        if len(items) == 1:
+            await self._put_out(items[0])
+        else:
+            await self._put_out(ItemBatch(items))
+        self._items_counter.inc(len(items))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(_('%(name)s - put %(length)d items.'), {'name': self, 'length': len(items)})
 
     def __str__(self):
         return '[{id}] {name}'.format(id=id(self), name=self.__class__.__name__)
 
 
-async def create_pipeline(stages, maxsize=100):
+class ItemBatch(list):
+    """
+    A list of items passed between two stages as a single queue item by
+    :meth:`~pulpcore.plugin.stages.Stage.put_many`.
+    """
+
+
+class BatchSizeController:
+    """
+    Adjusts the batch size of a stage to reach a target service time per batch.
+
+    The controller keeps an exponentially weighted moving average of the service time per item, and
+    sets :attr:`size` to the number of items expected to be served in `target_latency` seconds,
+    bounded by `minsize` and `maxsize`. Pass it to :meth:`~pulpcore.plugin.stages.Stage.batches`
+    or as the `batch_controller` of a :class:`~pulpcore.plugin.stages.Stage`.
+
+    Example:
+        >>> QueryExistingArtifacts(batch_controller=BatchSizeController(target_latency=0.5))
+
+    Args:
+        target_latency (float): The desired service time of one batch in seconds.
+        minsize (int): The smallest batch size to choose. Defaults to 1.
+        maxsize (int): The largest batch size to choose. Defaults to 1000.
+        initial_size (int): The batch size to start with. Defaults to 50.
+        smoothing (float): The weight of the newest measurement in the moving average, greater
+            than 0 and at most 1. Defaults to 0.3.
+
+    Attributes:
+        size (int): The current target batch size.
+
+    Raises:
+        ValueError: When `minsize` is larger than `maxsize` or `smoothing` is out of range.
+    """
+
+    def __init__(self, target_latency, minsize=1, maxsize=1000, initial_size=50, smoothing=0.3):
+        if minsize > maxsize:
+            raise ValueError(_('minsize must not be larger than maxsize.'))
+        if not 0 < smoothing <= 1:
+            raise ValueError(_('smoothing must be greater than 0 and at most 1.'))
+        self.target_latency = target_latency
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.smoothing = smoothing
+        self.size = self._bound(initial_size)
+        self._time_per_item = None
+
+    def _bound(self, size):
+        return max(self.minsize, min(self.maxsize, size))
+
+    def record(self, batch_size, service_time):
+        """
+        Record the service time of a batch and update :attr:`size`.
+
+        Args:
+            batch_size (int): The number of items in the batch.
+            service_time (float): The number of seconds the batch took to be served.
+        """
+        if batch_size <= 0:
+            return
+        time_per_item = service_time / batch_size
+        if self._time_per_item is None:
+            self._time_per_item = time_per_item
+        else:
+            self._time_per_item = (
+                self.smoothing * time_per_item + (1 - self.smoothing) * self._time_per_item
+            )
+        if self._time_per_item > 0:
+            self.size = self._bound(int(self.target_latency / self._time_per_item))
+        else:
+            self.size = self.maxsize
+
+
+class ReplicatedStage(Stage):
+    """
+    A Stages API stage that runs several replicas of a stage concurrently.
+
+    The replicas share the input of this stage, so each item is handled by whichever replica asks
+    for it first. The output of all replicas is merged into the output of this stage, and the end
+    of the stream is passed on only once, after all replicas have finished.
+
+    By default items are passed on in the order the replicas put them. If `ordered` is True, the
+    items are passed on in the order they arrived at this stage instead. This requires each replica
+    to put the items it keeps in the order it got them, as the builtin stages handling
+    :class:`~pulpcore.plugin.stages.DeclarativeContent` do, the
+    :class:`~pulpcore.plugin.stages.ArtifactDownloader` aside. An item a replica does not put is
+    skipped once the replica puts an item it got later, or once it ends. An item a replica puts
+    without having received it takes the place of the oldest item the replica got and did not put,
+    or is passed on right away if there is none. Items that are ahead of a slower replica are held
+    back, so ordering costs memory in proportion to how far the replicas drift apart.
+
+    Example:
+        >>> ReplicatedStage([ContentSaver() for i in range(4)], ordered=True)
+
+    Args:
+        replicas (list of :class:`~pulpcore.plugin.stages.Stage`): Distinct instances of the stage
+            to run.
+        ordered (bool): If True, keep the order of the items. Defaults to False.
+
+    Raises:
+        ValueError: When `replicas` is empty or contains a stage instance more than once.
+    """
+
+    def __init__(self, replicas, ordered=False):
+        super().__init__()
+        if not replicas:
+            raise ValueError(_('At least one replica is required.'))
+        if len(set(replicas)) != len(replicas):
+            raise ValueError(_('Each stage instance must be unique.'))
+        self.replicas = list(replicas)
+        self.ordered = ordered
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        replicas_in_q = make_queue_like(self._in_q)
+        replicas_out_q = make_queue_like(self._out_q)
+        for replica in self.replicas:
+            if self.ordered:
+                taken = OrderedDict()
+                replica._connect(_ReplicaInput(replicas_in_q, taken),
+                                 _ReplicaOutput(replicas_out_q, taken))
+            else:
+                replica._connect(replicas_in_q, replicas_out_q)
+        if self.ordered:
+            # The queues hold envelopes, weigh what they carry
+            for queue in (replicas_in_q, replicas_out_q):
+                if isinstance(queue, WeightedQueue):
+                    queue.weigh = functools.partial(_weigh_envelope, queue.weigh)
+        futures = [asyncio.ensure_future(self._dispatch(replicas_in_q))]
+        futures.extend(asyncio.ensure_future(replica()) for replica in self.replicas)
+        futures.append(asyncio.ensure_future(self._merge(replicas_out_q)))
+        try:
+            await asyncio.gather(*futures)
+        finally:
+            for task in futures:
+                if not task.done():
+                    task.cancel()
+
+    async def _dispatch(self, replicas_in_q):
+        """
+        Pass the input of this stage on to the replicas, ending the stream once for each replica.
+
+        If `ordered` is True, each item is put into an envelope with its sequence number, which the
+        replica takes it out of when it gets the item.
+
+        Args:
+            replicas_in_q (:class:`asyncio.Queue`): The queue shared by the replicas as input.
+        """
+        sequence = 0
+        while True:
+            item = await self._in_q.get()
+            if item is None:
+                break
+            if not self.ordered:
+                await replicas_in_q.put(item)
+                continue
+            for element in (item if type(item) is ItemBatch else [item]):
+                await replicas_in_q.put((sequence, element))
+                sequence += 1
+        for replica in self.replicas:
+            await replicas_in_q.put(None)
+
+    async def _merge(self, replicas_out_q):
+        """
+        Pass the output of the replicas on, until each replica has ended its stream.
+
+        If `ordered` is True, the output of the replicas comes in envelopes holding the items the
+        replica got and did not put yet, and the items are passed on in sequence.
+
+        Args:
+            replicas_out_q (:class:`asyncio.Queue`): The queue shared by the replicas as output.
+        """
+        running = len(self.replicas)
+        held = {}
+        next_sequence = 0
+        while running:
+            item = await replicas_out_q.get()
+            if not self.ordered:
+                if item is None:
+                    running -= 1
+                else:
+                    await self._pass_on(item)
+                continue
+            taken, item = item
+            if item is None:
+                running -= 1
+                # the items the replica got and did not put are skipped
+                held.update(dict.fromkeys(taken, _SKIPPED))
+                taken.clear()
+            else:
+                for element in (item if type(item) is ItemBatch else [item]):
+                    sequence = _pop_sequence(taken, element, held)
+                    if sequence is None:
+                        await self.put(element)
+                    else:
+                        held[sequence] = element
+            while next_sequence in held:
+                element = held.pop(next_sequence)
+                if element is not _SKIPPED:
+                    await self.put(element)
+                next_sequence += 1
+        for sequence in sorted(held):
+            if held[sequence] is not _SKIPPED:
+                await self.put(held[sequence])
+
+    def __str__(self):
+        return '[{id}] {name}[{replicas}]'.format(
+            id=id(self), name=self.__class__.__name__, replicas=len(self.replicas)
+        )
+
+
+#: Marks the sequence numbers of the items a replica did not put.
+_SKIPPED = object()
+
+
+def _pop_sequence(taken, element, held):
+    """
+    Return the sequence number an item put by a replica is passed on at.
+
+    The items the replica got before `element` and did not put are marked as skipped in `held`. An
+    item the replica did not get takes the sequence number of the oldest item it got and did not
+    put.
+
+    Args:
+        taken (:class:`collections.OrderedDict`): The items the replica got and did not put yet,
+            keyed on their sequence numbers.
+        element: The item put by the replica.
+        held (dict): The items held back by the merge, keyed on their sequence numbers.
+
+    Returns:
+        int: The sequence number of `element`, or None if the replica has no item left to put.
+    """
+    for sequence, taken_element in taken.items():
+        if taken_element is element:
+            break
+    else:
+        if not taken:
+            return None
+        return taken.popitem(last=False)[0]
+    while True:
+        taken_sequence, _taken_element = taken.popitem(last=False)
+        if taken_sequence == sequence:
+            return sequence
+        held[taken_sequence] = _SKIPPED
+
+
+def _weigh_envelope(weigh, envelope):
+    return 0 if envelope[1] is None else weigh(envelope[1])
+
+
+class _ReplicaInput:
+    """
+    The input queue of a replica of an ordered :class:`ReplicatedStage`.
+
+    It takes the items out of the envelopes of the queue shared by the replicas, and records the
+    items the replica got in `taken`. Any other attribute is the one of the shared queue.
+
+    Args:
+        queue (:class:`asyncio.Queue`): The queue shared by the replicas as input.
+        taken (:class:`collections.OrderedDict`): The items the replica got and did not put yet,
+            keyed on their sequence numbers.
+    """
+
+    def __init__(self, queue, taken):
+        self._queue = queue
+        self._taken = taken
+
+    def __getattr__(self, name):
+        return getattr(self._queue, name)
+
+    def _open(self, envelope):
+        if envelope is None:
+            return None
+        sequence, item = envelope
+        self._taken[sequence] = item
+        return item
+
+    async def get(self):
+        return self._open(await self._queue.get())
+
+    def get_nowait(self):
+        return self._open(self._queue.get_nowait())
+
+
+class _ReplicaOutput:
+    """
+    The output queue of a replica of an ordered :class:`ReplicatedStage`.
+
+    It puts the items into envelopes with the `taken` items of the replica, end marker included,
+    into the queue shared by the replicas. Any other attribute is the one of the shared queue.
+
+    Args:
+        queue (:class:`asyncio.Queue`): The queue shared by the replicas as output.
+        taken (:class:`collections.OrderedDict`): The items the replica got and did not put yet,
+            keyed on their sequence numbers.
+    """
+
+    def __init__(self, queue, taken):
+        self._queue = queue
+        self._taken = taken
+
+    def __getattr__(self, name):
+        return getattr(self._queue, name)
+
+    async def put(self, item):
+        await self._queue.put((self._taken, item))
+
+    def put_nowait(self, item):
+        self._queue.put_nowait((self._taken, item))
+
+
+class RoutingStage(Stage):
+    """
+    A Stages API stage that routes items through one of several branches of stages and joins them.
+
+    Each branch is a list of stages that are connected in line, like the stages of
+    :func:`~pulpcore.plugin.stages.create_pipeline`. Each item is sent to the branch `route`
+    returns the key of, and the output of all branches is joined into the output of this stage.
+    Items routed to a branch without stages bypass the branches entirely. Items routed to a key
+    without a branch go to the branch with the key None, if there is one. The end of the stream is
+    passed on once, after all branches have finished. The order of items routed to different
+    branches is not kept.
+
+    By default items are routed by the type of their
+    :attr:`~pulpcore.plugin.stages.DeclarativeContent.content`, so content types that need no
+    artifacts can skip the artifact stages:
+
+    >>> RoutingStage({
+    >>>     MetadataContent: [],
+    >>>     None: [QueryExistingArtifacts(), ArtifactDownloader(), ArtifactSaver()],
+    >>> })
+
+    Args:
+        branches (dict): A mapping of a route key to a list of Stages API compatible coroutines.
+            The last stage of a branch must not be an :class:`~pulpcore.plugin.stages.EndStage`.
+        route (callable): A function returning the route key of an item. Defaults to the type of
+            the item's `content`.
+        maxsize (int): The maximum amount of items a queue between two stages of a branch should
+            hold. Defaults to 100.
+        maxweight (int): The maximum total weight of the items a queue between two stages of a
+            branch should hold, as weighed by :func:`~pulpcore.plugin.stages.estimate_size`.
+            Defaults to None, meaning unbounded.
+
+    Raises:
+        ValueError: When a stage instance is specified more than once.
+    """
+
+    def __init__(self, branches, route=None, maxsize=100, maxweight=None):
+        super().__init__()
+        stages = [stage for branch in branches.values() for stage in branch]
+        if len(set(stages)) != len(stages):
+            raise ValueError(_('Each stage instance must be unique.'))
+        self.branches = {key: list(branch) for key, branch in branches.items()}
+        self.route = route or self._content_type
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+
+    @staticmethod
+    def _content_type(d_content):
+        return type(d_content.content)
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+
+        Raises:
+            ValueError: When an item is routed to a key without a branch and there is no default.
+        """
+        join_q = make_queue_like(self._out_q)
+        branch_in_qs = {}
+        futures = []
+        for key, branch in self.branches.items():
+            if not branch:
+                continue
+            in_q = _make_queue(branch[0], 0, self.maxsize, self.maxweight)
+            branch_in_qs[key] = in_q
+            for i, stage in enumerate(branch):
+                if i < len(branch) - 1:
+                    out_q = _make_queue(branch[i + 1], i + 1, self.maxsize, self.maxweight)
+                else:
+                    out_q = join_q
+                stage._connect(in_q, out_q)
+                futures.append(asyncio.ensure_future(stage()))
+                in_q = out_q
+        futures.append(asyncio.ensure_future(self._route(branch_in_qs)))
+        futures.append(asyncio.ensure_future(self._join(join_q, len(branch_in_qs))))
+        try:
+            await asyncio.gather(*futures)
+        finally:
+            for task in futures:
+                if not task.done():
+                    task.cancel()
+
+    async def _route(self, branch_in_qs):
+        """
+        Send each item to its branch, or pass it on if its branch has no stages.
+
+        Args:
+            branch_in_qs (dict): A mapping of a route key to the input queue of its branch.
+        """
+        async for item in self.items():
+            key = self.route(item)
+            if key not in self.branches:
+                if None not in self.branches:
+                    raise ValueError(_('No branch for route key {key}.').format(key=key))
+                key = None
+            in_q = branch_in_qs.get(key)
+            if in_q is None:
+                await self.put(item)
+            else:
+                await in_q.put(item)
+        for in_q in branch_in_qs.values():
+            await in_q.put(None)
+
+    async def _join(self, join_q, branches):
+        """
+        Pass the output of the branches on, until each branch has ended its stream.
+
+        Args:
+            join_q (:class:`asyncio.Queue`): The queue shared by the branches as output.
+            branches (int): The number of branches with stages.
+        """
+        while branches:
+            item = await join_q.get()
+            if item is None:
+                branches -= 1
+            else:
+                await self._pass_on(item)
+
+
+class ProcessPoolStage(Stage):
+    """
+    A Stages API stage that parses chunks of input in a pool of worker processes.
+
+    `parse` is called with each chunk in a :class:`concurrent.futures.ProcessPoolExecutor`, so
+    several chunks are parsed at once on different cores without blocking the event loop. It
+    returns a list of results, each of which is passed on as a
+    :class:`~pulpcore.plugin.stages.DeclarativeContent`. Results that are not
+    :class:`~pulpcore.plugin.stages.DeclarativeContent` already are passed to `to_d_content` in this
+    process, which by default wraps them as the `content` of a new
+    :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+
+    The chunks are taken from `chunks`, or from `self._in_q` if `chunks` is None. Results are
+    passed on in the order of their chunks. At most `max_pending` chunks are submitted to the pool
+    at a time, and no more are submitted while the next stage is not accepting results.
+
+    The worker processes are started with the 'spawn' method, not forked, so they don't inherit the
+    locks held by the other threads of this process. `parse`, the chunks, and the results must be
+    picklable, and `parse` must be a module-level function. Its module is imported again by each
+    worker, so importing it must not require Django to be set up. The worker processes must not use
+    the database. On Python 3.6, the worker processes are forked.
+
+    Example:
+        >>> ProcessPoolStage(parse_primary_xml, ['primary.xml.gz'], to_d_content=make_d_content)
+
+    Args:
+        parse (callable): A picklable function returning a list of results for one chunk.
+        chunks (iterable): The picklable chunks to parse. Defaults to the items of `self._in_q`.
+        to_d_content (callable): A function returning a
+            :class:`~pulpcore.plugin.stages.DeclarativeContent` for one result. Optional.
+        max_workers (int): The number of worker processes. Defaults to the number of CPUs.
+        max_pending (int): The maximum number of chunks submitted at a time. Defaults to twice the
+            number of worker processes.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    def __init__(self, parse, chunks=None, to_d_content=None, max_workers=None, max_pending=None,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parse = parse
+        self.chunks = chunks
+        self.to_d_content = to_d_content or self._wrap_content
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.max_workers
+
+    @staticmethod
+    def _wrap_content(content):
+        return DeclarativeContent(content=content)
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        loop = asyncio.get_event_loop()
+        pending = deque()
+        executor = None
+        try:
+            async for chunk in self._chunks():
+                if executor is None:
+                    executor = self._make_executor()
+                pending.append(loop.run_in_executor(executor, self.parse, chunk))
+                if len(pending) >= self.max_pending:
+                    await self._put_results(await pending.popleft())
+            while pending:
+                await self._put_results(await pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+            if executor is not None:
+                # Chunks being parsed can't be interrupted, so wait for the workers to exit on
+                # another thread. Before Python 3.9, shutdown(wait=False) leaves them running.
+                await loop.run_in_executor(None, executor.shutdown)
+
+    def _make_executor(self):
+        """
+        Return a new pool of worker processes, right before its first chunk is submitted.
+
+        The workers are spawned, as a forked worker could deadlock on a lock held by another
+        thread of this process, such as the thread of a stage querying the database or the writer
+        thread of the profiler.
+
+        Python 3.6 can only fork them. The database connections of this thread are then closed
+        first, unless a transaction is open, so the workers don't inherit them. They are opened
+        again when the event loop next queries the database.
+        """
+        try:
+            return ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        except TypeError:
+            # Python 3.6
+            pass
+        if not connection.in_atomic_block:
+            connections.close_all()
+        return ProcessPoolExecutor(max_workers=self.max_workers)
+
+    async def _chunks(self):
+        """
+        Asynchronous iterator yielding the chunks to parse.
+        """
+        if self.chunks is None:
+            async for chunk in self.items():
+                yield chunk
+        else:
+            for chunk in self.chunks:
+                yield chunk
+
+    async def _put_results(self, results):
+        """
+        Pass the results of one chunk on as :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+
+        Args:
+            results (list): The results `parse` returned for a chunk.
+        """
+        d_contents = []
+        for result in results:
+            if not isinstance(result, DeclarativeContent):
+                result = self.to_d_content(result)
+            d_contents.append(result)
+        await self.put_many(d_contents)
+
+
+def _make_queue(stage, num, maxsize, maxweight=None, weigh=None):
+    """
+    Create the queue feeding `stage`, profiling it if the `PROFILE_STAGES_API` setting is enabled.
+
+    The depth of the queue is reported in the metrics.
+
+    Args:
+        stage (:class:`~pulpcore.plugin.stages.Stage`): The stage the queue feeds.
+        num (int): The number in the pipeline this stage is at.
+        maxsize (int): The maximum amount of items the queue should hold.
+        maxweight (int): The maximum total weight of the items the queue should hold. Optional.
+        weigh (callable): The function weighing the items. Optional.
+
+    Returns:
+        :class:`asyncio.Queue`: The queue feeding `stage`.
+    """
+    if settings.PROFILE_STAGES_API:
+        queue = ProfilingQueue.make_and_record_queue(stage, num, maxsize, maxweight, weigh)
+    else:
+        queue = WeightedQueue(maxsize=maxsize, maxweight=maxweight, weigh=weigh)
+    metrics.track_queue(queue, stage)
+    return queue
+
+
+async def _write_metrics(path, interval):
+    """
+    Write the metrics to the textfile at `path` every `interval` seconds, until cancelled.
+
+    Args:
+        path (str): The path of the textfile.
+        interval (float): The number of seconds between two writes.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            metrics.registry.write_textfile(path)
+        except OSError:
+            log.exception(_('Failed to write the metrics to %(path)s.'), {'path': path})
+
+
+async def create_pipeline(stages, maxsize=100, maxweight=None, weigh=None, queue_options=None):
     """
     A coroutine that builds a Stages API linear pipeline from the list `stages` and runs it.
 
@@ -177,10 +1094,36 @@ async def create_pipeline(stages, maxsize=100):
     >>>         async for d_content in self.items():  # Fetch items from the previous stage
     >>>             await self.put(d_content)  # Hand them over to the next stage
 
+    To run several replicas of a slow stage concurrently, wrap them in a
+    :class:`~pulpcore.plugin.stages.ReplicatedStage`. To send items through different stages
+    depending on their content type, use a :class:`~pulpcore.plugin.stages.RoutingStage`.
+
+    Queues can also be bounded by the estimated memory used by their items, with `maxweight` and a
+    `weigh` function, see :class:`~pulpcore.plugin.stages.WeightedQueue`. The bounds of the queue
+    feeding a particular stage can be overridden with `queue_options`:
+
+    >>> create_pipeline(stages, maxweight=100 * 1024 * 1024,
+    >>>                 queue_options={artifact_downloader: {'maxsize': 0, 'maxweight': 10 ** 9}})
+
     Args:
         stages (list of coroutines): A list of Stages API compatible coroutines.
         maxsize (int): The maximum amount of items a queue between two stages should hold. Optional
             and defaults to 100.
+        maxweight (int): The maximum total weight of the items a queue between two stages should
+            hold. Optional and defaults to None, meaning unbounded.
+        weigh (callable): A function returning the weight of an item. Optional and defaults to
+            :func:`~pulpcore.plugin.stages.estimate_size`, weighing items in estimated bytes.
+        queue_options (dict): A mapping of a stage to a dict overriding any of `maxsize`,
+            `maxweight`, and `weigh` for the queue feeding that stage. Optional.
+
+    If the `TRACE_STAGES_API` setting is set to a share of items between 0 and 1, that share of the
+    :class:`~pulpcore.plugin.stages.DeclarativeContent` created while the pipeline runs is traced,
+    and the trace is written to `/var/lib/pulp/debug/` as Chrome trace-event JSON. See
+    :class:`~pulpcore.plugin.stages.tracing.Tracer`.
+
+    If the `METRICS_TEXTFILE` setting is set, the metrics of :mod:`pulpcore.plugin.metrics` are
+    written to that path every `METRICS_TEXTFILE_INTERVAL` seconds, 15 by default, while the
+    pipeline runs, and once it has finished.
 
     Returns:
         A single coroutine that can be used to run, wait, or cancel the entire pipeline with.
@@ -195,16 +1138,26 @@ async def create_pipeline(stages, maxsize=100):
             raise ValueError(_('Each stage instance must be unique.'))
         history.add(stage)
         if i < len(stages) - 1:
-            if settings.PROFILE_STAGES_API:
-                out_q = ProfilingQueue.make_and_record_queue(stages[i + 1], i + 1, maxsize)
-            else:
-                out_q = asyncio.Queue(maxsize=maxsize)
+            options = {'maxsize': maxsize, 'maxweight': maxweight, 'weigh': weigh}
+            options.update((queue_options or {}).get(stages[i + 1], {}))
+            out_q = _make_queue(stages[i + 1], i + 1, **options)
         else:
             out_q = None
         stage._connect(in_q, out_q)
         futures.append(asyncio.ensure_future(stage()))
         in_q = out_q
 
+    tracing_started = False
+    sample_rate = getattr(settings, 'TRACE_STAGES_API', 0)
+    if sample_rate and tracing.TRACER is None:
+        tracing.start_tracing(sample_rate)
+        tracing_started = True
+    metrics_path = getattr(settings, 'METRICS_TEXTFILE', None)
+    metrics_writer = None
+    if metrics_path:
+        metrics_writer = asyncio.ensure_future(_write_metrics(
+            metrics_path, getattr(settings, 'METRICS_TEXTFILE_INTERVAL', 15)
+        ))
     try:
         await asyncio.gather(*futures)
     except Exception:
@@ -218,6 +1171,18 @@ async def create_pipeline(stages, maxsize=100):
         if pending:
             await asyncio.wait(pending, timeout=60)
         raise
+    finally:
+        if settings.PROFILE_STAGES_API:
+            flush_profile_db()
+        if tracing_started:
+            tracing.stop_tracing()
+        if metrics_writer is not None:
+            metrics_writer.cancel()
+            try:
+                metrics.registry.write_textfile(metrics_path)
+            except OSError:
+                log.exception(_('Failed to write the metrics to %(path)s.'),
+                              {'path': metrics_path})
 
 
 class EndStage(Stage):
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import threading
+import weakref
+
+from django.db.models.signals import post_delete
+
+from pulpcore.plugin.models import Artifact
+
+
+_caches = weakref.WeakSet()
+
+
+class ArtifactCache:
+    """
+    A bounded cache of saved :class:`~pulpcore.plugin.models.Artifact` objects, keyed on digest.
+
+    It serves the lookups of :class:`~pulpcore.plugin.stages.QueryExistingArtifacts` that were
+    already answered by the database, or by the saves of
+    :class:`~pulpcore.plugin.stages.ArtifactSaver`, without a query. When it holds `maxsize`
+    Artifacts, the least recently used one is evicted.
+
+    Deleted Artifacts are removed from every cache of the process when the `post_delete` signal is
+    sent for them. Artifacts deleted by another process, such as an orphan cleanup run by another
+    worker, or without signals, must be removed with :meth:`invalidate` or :meth:`clear`. A cache
+    should therefore not outlive the sync it is made for.
+
+    The cache can be used from several threads at once.
+
+    Attributes:
+        maxsize (int): The maximum number of Artifacts in the cache.
+        hits (int): The number of lookups served by the cache.
+        misses (int): The number of lookups not served by the cache.
+
+    Args:
+        maxsize (int): The maximum number of Artifacts in the cache. Defaults to 10000.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._artifacts = OrderedDict()
+        self._pks = {}
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._artifacts)
+
+    @staticmethod
+    def _lookup_key(artifact):
+        """
+        Return the digest a saved Artifact is looked up with, as done by `Artifact.q()`.
+        """
+        for digest_name in artifact.DIGEST_FIELDS:
+            digest_value = getattr(artifact, digest_name)
+            if digest_value:
+                return (digest_name, digest_value)
+        return None
+
+    def get(self, artifact):
+        """
+        Return the saved Artifact with the digest `artifact` would be looked up with.
+
+        Args:
+            artifact (:class:`~pulpcore.plugin.models.Artifact`): An unsaved Artifact.
+
+        Returns:
+            :class:`~pulpcore.plugin.models.Artifact`: The saved Artifact, or None if it is not in
+            the cache.
+        """
+        key = self._lookup_key(artifact)
+        with self._lock:
+            pk = self._pks.get(key)
+            if pk is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._artifacts.move_to_end(pk)
+            return self._artifacts[pk]
+
+    def add(self, artifacts):
+        """
+        Add saved Artifacts to the cache, evicting the least recently used ones if it is full.
+
+        Args:
+            artifacts (iterable): The saved :class:`~pulpcore.plugin.models.Artifact` objects.
+        """
+        with self._lock:
+            for artifact in artifacts:
+                if artifact.pk in self._artifacts:
+                    self._artifacts.move_to_end(artifact.pk)
+                    continue
+                self._artifacts[artifact.pk] = artifact
+                for digest_name in artifact.DIGEST_FIELDS:
+                    digest_value = getattr(artifact, digest_name)
+                    if digest_value:
+                        self._pks[(digest_name, digest_value)] = artifact.pk
+                while len(self._artifacts) > self.maxsize:
+                    self._remove(next(iter(self._artifacts)))
+
+    def invalidate(self, pks):
+        """
+        Remove the Artifacts with primary keys `pks` from the cache.
+
+        Args:
+            pks (iterable): The primary keys of the Artifacts to remove.
+        """
+        with self._lock:
+            for pk in pks:
+                if pk in self._artifacts:
+                    self._remove(pk)
+
+    def clear(self):
+        """
+        Remove all Artifacts from the cache.
+        """
+        with self._lock:
+            self._artifacts.clear()
+            self._pks.clear()
+
+    def _remove(self, pk):
+        artifact = self._artifacts.pop(pk)
+        for digest_name in artifact.DIGEST_FIELDS:
+            key = (digest_name, getattr(artifact, digest_name))
+            if self._pks.get(key) == pk:
+                del self._pks[key]
+
+
+def _invalidate_deleted_artifact(sender, instance, **kwargs):
+    for cache in list(_caches):
+        cache.invalidate([instance.pk])
+
+
+post_delete.connect(_invalidate_deleted_artifact, sender=Artifact)
@@ -1,12 +1,15 @@
 import asyncio
+from collections import defaultdict
 from gettext import gettext as _
 import logging
 
+from django.conf import settings
 from django.db.models import Q, Prefetch, prefetch_related_objects
 
 from pulpcore.plugin.models import Artifact, ContentArtifact, ProgressBar, RemoteArtifact
 
 from .api import Stage
+from .profiler import record_artifact_cache
 
 log = logging.getLogger(__name__)
 
@@ -31,9 +34,31 @@ class QueryExistingArtifacts(Stage):
     its :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled.
 
     This stage drains all available items from `self._in_q` and batches everything into one large
-    call to the db for efficiency.
+    call to the db for efficiency. The unsaved :class:`~pulpcore.plugin.models.Artifact` objects of
+    a batch are indexed by digest, so each :class:`~pulpcore.plugin.models.Artifact` returned by
+    the db is matched with a single lookup per digest type.
+
+    If `artifact_cache` is given, the unsaved :class:`~pulpcore.plugin.models.Artifact` objects
+    found in it are replaced without a query, and the ones returned by the db are added to it.
+
+    If `bloom_filter` is given, the unsaved :class:`~pulpcore.plugin.models.Artifact` objects with
+    a sha256 digest the filter certainly doesn't contain are not queried.
+
+    Args:
+        artifact_cache (:class:`~pulpcore.plugin.stages.ArtifactCache`): An optional cache of saved
+            :class:`~pulpcore.plugin.models.Artifact` objects. Defaults to None.
+        bloom_filter (:class:`~pulpcore.plugin.stages.ArtifactBloomFilter`): An optional filter of
+            the digests of saved :class:`~pulpcore.plugin.models.Artifact` objects. Defaults to
+            None.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
+    def __init__(self, artifact_cache=None, bloom_filter=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.artifact_cache = artifact_cache
+        self.bloom_filter = bloom_filter
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -42,23 +67,63 @@ class QueryExistingArtifacts(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            all_artifacts_q = Q(pk=None)
-            for d_content in batch:
-                for d_artifact in d_content.d_artifacts:
-                    one_artifact_q = d_artifact.artifact.q()
-                    if one_artifact_q:
-                        all_artifacts_q |= one_artifact_q
-
-            for artifact in Artifact.objects.filter(all_artifacts_q):
-                for d_content in batch:
-                    for d_artifact in d_content.d_artifacts:
-                        for digest_name in artifact.DIGEST_FIELDS:
-                            digest_value = getattr(d_artifact.artifact, digest_name)
-                            if digest_value and digest_value == getattr(artifact, digest_name):
-                                d_artifact.artifact = artifact
-                                break
-            for d_content in batch:
-                await self.put(d_content)
+            await self.run_database(self._query_batch, batch)
+            if settings.PROFILE_STAGES_API and self.artifact_cache is not None:
+                record_artifact_cache(self._in_q, self.artifact_cache)
+            await self.put_many(batch)
+        if self.bloom_filter is not None:
+            log.info(_('Bloom filter: %(checks)d digests checked, %(negatives)d skipped, observed '
+                       'false-positive rate %(rate)s.'),
+                     {'checks': self.bloom_filter.checks,
+                      'negatives': self.bloom_filter.negatives,
+                      'rate': self.bloom_filter.observed_false_positive_rate})
+
+    def _query_batch(self, batch):
+        """
+        Replace the unsaved Artifacts of `batch` with saved ones that have the same digests.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        all_artifacts_q = Q(pk=None)
+        d_artifacts_by_digest = defaultdict(list)
+        filtered = []
+        for d_content in batch:
+            for d_artifact in d_content.d_artifacts:
+                if d_artifact.artifact.pk is not None:
+                    continue
+                one_artifact_q = d_artifact.artifact.q()
+                if not one_artifact_q:
+                    continue
+                if self.artifact_cache is not None:
+                    artifact = self.artifact_cache.get(d_artifact.artifact)
+                    if artifact is not None:
+                        d_artifact.artifact = artifact
+                        continue
+                if self.bloom_filter is not None and d_artifact.artifact.sha256:
+                    if not self.bloom_filter.might_contain(d_artifact.artifact.sha256):
+                        continue
+                    filtered.append(d_artifact)
+                all_artifacts_q |= one_artifact_q
+                for digest_name in d_artifact.artifact.DIGEST_FIELDS:
+                    digest_value = getattr(d_artifact.artifact, digest_name)
+                    if digest_value:
+                        d_artifacts_by_digest[(digest_name, digest_value)].append(d_artifact)
+
+        if d_artifacts_by_digest:
+            artifacts = list(Artifact.objects.filter(all_artifacts_q))
+            for artifact in artifacts:
+                for digest_name in artifact.DIGEST_FIELDS:
+                    digest_value = getattr(artifact, digest_name)
+                    digest_key = (digest_name, digest_value)
+                    for d_artifact in d_artifacts_by_digest.get(digest_key, []):
+                        d_artifact.artifact = artifact
+            if self.artifact_cache is not None:
+                self.artifact_cache.add(artifacts)
+            if filtered:
+                self.bloom_filter.record_false_positives(
+                    sum(1 for d_artifact in filtered if d_artifact.artifact.pk is None)
+                )
 
 
 class ArtifactDownloader(Stage):
@@ -81,17 +146,23 @@ class ArtifactDownloader(Stage):
     This stage drains all available items from `self._in_q` and starts as many downloaders as
     possible (up to `download_concurrency` set on a Remote)
 
+    If `resume_dir` is given, the downloads are kept in it until they are saved, so that the
+    downloads of a failed sync are reused or continued by the next one. See
+    :meth:`~pulpcore.plugin.stages.DeclarativeArtifact.download`.
+
     Args:
         max_concurrent_content (int): The maximum number of
             :class:`~pulpcore.plugin.stages.DeclarativeContent` instances to handle simultaneously.
             Default is 200.
+        resume_dir (str): An optional directory to keep resumable downloads in. Defaults to None.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, max_concurrent_content=200, *args, **kwargs):
+    def __init__(self, max_concurrent_content=200, resume_dir=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_concurrent_content = max_concurrent_content
+        self.resume_dir = resume_dir
 
     async def run(self):
         """
@@ -147,8 +218,11 @@ class ArtifactDownloader(Stage):
         Returns:
             The number of downloads
         """
+        download_kwargs = {}
+        if self.resume_dir:
+            download_kwargs['resume_dir'] = self.resume_dir
         downloaders_for_content = [
-            d_artifact.download() for d_artifact in d_content.d_artifacts
+            d_artifact.download(**download_kwargs) for d_artifact in d_content.d_artifacts
             if d_artifact.artifact.pk is None
         ]
         if downloaders_for_content:
@@ -172,8 +246,25 @@ class ArtifactSaver(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    If `artifact_cache` or `bloom_filter` are given, the saved
+    :class:`~pulpcore.plugin.models.Artifact` objects are added to them.
+
+    Args:
+        artifact_cache (:class:`~pulpcore.plugin.stages.ArtifactCache`): An optional cache of saved
+            :class:`~pulpcore.plugin.models.Artifact` objects. Defaults to None.
+        bloom_filter (:class:`~pulpcore.plugin.stages.ArtifactBloomFilter`): An optional filter of
+            the digests of saved :class:`~pulpcore.plugin.models.Artifact` objects. Defaults to
+            None.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
+    def __init__(self, artifact_cache=None, bloom_filter=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.artifact_cache = artifact_cache
+        self.bloom_filter = bloom_filter
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -190,12 +281,18 @@ class ArtifactSaver(Stage):
                         da_to_save.append(d_artifact)
 
             if da_to_save:
-                for d_artifact, artifact in zip(da_to_save, Artifact.objects.bulk_get_or_create(
-                        d_artifact.artifact for d_artifact in da_to_save)):
+                artifacts = await self.run_database(
+                    Artifact.objects.bulk_get_or_create,
+                    [d_artifact.artifact for d_artifact in da_to_save]
+                )
+                for d_artifact, artifact in zip(da_to_save, artifacts):
                     d_artifact.artifact = artifact
+                if self.artifact_cache is not None:
+                    self.artifact_cache.add(artifacts)
+                if self.bloom_filter is not None:
+                    self.bloom_filter.update(artifact.sha256 for artifact in artifacts)
 
-            for d_content in batch:
-                await self.put(d_content)
+            await self.put_many(batch)
 
 
 class RemoteArtifactSaver(Stage):
@@ -214,9 +311,17 @@ class RemoteArtifactSaver(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            RemoteArtifact.objects.bulk_get_or_create(self._needed_remote_artifacts(batch))
-            for d_content in batch:
-                await self.put(d_content)
+            await self.run_database(self._save_remote_artifacts, batch)
+            await self.put_many(batch)
+
+    def _save_remote_artifacts(self, batch):
+        """
+        Save the :class:`~pulpcore.plugin.models.RemoteArtifact` objects needed by the batch.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        RemoteArtifact.objects.bulk_get_or_create(self._needed_remote_artifacts(batch))
 
     def _needed_remote_artifacts(self, batch):
         """
@@ -1,4 +1,9 @@
-from django.db.models import Q
+from collections import defaultdict
+from itertools import islice
+import uuid
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
 
 from pulpcore.plugin.models import Content, ProgressBar
 
@@ -13,19 +18,33 @@ class ContentAssociation(Stage):
     compute the units already associated but not received from `self._in_q`. These units are passed
     via `self._out_q` to the next stage as a :class:`django.db.models.query.QuerySet`.
 
+    With `use_staging_table`, the primary keys received from `self._in_q` are streamed into a
+    temporary table instead, and the units to unassociate are computed by the database after the
+    last batch. They are passed via `self._out_q` as one
+    :class:`django.db.models.query.QuerySet` per chunk of `staging_chunk_size` units, so the memory
+    used by this stage does not grow with the size of the repository. This mode requires
+    PostgreSQL.
+
     This stage creates a ProgressBar named 'Associating Content' that counts the number of units
     associated. Since it's a stream the total count isn't known until it's finished.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
             stage associates content with.
+        use_staging_table (bool): If True, compute the units to unassociate in the database.
+            Defaults to False.
+        staging_chunk_size (int): The number of units per QuerySet passed to the next stage when
+            `use_staging_table` is True. Defaults to 10000.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, new_version, *args, **kwargs):
+    def __init__(self, new_version, use_staging_table=False, staging_chunk_size=10000, *args,
+                 **kwargs):
         super().__init__(*args, **kwargs)
         self.new_version = new_version
+        self.use_staging_table = use_staging_table
+        self.staging_chunk_size = staging_chunk_size
 
     async def run(self):
         """
@@ -34,8 +53,14 @@ class ContentAssociation(Stage):
         Returns:
             The coroutine for this stage.
         """
+        if self.use_staging_table:
+            await self._run_with_staging_table()
+            return
+
         with ProgressBar(message='Associating Content') as pb:
-            to_delete = set(self.new_version.content.values_list('pk', flat=True))
+            to_delete = await self.run_database(
+                set, self.new_version.content.values_list('pk', flat=True)
+            )
             async for batch in self.batches():
                 to_add = set()
                 for d_content in batch:
@@ -45,31 +70,118 @@ class ContentAssociation(Stage):
                         to_add.add(d_content.content.pk)
 
                 if to_add:
-                    self.new_version.add_content(Content.objects.filter(pk__in=to_add))
+                    await self.run_database(
+                        self.new_version.add_content, Content.objects.filter(pk__in=to_add)
+                    )
                     pb.done = pb.done + len(to_add)
                     pb.save()
 
             if to_delete:
                 await self.put(Content.objects.filter(pk__in=to_delete))
 
+    async def _run_with_staging_table(self):
+        """
+        Associate content while streaming the received primary keys into a temporary table.
+        """
+        table = connection.ops.quote_name(
+            'pulp_content_association_{id}'.format(id=uuid.uuid4().hex)
+        )
+        await self.run_database(self._create_staging_table, table)
+        try:
+            with ProgressBar(message='Associating Content') as pb:
+                async for batch in self.batches():
+                    batch_pks = {d_content.content.pk for d_content in batch}
+                    added = await self.run_database(self._stage_batch, table, batch_pks)
+                    if added:
+                        pb.done = pb.done + added
+                        pb.save()
+
+            staged_pks = RawSQL('SELECT content_id FROM {table}'.format(table=table), [])
+            to_delete = self.new_version.content.exclude(pk__in=staged_pks)
+            pks = to_delete.values_list('pk', flat=True).iterator()
+            chunk = await self.run_database(list, islice(pks, self.staging_chunk_size))
+            while chunk:
+                await self.put(Content.objects.filter(pk__in=chunk))
+                chunk = await self.run_database(list, islice(pks, self.staging_chunk_size))
+        finally:
+            await self.run_database(self._drop_staging_table, table)
+
+    @staticmethod
+    def _create_staging_table(table):
+        """
+        Create the temporary table `table` holding the received primary keys.
+
+        Args:
+            table (str): The quoted name of the table.
+        """
+        pk_type = Content._meta.pk.rel_db_type(connection)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE {table} (content_id {pk_type} PRIMARY KEY)'.format(
+                    table=table, pk_type=pk_type)
+            )
+
+    @staticmethod
+    def _drop_staging_table(table):
+        """
+        Drop the temporary table `table`.
+
+        Args:
+            table (str): The quoted name of the table.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS {table}'.format(table=table))
+
+    def _stage_batch(self, table, batch_pks):
+        """
+        Insert `batch_pks` into `table`, and add the units not yet present to `new_version`.
+
+        Args:
+            table (str): The quoted name of the temporary table.
+            batch_pks (set): The primary keys of the content units of a batch.
+
+        Returns:
+            int: The number of content units added to `new_version`.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} (content_id) VALUES {values} '
+                'ON CONFLICT DO NOTHING'.format(
+                    table=table, values=', '.join(['(%s)'] * len(batch_pks))),
+                list(batch_pks)
+            )
+        present = set(
+            self.new_version.content.filter(pk__in=batch_pks).values_list('pk', flat=True)
+        )
+        to_add = batch_pks - present
+        if to_add:
+            self.new_version.add_content(Content.objects.filter(pk__in=to_add))
+        return len(to_add)
+
 
 class ContentUnassociation(Stage):
     """
     A Stages API stage that unassociates content units from `new_version`.
 
+    Each :class:`django.db.models.query.QuerySet` received from `self._in_q` is unassociated in
+    chunks of at most `chunk_size` units, so no single UPDATE touches an unbounded number of rows.
+
     This stage creates a ProgressBar named 'Un-Associating Content' that counts the number of units
-    un-associated. Since it's a stream the total count isn't known until it's finished.
+    un-associated. Since it's a stream the total count isn't known until it's finished. The count is
+    taken from the size of each chunk and is saved after every chunk.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
             stage unassociates content from.
+        chunk_size (int): The maximum number of units unassociated by one query. Defaults to 1000.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, new_version, *args, **kwargs):
+    def __init__(self, new_version, chunk_size=1000, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.new_version = new_version
+        self.chunk_size = chunk_size
 
     async def run(self):
         """
@@ -80,12 +192,28 @@ class ContentUnassociation(Stage):
         """
         with ProgressBar(message='Un-Associating Content') as pb:
             async for queryset_to_unassociate in self.items():
-                self.new_version.remove_content(queryset_to_unassociate)
-                pb.done = pb.done + queryset_to_unassociate.count()
-                pb.save()
+                pks = queryset_to_unassociate.values_list('pk', flat=True).iterator()
+                chunk = await self.run_database(list, islice(pks, self.chunk_size))
+                while chunk:
+                    pb.done = pb.done + await self.run_database(self._remove_chunk, chunk)
+                    pb.save()
+                    chunk = await self.run_database(list, islice(pks, self.chunk_size))
 
                 await self.put(queryset_to_unassociate)
 
+    def _remove_chunk(self, pks):
+        """
+        Unassociate the content units with primary keys `pks` from `new_version`.
+
+        Args:
+            pks (list): The primary keys of the content units to unassociate.
+
+        Returns:
+            int: The number of content units unassociated.
+        """
+        self.new_version.remove_content(Content.objects.filter(pk__in=pks))
+        return len(pks)
+
 
 class RemoveDuplicates(Stage):
     """
@@ -93,9 +221,18 @@ class RemoveDuplicates(Stage):
 
     This stage is expected to be added by the
     :class:`~pulpcore.plugin.stages.DeclarativeVersion`. See that class for example usage.
+
+    Before handling the first batch, this stage loads an index of the `field_names` values of all
+    `model` units in `new_version`. Each batch is checked against that index, and only the primary
+    keys of the units it replaces are removed from `new_version`, with one call per batch.
+
+    A unit replaced by a later unit of the same sync may not be associated with `new_version` yet
+    when it is removed, so :meth:`remove_superseded` must be called once the
+    :class:`~pulpcore.plugin.stages.ContentAssociation` stage has finished, as
+    :meth:`~pulpcore.plugin.stages.DeclarativeVersion.create` does.
     """
 
-    def __init__(self, new_version, model, field_names):
+    def __init__(self, new_version, model, field_names, *args, **kwargs):
         """
         Args:
             new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
@@ -104,10 +241,16 @@ class RemoveDuplicates(Stage):
                 indicate which content type to operate on.
             field_names (list): List of field names to ensure uniqueness within a repository
                 version.
+            args: unused positional arguments passed along to
+                :class:`~pulpcore.plugin.stages.Stage`.
+            kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         """
+        super().__init__(*args, **kwargs)
         self.new_version = new_version
         self.model = model
         self.field_names = field_names
+        self._pks_by_key = {}
+        self._removed = set()
 
     async def run(self):
         """
@@ -116,18 +259,52 @@ class RemoveDuplicates(Stage):
         Returns:
             The coroutine for this stage.
         """
-        rm_q = Q()
+        attnames = [self.model._meta.get_field(field).attname for field in self.field_names]
+        pks_by_key = self._pks_by_key = await self.run_database(self._load_index, attnames)
         async for batch in self.batches():
+            pks_to_remove = set()
             for d_content in batch:
                 if isinstance(d_content.content, self.model):
-                    unit_q_dict = {field: getattr(d_content.content, field)
-                                   for field in self.field_names}
+                    unit_key = tuple(getattr(d_content.content, attname) for attname in attnames)
                     # Don't remove *this* object if it is already in the repository version.
-                    not_this = ~Q(pk=d_content.content.pk)
-                    dupe = Q(**unit_q_dict)
-                    rm_q |= Q(dupe & not_this)
-            queryset_to_unassociate = self.model.objects.filter(rm_q)
-            self.new_version.remove_content(queryset_to_unassociate)
+                    pks_to_remove |= pks_by_key.get(unit_key, set()) - {d_content.content.pk}
+                    pks_by_key[unit_key] = {d_content.content.pk}
+            if pks_to_remove:
+                self._removed |= pks_to_remove
+                queryset_to_unassociate = self.model.objects.filter(pk__in=pks_to_remove)
+                await self.run_database(self.new_version.remove_content, queryset_to_unassociate)
 
-            for d_content in batch:
-                await self.put(d_content)
+            await self.put_many(batch)
+
+    def remove_superseded(self):
+        """
+        Make the removals of this stage final, once all units of the sync are associated.
+
+        The removed units that were associated after being removed are removed again, and the
+        removed units that came again later in the sync are added back.
+        """
+        latest = set().union(*self._pks_by_key.values())
+        superseded = self._removed - latest
+        if superseded:
+            self.new_version.remove_content(self.model.objects.filter(pk__in=superseded))
+        restored = self._removed & latest
+        if restored:
+            self.new_version.add_content(self.model.objects.filter(pk__in=restored))
+
+    def _load_index(self, attnames):
+        """
+        Load the primary keys of the `model` units in `new_version`, keyed on their field values.
+
+        Args:
+            attnames (list): The attribute names of `field_names` on `model`.
+
+        Returns:
+            dict: A set of primary keys for each tuple of field values present in `new_version`.
+        """
+        pks_by_key = defaultdict(set)
+        rows = self.model.objects.filter(
+            pk__in=self.new_version.content
+        ).values_list('pk', *attnames)
+        for row in rows.iterator():
+            pks_by_key[tuple(row[1:])].add(row[0])
+        return pks_by_key
@@ -0,0 +1,226 @@
+from gettext import gettext as _
+import logging
+import math
+import threading
+import time
+
+from pulpcore.plugin.models import Artifact
+
+
+log = logging.getLogger(__name__)
+
+
+class ArtifactBloomFilter:
+    """
+    A Bloom filter over the sha256 digests of the saved :class:`~pulpcore.plugin.models.Artifact`
+    objects.
+
+    :meth:`might_contain` returns False only for digests that no Artifact added to the filter has,
+    so :class:`~pulpcore.plugin.stages.QueryExistingArtifacts` can skip the db for them. It may
+    return True for a digest no Artifact has, with a probability close to `error_rate` as long as
+    no more than `capacity` digests were added.
+
+    Bloom filters can't forget digests. A deleted Artifact only makes its digest a false positive,
+    which is then queried like any other. An Artifact saved by another process after the filter
+    was built is reported as absent, so it is downloaded again and saved with
+    `bulk_get_or_create()`, which finds the existing Artifact. :func:`shared_artifact_bloom_filter`
+    rebuilds its filter periodically to bound both.
+
+    The digests are random already, so the bit positions are derived from the digest itself,
+    without hashing it again.
+
+    Attributes:
+        capacity (int): The number of digests the filter is sized for.
+        error_rate (float): The false-positive rate the filter is sized for.
+        size (int): The number of bits of the filter.
+        hash_count (int): The number of bits set for each digest.
+        count (int): The number of digests added.
+        build_time (float): The number of seconds :meth:`from_database` took, or None.
+        built_at (float): The value of :func:`time.monotonic` when :meth:`from_database` finished
+            building the filter, or None.
+        checks (int): The number of digests checked with :meth:`might_contain`.
+        negatives (int): The number of checked digests that were certainly absent.
+        false_positives (int): The number of checked digests reported as false positives with
+            :meth:`record_false_positives`.
+
+    Args:
+        capacity (int): The number of digests the filter is sized for.
+        error_rate (float): The false-positive rate the filter is sized for. Defaults to 0.01.
+
+    Raises:
+        ValueError: When `capacity` is not positive, or `error_rate` is not between 0 and 1.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        if capacity < 1:
+            raise ValueError(_('capacity must be positive.'))
+        if not 0 < error_rate < 1:
+            raise ValueError(_('error_rate must be between 0 and 1.'))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self.build_time = None
+        self.built_at = None
+        self.checks = 0
+        self.negatives = 0
+        self.false_positives = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_database(cls, error_rate=0.01, headroom=2.0, min_capacity=100000):
+        """
+        Build a filter holding the sha256 digests of all saved Artifacts.
+
+        The filter is sized for `headroom` times the current number of Artifacts, so it keeps its
+        false-positive rate while the Artifacts saved later are added.
+
+        Args:
+            error_rate (float): The false-positive rate the filter is sized for. Defaults to 0.01.
+            headroom (float): The capacity of the filter relative to the current number of
+                Artifacts. Defaults to 2.0.
+            min_capacity (int): The minimum capacity of the filter. Defaults to 100000.
+
+        Returns:
+            :class:`ArtifactBloomFilter`: The filter.
+        """
+        start = time.monotonic()
+        capacity = max(min_capacity, int(Artifact.objects.count() * headroom))
+        bloom_filter = cls(capacity, error_rate=error_rate)
+        digests = Artifact.objects.values_list('sha256', flat=True)
+        bloom_filter.update(digests.iterator())
+        bloom_filter.built_at = time.monotonic()
+        bloom_filter.build_time = bloom_filter.built_at - start
+        log.info(_('Built a Bloom filter of %(count)d Artifact digests in %(time).2fs, using '
+                   '%(memory)d bytes, with an estimated false-positive rate of %(rate).4f.'),
+                 {'count': bloom_filter.count, 'time': bloom_filter.build_time,
+                  'memory': bloom_filter.memory_size, 'rate': bloom_filter.false_positive_rate})
+        return bloom_filter
+
+    @property
+    def memory_size(self):
+        """
+        The number of bytes used by the bits of the filter.
+        """
+        return len(self._bits)
+
+    @property
+    def false_positive_rate(self):
+        """
+        The false-positive rate estimated from the number of digests added.
+        """
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    def is_stale(self, max_age):
+        """
+        Return whether the filter should be rebuilt from the database.
+
+        It should be once it is older than `max_age` seconds, as it misses the Artifacts saved by
+        other processes since, or once more than `capacity` digests were added, as its
+        false-positive rate then grows past `error_rate`.
+
+        Args:
+            max_age (float): The maximum age in seconds of a filter built by :meth:`from_database`.
+
+        Returns:
+            bool: True if the filter should be rebuilt.
+        """
+        if self.count > self.capacity:
+            return True
+        return self.built_at is not None and time.monotonic() - self.built_at > max_age
+
+    @property
+    def observed_false_positive_rate(self):
+        """
+        The share of the checked digests absent from the db that were not filtered out, or None.
+        """
+        absent = self.negatives + self.false_positives
+        if not absent:
+            return None
+        return self.false_positives / absent
+
+    def _positions(self, digest):
+        first = int(digest[:16], 16)
+        second = int(digest[16:32], 16) | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, digest):
+        """
+        Add a sha256 hex digest to the filter.
+
+        Args:
+            digest (str): The digest to add.
+        """
+        with self._lock:
+            for position in self._positions(digest):
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def update(self, digests):
+        """
+        Add sha256 hex digests to the filter.
+
+        Args:
+            digests (iterable): The digests to add. Empty digests are skipped.
+        """
+        for digest in digests:
+            if digest:
+                self.add(digest)
+
+    def might_contain(self, digest):
+        """
+        Return whether an Artifact added to the filter may have the sha256 hex digest `digest`.
+
+        Args:
+            digest (str): The digest to check.
+
+        Returns:
+            bool: False if no Artifact added to the filter has `digest`.
+        """
+        bits = self._bits
+        found = all(bits[position >> 3] & (1 << (position & 7))
+                    for position in self._positions(digest))
+        with self._lock:
+            self.checks += 1
+            if not found:
+                self.negatives += 1
+        return found
+
+    def record_false_positives(self, count):
+        """
+        Record that `count` digests the filter might contain were not found in the db.
+
+        Args:
+            count (int): The number of false positives.
+        """
+        with self._lock:
+            self.false_positives += count
+
+
+_shared_artifact_bloom_filter = None
+_shared_lock = threading.Lock()
+
+
+def shared_artifact_bloom_filter(max_age=3600):
+    """
+    Return the :class:`ArtifactBloomFilter` shared by the syncs of this process.
+
+    It is built with :meth:`ArtifactBloomFilter.from_database` on the first call, and built again
+    when it is stale, see :meth:`ArtifactBloomFilter.is_stale`. The syncs already using the
+    previous filter keep it until they finish.
+
+    Args:
+        max_age (float): The number of seconds after which the filter is built again. Defaults to
+            3600.
+
+    Returns:
+        :class:`ArtifactBloomFilter`: The filter.
+    """
+    global _shared_artifact_bloom_filter
+    with _shared_lock:
+        bloom_filter = _shared_artifact_bloom_filter
+        if bloom_filter is None or bloom_filter.is_stale(max_age):
+            _shared_artifact_bloom_filter = ArtifactBloomFilter.from_database()
+        return _shared_artifact_bloom_filter
@@ -3,7 +3,7 @@ from collections import defaultdict
 from django.db import IntegrityError, transaction
 from django.db.models import Q
 
-from pulpcore.plugin.models import ContentArtifact
+from pulpcore.plugin.models import ContentArtifact, bulk_create_content
 
 from .api import Stage
 
@@ -26,7 +26,9 @@ class QueryExistingContents(Stage):
     been handled.
 
     This stage drains all available items from `self._in_q` and batches everything into one large
-    call to the db for efficiency.
+    call to the db for efficiency. The batch is bucketed by content type and natural key, so each
+    Content unit returned by the db resolves all of its in-flight
+    :class:`~pulpcore.plugin.stages.DeclarativeContent` objects with a single lookup.
     """
 
     async def run(self):
@@ -37,28 +39,32 @@ class QueryExistingContents(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            content_q_by_type = defaultdict(lambda: Q(pk=None))
-            for d_content in batch:
-                model_type = type(d_content.content)
-                unit_q = d_content.content.q()
-                content_q_by_type[model_type] = content_q_by_type[model_type] | unit_q
-
-            for model_type in content_q_by_type.keys():
-                for result in model_type.objects.filter(content_q_by_type[model_type]):
-                    for d_content in batch:
-                        if type(d_content.content) is not model_type:
-                            continue
-                        not_same_unit = False
-                        for field in result.natural_key_fields():
-                            in_memory_digest_value = getattr(d_content.content, field)
-                            if in_memory_digest_value != getattr(result, field):
-                                not_same_unit = True
-                                break
-                        if not_same_unit:
-                            continue
-                        d_content.content = result
-            for d_content in batch:
-                await self.put(d_content)
+            await self.run_database(self._query_batch, batch)
+            await self.put_many(batch)
+
+    def _query_batch(self, batch):
+        """
+        Replace the unsaved Content units of `batch` with saved ones that have the same natural key.
+
+        Args:
+            batch (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+        """
+        content_q_by_type = defaultdict(lambda: Q(pk=None))
+        d_contents_by_key = defaultdict(list)
+        for d_content in batch:
+            if d_content.content.pk is not None:
+                continue
+            model_type = type(d_content.content)
+            unit_q = d_content.content.q()
+            content_q_by_type[model_type] = content_q_by_type[model_type] | unit_q
+            unit_key = (model_type, d_content.content.natural_key())
+            d_contents_by_key[unit_key].append(d_content)
+
+        for model_type in content_q_by_type.keys():
+            for result in model_type.objects.filter(content_q_by_type[model_type]):
+                unit_key = (model_type, result.natural_key())
+                for d_content in d_contents_by_key.get(unit_key, []):
+                    d_content.content = result
 
 
 class ContentSaver(Stage):
@@ -78,8 +84,30 @@ class ContentSaver(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    By default each unsaved Content unit is saved in its own savepoint, and a unit that already
+    exists is fetched with a separate query. In bulk mode the unsaved units of a batch are grouped
+    by model and de-duplicated by natural key. Each group is inserted with
+    :meth:`_bulk_insert`, which skips units conflicting with existing rows, and the conflicting
+    natural keys are then re-queried with one query per model. A conflicting unit the re-query
+    didn't return is fetched with a separate query, which raises `DoesNotExist` if it conflicted
+    on a constraint other than its natural key. Bulk mode does not call `save()` on the Content
+    units.
+
+    If `database_thread` is set, each batch is saved in a transaction on the database thread of
+    this stage. :meth:`_pre_save` and :meth:`_post_save` still run on the event loop of the
+    pipeline, before and after that transaction, so they are not part of it.
+
+    Args:
+        bulk (bool): If True, save Content units in bulk. Defaults to False.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
+    def __init__(self, bulk=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bulk = bulk
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -88,36 +116,151 @@ class ContentSaver(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            content_artifact_bulk = []
-            with transaction.atomic():
+            if self.database_thread:
                 await self._pre_save(batch)
-                for d_content in batch:
-                    if d_content.content.pk is None:
-                        try:
-                            with transaction.atomic():
-                                d_content.content.save()
-                        except IntegrityError:
-                            d_content.content = \
-                                d_content.content.__class__.objects.get(
-                                    d_content.content.q())
-                            continue
-                        for d_artifact in d_content.d_artifacts:
-                            content_artifact = ContentArtifact(
-                                content=d_content.content,
-                                artifact=d_artifact.artifact,
-                                relative_path=d_artifact.relative_path
-                            )
-                            content_artifact_bulk.append(content_artifact)
-                ContentArtifact.objects.bulk_get_or_create(content_artifact_bulk)
+                await self.run_database(self._save_batch_atomically, batch)
                 await self._post_save(batch)
-            for declarative_content in batch:
-                await self.put(declarative_content)
+            else:
+                with transaction.atomic():
+                    await self._pre_save(batch)
+                    self._save_batch(batch)
+                    await self._post_save(batch)
+            await self.put_many(batch)
+
+    def _save_batch_atomically(self, batch):
+        """
+        Save `batch` with :meth:`_save_batch` in a transaction.
+
+        Args:
+            batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
+        """
+        with transaction.atomic():
+            self._save_batch(batch)
+
+    def _save_batch(self, batch):
+        """
+        Save the unsaved Content units of `batch` and the ContentArtifacts of the new ones.
+
+        Args:
+            batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
+        """
+        if self.bulk:
+            d_contents_saved = self._bulk_save_contents(batch)
+        else:
+            d_contents_saved = self._save_contents(batch)
+        content_artifact_bulk = []
+        for d_content in d_contents_saved:
+            for d_artifact in d_content.d_artifacts:
+                content_artifact = ContentArtifact(
+                    content=d_content.content,
+                    artifact=d_artifact.artifact,
+                    relative_path=d_artifact.relative_path
+                )
+                content_artifact_bulk.append(content_artifact)
+        ContentArtifact.objects.bulk_get_or_create(content_artifact_bulk)
+
+    def _save_contents(self, batch):
+        """
+        Save the unsaved Content units of `batch` one by one.
+
+        Args:
+            batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
+
+        Returns:
+            list: The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects whose Content
+                unit was newly created.
+        """
+        d_contents_saved = []
+        for d_content in batch:
+            if d_content.content.pk is None:
+                try:
+                    with transaction.atomic():
+                        d_content.content.save()
+                except IntegrityError:
+                    d_content.content = \
+                        d_content.content.__class__.objects.get(
+                            d_content.content.q())
+                    continue
+                d_contents_saved.append(d_content)
+        return d_contents_saved
+
+    def _bulk_save_contents(self, batch):
+        """
+        Save the unsaved Content units of `batch` in bulk, grouped by model.
+
+        In-flight :class:`~pulpcore.plugin.stages.DeclarativeContent` objects sharing a natural key
+        are resolved to the same Content unit.
+
+        Args:
+            batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
+
+        Returns:
+            list: The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects whose Content
+                unit was newly created.
+        """
+        d_contents_by_key_by_type = defaultdict(lambda: defaultdict(list))
+        for d_content in batch:
+            if d_content.content.pk is None:
+                model_type = type(d_content.content)
+                unit_key = d_content.content.natural_key()
+                d_contents_by_key_by_type[model_type][unit_key].append(d_content)
+
+        d_contents_saved = []
+        for model_type, d_contents_by_key in d_contents_by_key_by_type.items():
+            units_by_key = {
+                unit_key: d_contents[0].content
+                for unit_key, d_contents in d_contents_by_key.items()
+            }
+            inserted = self._bulk_insert(model_type, list(units_by_key.values()))
+            inserted_ids = {id(unit) for unit in inserted}
+
+            if len(inserted) < len(units_by_key):
+                conflicts_q = Q(pk=None)
+                for unit in units_by_key.values():
+                    if unit.pk is None:
+                        conflicts_q |= unit.q()
+                for result in model_type.objects.filter(conflicts_q):
+                    units_by_key[result.natural_key()] = result
+                for unit_key, unit in units_by_key.items():
+                    if unit.pk is None:
+                        # the natural key of the result didn't match the one of the unit
+                        units_by_key[unit_key] = model_type.objects.get(unit.q())
+
+            for unit_key, d_contents in d_contents_by_key.items():
+                unit = units_by_key[unit_key]
+                for d_content in d_contents:
+                    d_content.content = unit
+                if id(unit) in inserted_ids:
+                    d_contents_saved.append(d_contents[0])
+        return d_contents_saved
+
+    def _bulk_insert(self, model_type, units):
+        """
+        Insert unsaved Content units of one model, skipping units that conflict with existing rows.
+
+        Plugin-writers can override this to customize how a group of units is inserted. The default
+        uses :func:`~pulpcore.plugin.models.bulk_create_content`, so `save()` is not called on the
+        units.
+
+        Args:
+            model_type (type): The Content model all `units` are instances of.
+            units (list): Unsaved instances of `model_type` with distinct natural keys.
+
+        Returns:
+            list: The units that were inserted. Units not in this list have their `pk` unset.
+        """
+        return bulk_create_content(units, ignore_conflicts=True)
 
     async def _pre_save(self, batch):
         """
         A hook plugin-writers can override to save related objects prior to content unit saving.
 
-        This is run within the same transaction as the content unit saving.
+        This is run within the same transaction as the content unit saving, unless
+        `database_thread` is set.
 
         Args:
             batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
@@ -130,7 +273,8 @@ class ContentSaver(Stage):
         """
         A hook plugin-writers can override to save related objects after content unit saving.
 
-        This is run within the same transaction as the content unit saving.
+        This is run within the same transaction as the content unit saving, unless
+        `database_thread` is set.
 
         Args:
             batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
@@ -1,9 +1,18 @@
 import asyncio
+from gettext import gettext as _
+import json
+import logging
+import os
+import shutil
+
+from django.conf import settings
 
 from pulpcore.plugin.models import RepositoryVersion
 from pulpcore.plugin.tasking import WorkingDirectory
 
-from .api import create_pipeline, EndStage
+from .api import create_pipeline, EndStage, RoutingStage
+from .artifact_cache import ArtifactCache
+from .bloom_filter import shared_artifact_bloom_filter
 from .artifact_stages import (
     ArtifactDownloader,
     ArtifactSaver,
@@ -14,8 +23,55 @@ from .association_stages import ContentAssociation, ContentUnassociation, Remove
 from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures
 
 
+log = logging.getLogger(__name__)
+
+
+def _content_is_saved(d_content):
+    """
+    Route a :class:`~pulpcore.plugin.stages.DeclarativeContent` on whether its Content is saved.
+    """
+    return d_content.content.pk is not None
+
+
 class DeclarativeVersion:
 
+    #: (int): The maximum batch size of the stages querying the database.
+    batch_maxsize = 500
+
+    #: (float): The maximum number of seconds the stages querying the database wait for a batch.
+    batch_max_wait = 1.0
+
+    #: (bool): Whether the stages querying the database do so on threads of their own.
+    database_threads = False
+
+    #: (bool): Whether the ContentAssociation stage computes the units to unassociate in a
+    #: temporary table of the database instead of in memory. This requires PostgreSQL.
+    use_staging_table = False
+
+    #: (int): The maximum estimated size in bytes of the items queued between two stages, in
+    #: addition to the default maximum of 100 items. None means no size limit.
+    queue_maxweight = None
+
+    #: (bool): Whether the downloads of a failed sync are kept, to be reused or continued by the
+    #: next sync of the same repository.
+    resume_downloads = False
+
+    #: (bool): Whether Content units already in Pulp are looked up before the Artifact stages, so
+    #: only new Content units are routed through them. The Artifacts of Content units already in
+    #: Pulp are then neither looked up nor downloaded, even if they were never downloaded before.
+    content_first = False
+
+    #: (bool): Whether the QueryExistingArtifacts and ArtifactSaver stages share an
+    #: :class:`~pulpcore.plugin.stages.ArtifactCache` of saved Artifacts. A new cache is made for
+    #: each sync, as a cache does not see the Artifacts deleted by other processes.
+    use_artifact_cache = False
+
+    #: (bool): Whether the Artifacts whose sha256 digest is certainly absent from the
+    #: :class:`~pulpcore.plugin.stages.ArtifactBloomFilter` shared by the syncs of this process are
+    #: not queried. The filter is built by the first sync using it, and built again by the first
+    #: sync using it once it is an hour old or holds more digests than it is sized for.
+    use_bloom_filter = False
+
     def __init__(self, first_stage, repository, mirror=True, download_artifacts=True,
                  remove_duplicates=None):
         """
@@ -139,6 +195,15 @@ class DeclarativeVersion:
         can be achieved by returning a list with different stages or by extending
         the list returned by this method.
 
+        The batches of the stages querying the database are bounded by `batch_maxsize` and
+        `batch_max_wait`. If `database_threads` is True, these stages query the database on
+        threads of their own. If `resume_downloads` is True, the Artifacts are downloaded into the
+        directory returned by :meth:`resume_dir`.
+
+        If `content_first` is True, :class:`~pulpcore.plugin.stages.QueryExistingContents` runs
+        before the Artifact stages, and a :class:`~pulpcore.plugin.stages.RoutingStage` sends only
+        the Content units not yet in Pulp through them.
+
         Args:
             new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The
                 new repository version that is going to be built.
@@ -147,35 +212,171 @@ class DeclarativeVersion:
             list: List of :class:`~pulpcore.plugin.stages.Stage` instances
 
         """
+        batch_kwargs = {
+            'batch_maxsize': self.batch_maxsize,
+            'batch_max_wait': self.batch_max_wait,
+            'database_thread': self.database_threads,
+        }
         pipeline = [self.first_stage]
         if self.download_artifacts:
-            pipeline.extend([
-                QueryExistingArtifacts(),
-                ArtifactDownloader(),
-                ArtifactSaver(),
-            ])
+            resume_dir = None
+            if self.resume_downloads:
+                resume_dir = self.resume_dir()
+                os.makedirs(resume_dir, exist_ok=True)
+            artifact_cache = ArtifactCache() if self.use_artifact_cache else None
+            artifact_kwargs = {'artifact_cache': artifact_cache}
+            if self.use_bloom_filter:
+                artifact_kwargs['bloom_filter'] = shared_artifact_bloom_filter()
+            artifact_stages = [
+                QueryExistingArtifacts(**artifact_kwargs, **batch_kwargs),
+                ArtifactDownloader(resume_dir=resume_dir),
+                ArtifactSaver(**artifact_kwargs, **batch_kwargs),
+            ]
+            if self.content_first:
+                pipeline.extend([
+                    QueryExistingContents(**batch_kwargs),
+                    RoutingStage(
+                        {True: [], False: artifact_stages},
+                        route=_content_is_saved,
+                        maxweight=self.queue_maxweight,
+                    ),
+                ])
+            else:
+                pipeline.extend(artifact_stages)
+                pipeline.append(QueryExistingContents(**batch_kwargs))
+        else:
+            pipeline.append(QueryExistingContents(**batch_kwargs))
         pipeline.extend([
-            QueryExistingContents(),
-            ContentSaver(),
-            RemoteArtifactSaver(),
+            ContentSaver(**batch_kwargs),
+            RemoteArtifactSaver(**batch_kwargs),
             ResolveContentFutures(),
         ])
         for dupe_query_dict in self.remove_duplicates:
-            pipeline.extend([RemoveDuplicates(new_version, **dupe_query_dict)])
+            pipeline.append(RemoveDuplicates(new_version, **dupe_query_dict, **batch_kwargs))
 
         return pipeline
 
+    def resume_dir(self):
+        """
+        Return the directory keeping the downloads of `repository` between syncs.
+
+        It is outside of the working directory of the task, which is removed when the task ends.
+        Its content is removed once a sync completes.
+
+        Returns:
+            str: The path of the directory.
+        """
+        return os.path.join(settings.WORKING_DIRECTORY, 'resume', str(self.repository.pk))
+
     def create(self):
         """
         Perform the work. This is the long-blocking call where all syncing occurs.
+
+        If the first stage declares a fingerprint of the upstream metadata with
+        :meth:`~pulpcore.plugin.stages.Stage.fingerprint`, and the last sync of the repository
+        recorded the same fingerprint with the same options and remote and created its latest
+        version, no new version is created and the pipeline is not run.
+
+        If `resume_downloads` is True and the sync fails, the Artifacts already saved and the
+        Content units already created are found again by the next sync, which also reuses the files
+        downloaded but not yet saved, and continues the partial downloads.
         """
         with WorkingDirectory():
+            loop = asyncio.get_event_loop()
+            fingerprint = loop.run_until_complete(self.first_stage.fingerprint())
+            if fingerprint is not None and self._is_unchanged(fingerprint):
+                log.info(_('Upstream metadata of repository %(repository)s is unchanged, '
+                           'skipping the sync.'), {'repository': self.repository.pk})
+                return
             with RepositoryVersion.create(self.repository) as new_version:
-                loop = asyncio.get_event_loop()
                 stages = self.pipeline_stages(new_version)
-                stages.append(ContentAssociation(new_version))
+                database_kwargs = {'database_thread': self.database_threads}
+                stages.append(ContentAssociation(
+                    new_version, use_staging_table=self.use_staging_table, **database_kwargs
+                ))
                 if self.mirror:
-                    stages.append(ContentUnassociation(new_version))
+                    stages.append(ContentUnassociation(new_version, **database_kwargs))
                 stages.append(EndStage())
-                pipeline = create_pipeline(stages)
+                pipeline = create_pipeline(stages, maxweight=self.queue_maxweight)
                 loop.run_until_complete(pipeline)
+                for stage in stages:
+                    if isinstance(stage, RemoveDuplicates):
+                        stage.remove_superseded()
+            if fingerprint is not None:
+                self._record_fingerprint(fingerprint, new_version)
+        if self.resume_downloads:
+            shutil.rmtree(self.resume_dir(), ignore_errors=True)
+
+    def fingerprint_path(self):
+        """
+        Return the path of the file recording the upstream fingerprint of the last sync.
+
+        Returns:
+            str: The path of the file.
+        """
+        return os.path.join(
+            settings.WORKING_DIRECTORY, 'fingerprints', '{pk}.json'.format(pk=self.repository.pk)
+        )
+
+    def _fingerprint_record(self, fingerprint):
+        """
+        Return the record of a sync of the upstream metadata fingerprinted `fingerprint`.
+
+        The options changing the content of the new version are part of the record, and so is the
+        `remote` of the first stage, if it has one, as plugins keep the remote they sync from there.
+        """
+        remote = getattr(self.first_stage, 'remote', None)
+        return {
+            'fingerprint': fingerprint,
+            'mirror': self.mirror,
+            'download_artifacts': self.download_artifacts,
+            'remove_duplicates': [
+                {'model': dupe_query_dict['model']._meta.label,
+                 'field_names': list(dupe_query_dict['field_names'])}
+                for dupe_query_dict in self.remove_duplicates
+            ],
+            'remote': None if remote is None else {
+                'pk': str(remote.pk),
+                'url': remote.url,
+            },
+        }
+
+    def _is_unchanged(self, fingerprint):
+        """
+        Return whether the last sync recorded `fingerprint` and created the latest version.
+
+        Args:
+            fingerprint (str): The fingerprint declared by the first stage.
+
+        Returns:
+            bool: True if the sync can be skipped.
+        """
+        try:
+            with open(self.fingerprint_path()) as record_file:
+                record = json.load(record_file)
+        except (OSError, ValueError):
+            return False
+        version = record.pop('version', None)
+        if record != self._fingerprint_record(fingerprint):
+            return False
+        latest = RepositoryVersion.objects.filter(
+            repository=self.repository, complete=True
+        ).order_by('-number').first()
+        return latest is not None and latest.number == version
+
+    def _record_fingerprint(self, fingerprint, new_version):
+        """
+        Record that `new_version` was synced from the upstream metadata fingerprinted `fingerprint`.
+
+        Args:
+            fingerprint (str): The fingerprint declared by the first stage.
+            new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The version created
+                by the sync.
+        """
+        record = self._fingerprint_record(fingerprint)
+        record['version'] = new_version.number
+        path = self.fingerprint_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as record_file:
+            json.dump(record, record_file)
+        os.replace(path + '.tmp', path)
@@ -1,9 +1,14 @@
 from gettext import gettext as _
 
 import asyncio
+import hashlib
+import os
+import time
 
 from pulpcore.plugin.models import Artifact
 
+from . import tracing
+
 
 class DeclarativeArtifact:
     """
@@ -26,12 +31,15 @@ class DeclarativeArtifact:
         remote (:class:`~pulpcore.plugin.models.Remote`): The remote used to fetch this
             :class:`~pulpcore.plugin.models.Artifact`.
         extra_data (dict): A dictionary available for additional data to be stored in.
+        trace (:class:`~pulpcore.plugin.stages.tracing.TraceContext`): The trace of the
+            :class:`~pulpcore.plugin.stages.DeclarativeContent` of this Artifact, if it is sampled
+            for tracing, otherwise None.
 
     Raises:
         ValueError: If `artifact`, `url`, `relative_path`, or `remote` are not specified.
     """
 
-    __slots__ = ('artifact', 'url', 'relative_path', 'remote', 'extra_data')
+    __slots__ = ('artifact', 'url', 'relative_path', 'remote', 'extra_data', 'trace')
 
     def __init__(self, artifact=None, url=None, relative_path=None, remote=None, extra_data=None):
         if not url:
@@ -47,11 +55,21 @@ class DeclarativeArtifact:
         self.relative_path = relative_path
         self.remote = remote
         self.extra_data = extra_data or {}
+        self.trace = None
 
-    async def download(self):
+    async def download(self, resume_dir=None):
         """
         Download content and update the associated Artifact.
 
+        If `resume_dir` is given and the Artifact has expected digests, the download is kept in
+        `resume_dir` under a name derived from the url and the expected digests. A download
+        interrupted by a failed sync is then reused or continued by the next sync.
+
+        If the Artifact is traced, the download is recorded as a span of its trace.
+
+        Args:
+            resume_dir (str): An optional directory to keep resumable downloads in.
+
         Returns:
             Returns the :class:`~pulpcore.plugin.download.DownloadResult` of the Artifact.
         """
@@ -66,18 +84,43 @@ class DeclarativeArtifact:
         if self.artifact.size:
             expected_size = self.artifact.size
             validation_kwargs['expected_size'] = expected_size
+        if resume_dir and expected_digests:
+            validation_kwargs['resume_path'] = os.path.join(
+                resume_dir, self._resume_name(expected_digests)
+            )
         downloader = self.remote.get_downloader(
             url=self.url,
             **validation_kwargs
         )
+        started_at = time.monotonic()
         # Custom downloaders may need extra information to complete the request.
         download_result = await downloader.run(extra_data=self.extra_data)
+        if self.trace is not None and tracing.TRACER is not None:
+            tracing.TRACER.record(
+                self.trace, 'download', started_at, time.monotonic(), category='download',
+                args={'url': self.url, 'size': download_result.artifact_attributes.get('size')}
+            )
         self.artifact = Artifact(
             **download_result.artifact_attributes,
             file=download_result.path
         )
         return download_result
 
+    def _resume_name(self, expected_digests):
+        """
+        Return the file name of the resumable download of this Artifact.
+
+        Args:
+            expected_digests (dict): The expected digests of the Artifact.
+
+        Returns:
+            str: A name unique to `url` and `expected_digests`.
+        """
+        key = hashlib.sha256(self.url.encode())
+        for digest_name, digest_value in sorted(expected_digests.items()):
+            key.update('{name}:{value}'.format(name=digest_name, value=digest_value).encode())
+        return key.hexdigest()
+
 
 class DeclarativeContent:
     """
@@ -101,12 +144,15 @@ class DeclarativeContent:
             :class:`~pulpcore.plugin.models.Content` in the
             :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage. See the
             :class:`~pulpcore.plugin.stages.ResolveContentFutures` stage for example usage.
+        trace (:class:`~pulpcore.plugin.stages.tracing.TraceContext`): The trace of this item if
+            it is sampled for tracing, otherwise None. Its
+            :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects share it.
 
     Raises:
         ValueError: If `content` is not specified.
     """
 
-    __slots__ = ('content', 'd_artifacts', 'extra_data', 'does_batch', 'future')
+    __slots__ = ('content', 'd_artifacts', 'extra_data', 'does_batch', 'future', 'trace')
 
     def __init__(self, content=None, d_artifacts=None, extra_data=None, does_batch=True):
         if not content:
@@ -116,6 +162,10 @@ class DeclarativeContent:
         self.extra_data = extra_data or {}
         self.does_batch = does_batch
         self.future = None
+        self.trace = tracing.start_trace(self)
+        if self.trace is not None:
+            for d_artifact in self.d_artifacts:
+                d_artifact.trace = self.trace
 
     def get_or_create_future(self):
         """
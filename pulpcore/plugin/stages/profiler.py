@@ -1,5 +1,7 @@
-from asyncio import Queue
+import asyncio
+from collections import deque
 import pathlib
+import threading
 import time
 import uuid
 
@@ -7,14 +9,158 @@ from rq.job import get_current_job
 
 from pulpcore.tasking import connection
 
+from .queues import WeightedQueue
+
 
 CONN = None
 
+WRITER = None
+
+#: (dict): The parameterized INSERT statement of each table of the profile db.
+INSERTS = {
+    'stages': 'INSERT INTO stages (uuid, name, num) VALUES (?, ?, ?)',
+    'traffic': 'INSERT INTO traffic (uuid, waiting_time, service_time) VALUES (?, ?, ?)',
+    'system': 'INSERT INTO system (uuid, length, interarrival_time) VALUES (?, ?, ?)',
+    'batch_sizes': 'INSERT INTO batch_sizes (uuid, size, target_size, service_time) '
+                   'VALUES (?, ?, ?, ?)',
+    'artifact_cache': 'INSERT INTO artifact_cache (uuid, hits, misses, size) VALUES (?, ?, ?, ?)',
+    'batch_queries': 'INSERT INTO batch_queries (uuid, size, queries, db_time, service_time) '
+                     'VALUES (?, ?, ?, ?, ?)',
+}
+
+#: (str): The statement recording the number of rows of a table dropped by the profiler.
+DROPPED_ROWS_INSERT = 'INSERT OR REPLACE INTO dropped_rows (name, count) VALUES (?, ?)'
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:
+    # Python 3.6
+    _current_task = asyncio.Task.current_task
+
+
+class ProfileWriter:
+    """
+    Buffers the rows recorded by the profiler and writes them to the profile db from a thread.
+
+    Recording a row only appends it to the in-memory ring buffer of its table, so the event loop
+    never waits for sqlite. A daemon thread writes the buffered rows every `interval` seconds with
+    one parameterized `executemany()` per table and a single commit. If a buffer fills up before it
+    is written, its oldest rows are overwritten. The overwritten rows are counted in `dropped`,
+    which is written to the `dropped_rows` table of the profile db, so reports can tell their
+    samples are incomplete.
+
+    Attributes:
+        dropped (dict): The number of rows overwritten before being written, per table.
 
-class ProfilingQueue(Queue):
+    Args:
+        conn (sqlite3.Connection): The connection to the profile db. It must allow being used from
+            other threads.
+        interval (float): The number of seconds between two writes. Defaults to 0.5.
+        buffer_size (int): The maximum number of rows buffered per table. Defaults to 100000.
+    """
+
+    def __init__(self, conn, interval=0.5, buffer_size=100000):
+        self.conn = conn
+        self.interval = interval
+        self._buffers = {table: deque(maxlen=buffer_size) for table in INSERTS}
+        self.dropped = dict.fromkeys(INSERTS, 0)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-writer', daemon=True)
+        self._thread.start()
+
+    def record(self, table, row):
+        """
+        Buffer a row to be written to `table`.
+
+        Args:
+            table (str): The name of the table.
+            row (tuple): The values of the row, in the order of :data:`INSERTS`.
+        """
+        buffer = self._buffers[table]
+        if len(buffer) == buffer.maxlen:
+            self.dropped[table] += 1
+        buffer.append(row)
+
+    def recorder(self, table):
+        """
+        Return a function buffering a row to be written to `table`, for the hottest code paths.
+
+        Args:
+            table (str): The name of the table.
+
+        Returns:
+            callable: A function taking the row as a tuple.
+        """
+        buffer = self._buffers[table]
+        append = buffer.append
+        maxlen = buffer.maxlen
+        dropped = self.dropped
+
+        def record(row):
+            if len(buffer) == maxlen:
+                dropped[table] += 1
+            append(row)
+
+        return record
+
+    def flush(self):
+        """
+        Write all buffered rows to the profile db.
+        """
+        with self._lock:
+            for table, buffer in self._buffers.items():
+                rows = [buffer.popleft() for _ in range(len(buffer))]
+                if rows:
+                    self.conn.executemany(INSERTS[table], rows)
+            dropped = [(table, count) for table, count in self.dropped.items() if count]
+            if dropped:
+                self.conn.executemany(DROPPED_ROWS_INSERT, dropped)
+            self.conn.commit()
+
+    def close(self):
+        """
+        Stop the writing thread and write the remaining buffered rows.
+        """
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+
+def flush_profile_db():
+    """
+    Write all rows buffered by the profiler to the profile db, if there is one.
+    """
+    if WRITER is not None:
+        WRITER.flush()
+
+
+def close_profile_db():
+    """
+    Write the rows buffered by the profiler, and close the profile db, if there is one.
+
+    The next profiled pipeline creates a new profile db.
+    """
+    global CONN, WRITER
+    if WRITER is not None:
+        WRITER.close()
+        WRITER = None
+    if CONN is not None:
+        CONN.close()
+        CONN = None
+
+
+class ProfilingQueue(WeightedQueue):
     """
     A customized subclass of asyncio.Queue that records time in the queue and between queues.
 
+    It is a :class:`~pulpcore.plugin.stages.WeightedQueue`, so it can be bounded like the queue it
+    replaces.
+
     This Profiler records some data on items that are inserted and removed from Queues. This data is
     stored on items in a dictionary attribute called 'extra_data'. If this attribute does not exist
     on an item, the ProfileQueue adds it.
@@ -26,6 +172,10 @@ class ProfilingQueue(Queue):
         * queue_length - The number of waiting items in the queue, measured before each new arrival.
         * interarrival_time - The number of seconds since the previous arrival to this Queue.
 
+    Times are measured with the monotonic clock. The statistics are buffered by the
+    :class:`ProfileWriter` and written to the profile db from a thread, so recording them costs a
+    few microseconds per item on the event loop.
+
     See the :meth:`create_profile_db_and_connection()` docs for more info on the database tables and
     layout.
 
@@ -36,8 +186,11 @@ class ProfilingQueue(Queue):
     """
 
     def __init__(self, stage_uuid, *args, **kwargs):
-        self.last_arrival_time = time.time()
+        self.last_arrival_time = time.monotonic()
         self.stage_uuid = stage_uuid
+        self._uuid = str(stage_uuid)
+        self._record_traffic = WRITER.recorder('traffic')
+        self._record_system = WRITER.recorder('system')
         return super().__init__(*args, **kwargs)
 
     def get_nowait(self):
@@ -46,51 +199,53 @@ class ProfilingQueue(Queue):
         """
         item = super().get_nowait()
         if item:
-            now = time.time()
-            item.extra_data['last_waiting_time'] = now - item.extra_data['lastput_time']
-            item.extra_data['last_get_time'] = now
+            now = time.monotonic()
+            extra_data = item.extra_data
+            extra_data['last_waiting_time'] = now - extra_data['lastput_time']
+            extra_data['last_get_time'] = now
+            extra_data['last_stage_uuid'] = self._uuid
+            if isinstance(item, list):
+                # items passed on at once share the statistics of their list
+                for element in item:
+                    element.extra_data.update(extra_data)
         return item
 
     def put_nowait(self, item):
         """
-        Thinly wrap `asyncio.put_nowait` happens and write statistics about them to the sqlite3 DB.
+        Thinly wrap `asyncio.put_nowait` and buffer statistics about the item for the profile db.
 
-        This method computes and writes the following statistics: waiting time, service time, queue
-        length, and interarrival time.
+        This method computes and records the following statistics: waiting time, service time,
+        queue length, and interarrival time.
         """
         if item:
-            now = time.time()
-            if not hasattr(item, 'extra_data'):
+            now = time.monotonic()
+            try:
+                extra_data = item.extra_data
+            except AttributeError:
                 # track stages that use QuerySet items too
-                item.extra_data = {}
+                extra_data = item.extra_data = {}
             try:
-                last_waiting_time = item.extra_data['last_waiting_time']
+                last_waiting_time = extra_data['last_waiting_time']
             except KeyError:
                 pass
             else:
-                service_time = now - item.extra_data['last_get_time']
-                sql = "INSERT INTO traffic (uuid, waiting_time, service_time) VALUES (" \
-                      "'{uuid}','{waiting_time}','{service_time}')"
-                formatted_sql = sql.format(
-                    uuid=self.stage_uuid, waiting_time=last_waiting_time, service_time=service_time
+                # the waiting and service times are those of the stage that got the item
+                service_time = now - extra_data['last_get_time']
+                self._record_traffic(
+                    (extra_data['last_stage_uuid'], last_waiting_time, service_time)
                 )
-                CONN.cursor().execute(formatted_sql)
-
-            interarrival_time = now - self.last_arrival_time
-            sql = "INSERT INTO system (uuid, length, interarrival_time) VALUES (" \
-                  "'{uuid}','{length}','{interarrival}')"
-            formatted_sql = sql.format(
-                uuid=self.stage_uuid, length=super().qsize(), interarrival=interarrival_time
-            )
-            CONN.cursor().execute(formatted_sql)
-            CONN.commit()
-
-            item.extra_data['lastput_time'] = now
+
+            self._record_system((self._uuid, len(self._queue), now - self.last_arrival_time))
+
+            extra_data['lastput_time'] = now
+            if isinstance(item, list):
+                for element in item:
+                    element.extra_data['lastput_time'] = now
             self.last_arrival_time = now
         return super().put_nowait(item)
 
     @staticmethod
-    def make_and_record_queue(stage, num, maxsize):
+    def make_and_record_queue(stage, num, maxsize, maxweight=None, weigh=None):
         """
         Create a ProfileQueue that is associated with the stage it feeds and record it in sqlite3.
 
@@ -98,6 +253,8 @@ class ProfilingQueue(Queue):
             stage (uuid.UUID): The uuid of this stage for correlation with other table data.
             num: (int): The number in the pipeline this stage is at, starting from 0, 1, etc.
             maxsize: The `maxsize` parameter being used to configure the ProfilingQueue with.
+            maxweight: The `maxweight` parameter being used to configure the ProfilingQueue with.
+            weigh: The `weigh` parameter being used to configure the ProfilingQueue with.
 
         Returns:
             ProfilingQueue: The configured ProfilingQueue that was also recorded in the db.
@@ -106,29 +263,119 @@ class ProfilingQueue(Queue):
             create_profile_db_and_connection()
         stage_id = uuid.uuid4()
         stage_name = '.'.join([stage.__class__.__module__, stage.__class__.__name__])
-        sql = "INSERT INTO stages (uuid, name, num) VALUES (" \
-              "'{uuid}','{stage}','{num}')"
-        formatted_sql = sql.format(
-            uuid=stage_id, stage=stage_name, num=num)
-        CONN.cursor().execute(formatted_sql)
-        in_q = ProfilingQueue(stage_id, maxsize=maxsize)
-        CONN.commit()
-        return in_q
+        WRITER.record('stages', (str(stage_id), stage_name, num))
+        return ProfilingQueue(stage_id, maxsize=maxsize, maxweight=maxweight, weigh=weigh)
+
+
+class QueryCounter:
+    """
+    A Django execute wrapper counting the SQL queries of a batch handled by a stage.
+
+    It is installed with `connection.execute_wrapper()` on the connection of the event loop thread
+    while the stage handles the batch, and on the connection of the database thread of the stage
+    during each :meth:`~pulpcore.plugin.stages.Stage.run_database` call. The stages of a pipeline
+    share the event loop thread, so only the queries of the task it was created in are counted
+    there.
+
+    Attributes:
+        queries (int): The number of queries executed, counting an `executemany()` as one.
+        db_time (float): The number of seconds spent executing them.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self._thread = threading.get_ident()
+        self._task = _current_task()
+
+    def __call__(self, execute, sql, params, many, context):
+        if threading.get_ident() == self._thread and _current_task() is not self._task:
+            return execute(sql, params, many, context)
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.monotonic() - start
+            self.queries += 1
+
+
+def record_batch_queries(queue, size, query_counter, service_time):
+    """
+    Record the queries of a batch served by a stage.
+
+    Nothing is recorded if `queue` is not a :class:`ProfilingQueue`.
+
+    Args:
+        queue (asyncio.Queue): The queue feeding the stage that served the batch.
+        size (int): The number of items in the batch.
+        query_counter (:class:`QueryCounter`): The counter of the queries of the batch.
+        service_time (float): The number of seconds the batch received service in the stage.
+    """
+    stage_uuid = getattr(queue, 'stage_uuid', None)
+    if WRITER is None or stage_uuid is None:
+        return
+    WRITER.record('batch_queries', (
+        str(stage_uuid), size, query_counter.queries, query_counter.db_time, service_time
+    ))
+
+
+def record_batch_size(queue, size, target_size, service_time):
+    """
+    Record a batch served by a stage whose batch size is adjusted by a controller.
+
+    Nothing is recorded if `queue` is not a :class:`ProfilingQueue`.
+
+    Args:
+        queue (asyncio.Queue): The queue feeding the stage that served the batch.
+        size (int): The number of items in the batch.
+        target_size (int): The batch size the controller chose after this batch.
+        service_time (float): The number of seconds the batch received service in the stage, as
+            reported to the controller.
+    """
+    stage_uuid = getattr(queue, 'stage_uuid', None)
+    if WRITER is None or stage_uuid is None:
+        return
+    WRITER.record('batch_sizes', (str(stage_uuid), size, target_size, service_time))
+
+
+def record_artifact_cache(queue, artifact_cache):
+    """
+    Record the counters of an :class:`~pulpcore.plugin.stages.ArtifactCache` used by a stage.
+
+    Nothing is recorded if `queue` is not a :class:`ProfilingQueue`.
+
+    Args:
+        queue (asyncio.Queue): The queue feeding the stage using the cache.
+        artifact_cache (:class:`~pulpcore.plugin.stages.ArtifactCache`): The cache to record.
+    """
+    stage_uuid = getattr(queue, 'stage_uuid', None)
+    if WRITER is None or stage_uuid is None:
+        return
+    WRITER.record(
+        'artifact_cache',
+        (str(stage_uuid), artifact_cache.hits, artifact_cache.misses, len(artifact_cache))
+    )
 
 
-def create_profile_db_and_connection():
+def create_profile_db_and_connection(db_path=None):
     """
     Create a profile db from this tasks UUID and a sqlite3 connection to that databases.
 
-    The database produced has three tables with the following SQL format:
+    A :class:`ProfileWriter` writing the recorded rows to the db is started too.
+
+    Args:
+        db_path (str): The path of the profile db. Defaults to a file named after the current RQ
+            job in `/var/lib/pulp/debug/`.
+
+    The database produced has seven tables with the following SQL format:
 
     The `stages` table stores info about the pipeline itself and stores 3 fields
     * uuid - the uuid of the stage
     * name - the name of the stage
     * num - the number of the stage starting at 0
 
-    The `traffic` table stores 3 fields:
-    * uuid - the uuid of the stage this queue feeds into
+    The `traffic` table stores 3 fields, recorded when a stage passes an item on:
+    * uuid - the uuid of the stage that passed the item on
     * waiting_time - the amount of time the item is waiting in the queue before it enters the stage.
     * service_time - the service time the item spent in the stage.
 
@@ -136,19 +383,51 @@ def create_profile_db_and_connection():
     * uuid - The uuid of stage this queue feeds into
     * length - The length of items in this queue, measured just before each arrival.
     * interarrival_time - The amount of time since the last arrival.
+
+    The `batch_sizes` table stores 4 fields for stages using a
+    :class:`~pulpcore.plugin.stages.BatchSizeController`:
+    * uuid - The uuid of the stage that served the batch
+    * size - The number of items in the batch.
+    * target_size - The batch size chosen by the controller after this batch.
+    * service_time - The amount of time the batch received service in the stage, not counting
+      the time the stage waited on a full downstream queue, as reported to the controller.
+
+    The `artifact_cache` table stores 4 fields for stages using an
+    :class:`~pulpcore.plugin.stages.ArtifactCache`, recorded after each batch:
+    * uuid - The uuid of the stage using the cache
+    * hits - The number of lookups served by the cache so far.
+    * misses - The number of lookups not served by the cache so far.
+    * size - The number of Artifacts in the cache.
+
+    The `batch_queries` table stores 5 fields for each batch yielded by
+    :meth:`~pulpcore.plugin.stages.Stage.batches`:
+    * uuid - The uuid of the stage that served the batch
+    * size - The number of items in the batch.
+    * queries - The number of SQL queries the stage executed while serving the batch.
+    * db_time - The amount of time those queries took.
+    * service_time - The amount of time the batch received service in the stage.
+
+    The `dropped_rows` table stores 2 fields for the tables whose rows were buffered faster than
+    they were written, see :class:`ProfileWriter`:
+    * name - The name of the table.
+    * count - The number of rows of that table that were dropped.
     """
-    debug_data_dir = "/var/lib/pulp/debug/"
-    pathlib.Path(debug_data_dir).mkdir(parents=True, exist_ok=True)
-    redis_conn = connection.get_redis_connection()
-    current_job = get_current_job(connection=redis_conn)
-    if current_job:
-        db_path = debug_data_dir + current_job.id
-    else:
-        db_path = debug_data_dir + uuid.uuid4()
+    if db_path is None:
+        debug_data_dir = "/var/lib/pulp/debug/"
+        pathlib.Path(debug_data_dir).mkdir(parents=True, exist_ok=True)
+        redis_conn = connection.get_redis_connection()
+        current_job = get_current_job(connection=redis_conn)
+        if current_job:
+            db_path = debug_data_dir + current_job.id
+        else:
+            db_path = debug_data_dir + str(uuid.uuid4())
 
     import sqlite3
-    global CONN
-    CONN = sqlite3.connect(db_path)
+    global CONN, WRITER
+    if WRITER is not None:
+        WRITER.close()
+    # The connection is used by the thread of the ProfileWriter
+    CONN = sqlite3.connect(db_path, check_same_thread=False)
     c = CONN.cursor()
 
     # Create table
@@ -163,4 +442,22 @@ def create_profile_db_and_connection():
     c.execute('''CREATE TABLE system
                  (uuid varchar(36), length int, interarrival_time real)''')
 
+    # Create table
+    c.execute('''CREATE TABLE batch_sizes
+                 (uuid varchar(36), size int, target_size int, service_time real)''')
+
+    # Create table
+    c.execute('''CREATE TABLE artifact_cache
+                 (uuid varchar(36), hits int, misses int, size int)''')
+
+    # Create table
+    c.execute('''CREATE TABLE batch_queries
+                 (uuid varchar(36), size int, queries int, db_time real, service_time real)''')
+
+    # Create table
+    c.execute('''CREATE TABLE dropped_rows
+                 (name text PRIMARY KEY, count int)''')
+
+    CONN.commit()
+    WRITER = ProfileWriter(CONN)
     return CONN
@@ -0,0 +1,119 @@
+from asyncio import Queue
+from collections import deque
+import sys
+
+
+#: (int): The estimated size in bytes of a :class:`~pulpcore.plugin.stages.DeclarativeContent`
+#: with its unsaved Content unit.
+DECLARATIVE_CONTENT_SIZE = 2048
+
+#: (int): The estimated size in bytes of a :class:`~pulpcore.plugin.stages.DeclarativeArtifact`
+#: with its Artifact.
+DECLARATIVE_ARTIFACT_SIZE = 1536
+
+
+def estimate_size(item):
+    """
+    Estimate the memory used by an item passed between two stages, in bytes.
+
+    A :class:`~pulpcore.plugin.stages.DeclarativeContent` is estimated from its number of
+    :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects and the shallow size of the values
+    in its `extra_data`. A list passed on with :meth:`~pulpcore.plugin.stages.Stage.put_many` is
+    the sum of its items. Any other item counts with its shallow size.
+
+    Args:
+        item: An item passed between two stages.
+
+    Returns:
+        int: The estimated size of `item` in bytes.
+    """
+    if isinstance(item, list):
+        return sum(estimate_size(element) for element in item)
+    try:
+        d_artifacts = item.d_artifacts
+    except AttributeError:
+        return sys.getsizeof(item)
+    size = DECLARATIVE_CONTENT_SIZE + len(d_artifacts) * DECLARATIVE_ARTIFACT_SIZE
+    for value in item.extra_data.values():
+        size += sys.getsizeof(value)
+    return size
+
+
+class WeightedQueue(Queue):
+    """
+    An :class:`asyncio.Queue` that is also bounded by the total weight of its items.
+
+    The weight of each item is computed by `weigh` when it is put into the queue. The queue is full
+    when the total weight of its items reaches `maxweight`, or when it holds `maxsize` items. A
+    list passed on with :meth:`~pulpcore.plugin.stages.Stage.put_many` counts as the number of
+    items in it, so `maxsize` bounds the items queued however they are batched. An item is always
+    accepted by an empty queue, even if it is a list of more than `maxsize` items or weighs more
+    than `maxweight`.
+
+    Args:
+        maxsize (int): The maximum amount of items in the queue. 0 means unbounded. Defaults to 0.
+        maxweight (int): The maximum total weight of the items in the queue. None means unbounded.
+            Defaults to None.
+        weigh (callable): A function returning the weight of an item. Defaults to
+            :func:`~pulpcore.plugin.stages.estimate_size`, weighing items in estimated bytes.
+        kwargs (dict): unused keyword arguments passed along to :class:`asyncio.Queue`.
+    """
+
+    def __init__(self, maxsize=0, maxweight=None, weigh=None, **kwargs):
+        self.maxweight = maxweight
+        self.weigh = weigh or estimate_size
+        self.weight = 0
+        self.length = 0
+        super().__init__(maxsize=maxsize, **kwargs)
+
+    def full(self):
+        """
+        Return True if the queue holds `maxsize` items or items weighing `maxweight` in total.
+        """
+        if self.empty():
+            return False
+        if self.maxsize > 0 and self.length >= self.maxsize:
+            return True
+        return self.maxweight is not None and self.weight >= self.maxweight
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._weights = deque()
+
+    def _put(self, item):
+        self.length += _count(item)
+        if self.maxweight is not None:
+            # Items are only weighed when the queue is bounded by weight
+            weight = 0 if item is None else self.weigh(item)
+            self._weights.append(weight)
+            self.weight += weight
+        super()._put(item)
+
+    def _get(self):
+        if self.maxweight is not None:
+            self.weight -= self._weights.popleft()
+        item = super()._get()
+        self.length -= _count(item)
+        return item
+
+
+def _count(item):
+    """
+    Return the number of items `item` counts as in a :class:`WeightedQueue`.
+    """
+    return len(item) if isinstance(item, list) else 1
+
+
+def make_queue_like(queue):
+    """
+    Create an empty queue with the same bounds as `queue`.
+
+    Args:
+        queue (:class:`asyncio.Queue`): The queue to copy the bounds of.
+
+    Returns:
+        :class:`asyncio.Queue`: A new queue bounded like `queue`.
+    """
+    if isinstance(queue, WeightedQueue):
+        return WeightedQueue(maxsize=queue.maxsize, maxweight=queue.maxweight, weigh=queue.weigh)
+    return Queue(maxsize=queue.maxsize)
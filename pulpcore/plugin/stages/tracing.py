@@ -0,0 +1,242 @@
+from gettext import gettext as _
+import json
+import logging
+import os
+import pathlib
+import random
+import threading
+import time
+
+from rq.job import get_current_job
+
+from pulpcore.tasking import connection
+
+
+log = logging.getLogger(__name__)
+
+
+TRACER = None
+
+
+class TraceContext:
+    """
+    The trace of a sampled :class:`~pulpcore.plugin.stages.DeclarativeContent` through a pipeline.
+
+    Attributes:
+        trace_id (int): The id of the trace, shown as the thread of its spans in the timeline.
+        stage (str): The name of the stage serving the item, or None.
+        got_at (float): The monotonic time the stage started serving the item, or None.
+        put_at (float): The monotonic time the item was last passed on, or None.
+    """
+
+    __slots__ = ('trace_id', 'stage', 'got_at', 'put_at')
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.stage = None
+        self.got_at = None
+        self.put_at = None
+
+
+class Tracer:
+    """
+    Samples :class:`~pulpcore.plugin.stages.DeclarativeContent` and records spans of their way
+    through a pipeline, to be exported as Chrome trace-event JSON.
+
+    Each sampled item gets a :class:`TraceContext` when it is created, and its spans are recorded
+    by :meth:`~pulpcore.plugin.stages.Stage.items`, :meth:`~pulpcore.plugin.stages.Stage.batches`,
+    :meth:`~pulpcore.plugin.stages.Stage.put`, and
+    :meth:`~pulpcore.plugin.stages.DeclarativeArtifact.download`:
+
+        * wait - from being passed on until the next stage serves it, in its queue or a batch.
+        * the name of a stage - from being served by the stage until being passed on.
+        * download - the download of one of its Artifacts.
+
+    In the timeline, each sampled item is shown as a thread named after it. Once `max_events`
+    spans are recorded, further spans are dropped.
+
+    Attributes:
+        traces (int): The number of items sampled.
+        dropped (int): The number of spans dropped.
+
+    Args:
+        sample_rate (float): The share of items to trace, between 0 and 1.
+        max_events (int): The maximum number of spans to keep. Defaults to 100000.
+    """
+
+    def __init__(self, sample_rate, max_events=100000):
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        self.traces = 0
+        self.dropped = 0
+        self._events = []
+        self._start = time.monotonic()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def start_trace(self, item):
+        """
+        Return a new :class:`TraceContext` for a sampled item, or None if it is not sampled.
+
+        Args:
+            item: The item, named after its `str()` in the timeline.
+        """
+        if random.random() >= self.sample_rate:
+            return None
+        with self._lock:
+            self.traces += 1
+            trace = TraceContext(self.traces)
+            self._events.append({
+                'ph': 'M', 'name': 'thread_name', 'pid': self._pid, 'tid': trace.trace_id,
+                'args': {'name': '{name} #{id}'.format(name=item, id=trace.trace_id)},
+            })
+        return trace
+
+    def record(self, trace, name, start, end, category='stage', args=None):
+        """
+        Record a span of a trace.
+
+        Args:
+            trace (:class:`TraceContext`): The trace of the item.
+            name (str): The name of the span.
+            start (float): The monotonic time the span started.
+            end (float): The monotonic time the span ended.
+            category (str): The category of the span. Defaults to 'stage'.
+            args (dict): Details shown with the span. Optional.
+        """
+        event = {
+            'ph': 'X', 'name': name, 'cat': category, 'pid': self._pid, 'tid': trace.trace_id,
+            'ts': (start - self._start) * 1e6, 'dur': (end - start) * 1e6,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            if len(self._events) >= self.max_events:
+                self.dropped += 1
+                return
+            self._events.append(event)
+
+    def export(self):
+        """
+        Return the recorded spans as Chrome trace-event JSON.
+
+        Returns:
+            dict: The trace, to be serialized with `json`.
+        """
+        with self._lock:
+            events = list(self._events)
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'sample_rate': self.sample_rate, 'dropped_events': self.dropped},
+        }
+
+    def write(self, path):
+        """
+        Write the recorded spans as Chrome trace-event JSON to `path`.
+
+        The file can be opened with `chrome://tracing` or Perfetto.
+
+        Args:
+            path (str): The path of the file.
+        """
+        with open(path, 'w') as trace_file:
+            json.dump(self.export(), trace_file)
+
+
+def start_trace(item):
+    """
+    Return a new :class:`TraceContext` if tracing is enabled and the item is sampled, else None.
+
+    Args:
+        item: The item, named after its `str()` in the timeline.
+    """
+    if TRACER is None:
+        return None
+    return TRACER.start_trace(item)
+
+
+def trace_get(item, stage):
+    """
+    Record that a stage starts serving an item, if the item is traced.
+
+    The time since the item was passed on is recorded as a `wait` span. If the previous stage
+    handed the item over without :meth:`~pulpcore.plugin.stages.Stage.put`, its span ends now.
+
+    Args:
+        item: The item.
+        stage (:class:`~pulpcore.plugin.stages.Stage`): The stage serving the item.
+    """
+    trace = getattr(item, 'trace', None)
+    tracer = TRACER
+    if trace is None or tracer is None:
+        return
+    now = time.monotonic()
+    name = stage.__class__.__name__
+    if trace.got_at is not None:
+        tracer.record(trace, trace.stage, trace.got_at, now)
+    elif trace.put_at is not None:
+        tracer.record(trace, 'wait', trace.put_at, now, category='wait', args={'stage': name})
+    trace.stage = name
+    trace.got_at = now
+
+
+def trace_put(item):
+    """
+    Record that the stage serving an item passes it on, if the item is traced.
+
+    Args:
+        item: The item.
+    """
+    trace = getattr(item, 'trace', None)
+    tracer = TRACER
+    if trace is None or tracer is None:
+        return
+    now = time.monotonic()
+    if trace.got_at is not None:
+        tracer.record(trace, trace.stage, trace.got_at, now)
+    trace.got_at = None
+    trace.put_at = now
+
+
+def start_tracing(sample_rate, max_events=100000):
+    """
+    Start sampling the items created from now on.
+
+    Args:
+        sample_rate (float): The share of items to trace, between 0 and 1.
+        max_events (int): The maximum number of spans to keep. Defaults to 100000.
+
+    Returns:
+        :class:`Tracer`: The tracer.
+    """
+    global TRACER
+    TRACER = Tracer(sample_rate, max_events=max_events)
+    return TRACER
+
+
+def stop_tracing(path=None):
+    """
+    Stop tracing, and write the trace.
+
+    Args:
+        path (str): The path to write the trace to. Defaults to a file named after the current RQ
+            job in `/var/lib/pulp/debug/`, with a `.trace.json` suffix.
+
+    Returns:
+        str: The path the trace was written to, or None if tracing was not started.
+    """
+    global TRACER
+    tracer, TRACER = TRACER, None
+    if tracer is None:
+        return None
+    if path is None:
+        debug_data_dir = "/var/lib/pulp/debug/"
+        pathlib.Path(debug_data_dir).mkdir(parents=True, exist_ok=True)
+        current_job = get_current_job(connection=connection.get_redis_connection())
+        job_id = current_job.id if current_job else str(os.getpid())
+        path = debug_data_dir + job_id + '.trace.json'
+    tracer.write(path)
+    log.info(_('Wrote the trace of %(count)d sampled items to %(path)s.'),
+             {'count': tracer.traces, 'path': path})
+    return path
@@ -0,0 +1,171 @@
+"""
+End-to-end benchmarks of the Stages API.
+
+A :class:`~pulpcore.plugin.stages.DeclarativeVersion` is driven by a synthetic first stage
+declaring `PULP_BENCHMARK_UNITS` content units of `PULP_BENCHMARK_ARTIFACTS` artifacts each, of
+`PULP_BENCHMARK_SIZE` bytes. The artifacts are served by a local HTTP server. Before the measured
+sync, `PULP_BENCHMARK_EXISTING` percent of the units are synced into another repository, so they
+are already in Pulp.
+
+The benchmarks need a development database, and pulp_file for its content and remote models::
+
+    PULP_BENCHMARK_UNITS=10000 PULP_BENCHMARK_EXISTING=50 \\
+        pulp-manager test ./pulpcore/tests/performance/
+
+They report the units and bytes synced per second, and the utilization of each stage as the share
+of the sync it spent serving items, measured with the `PROFILE_STAGES_API` profiler.
+"""
+import asyncio
+import hashlib
+import os
+import socket
+import tempfile
+import time
+import types
+import uuid
+from unittest import mock, skipIf
+
+from aiohttp import web
+from django.test import override_settings, TransactionTestCase
+
+from pulpcore.app.models import Task
+from pulpcore.plugin.models import Artifact, Repository
+from pulpcore.plugin.stages import (
+    DeclarativeArtifact,
+    DeclarativeContent,
+    DeclarativeVersion,
+    profiler,
+    Stage,
+)
+
+try:
+    from pulp_file.app.models import FileContent, FileRemote
+except ImportError:
+    FileContent = FileRemote = None
+
+
+UNITS = int(os.environ.get('PULP_BENCHMARK_UNITS', 1000))
+ARTIFACTS = int(os.environ.get('PULP_BENCHMARK_ARTIFACTS', 1))
+EXISTING = float(os.environ.get('PULP_BENCHMARK_EXISTING', 0))
+SIZE = int(os.environ.get('PULP_BENCHMARK_SIZE', 1024))
+
+
+def artifact_data(unit, index, size):
+    """
+    Return the data of an artifact of a synthetic unit.
+    """
+    seed = '{unit}-{index}\n'.format(unit=unit, index=index).encode()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class SyntheticFirstStage(Stage):
+    """
+    A first stage declaring `units` FileContent units of `artifacts` artifacts of `size` bytes.
+
+    The digests of the artifacts are computed before the sync, so they are not measured.
+    """
+
+    def __init__(self, remote, units, artifacts, size):
+        super().__init__()
+        self.remote = remote
+        self.units = units
+        self.artifacts = artifacts
+        self.size = size
+        self.digests = [
+            [hashlib.sha256(artifact_data(unit, index, size)).hexdigest()
+             for index in range(artifacts)]
+            for unit in range(units)
+        ]
+
+    async def run(self):
+        for unit in range(self.units):
+            d_artifacts = []
+            for index, digest in enumerate(self.digests[unit]):
+                relative_path = '{unit}/{index}'.format(unit=unit, index=index)
+                d_artifacts.append(DeclarativeArtifact(
+                    artifact=Artifact(sha256=digest, size=self.size),
+                    url='{url}/{path}'.format(url=self.remote.url, path=relative_path),
+                    relative_path=relative_path,
+                    remote=self.remote,
+                ))
+            content = FileContent(relative_path=d_artifacts[0].relative_path,
+                                  digest=self.digests[unit][0])
+            await self.put(DeclarativeContent(content=content, d_artifacts=d_artifacts))
+
+
+@skipIf(FileContent is None, 'pulp_file is required to benchmark the Stages API')
+class TestStagesBenchmark(TransactionTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        app = web.Application()
+        app.router.add_get('/{unit}/{index}', self.serve_artifact)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.loop.run_until_complete(web.SockSite(self.runner, sock).start())
+        self.url = 'http://127.0.0.1:{port}'.format(port=sock.getsockname()[1])
+        self.remote = FileRemote.objects.create(name=str(uuid.uuid4()), url=self.url)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+
+    async def serve_artifact(self, request):
+        unit = int(request.match_info['unit'])
+        index = int(request.match_info['index'])
+        return web.Response(body=artifact_data(unit, index, SIZE))
+
+    def sync(self, units, profile=False):
+        """
+        Sync `units` synthetic units into a new repository, as a task would.
+
+        Returns:
+            float: The number of seconds the sync took.
+        """
+        repository = Repository.objects.create(name=str(uuid.uuid4()))
+        first_stage = SyntheticFirstStage(self.remote, units, ARTIFACTS, SIZE)
+        task = Task.objects.create(state='running', name='benchmark')
+        job = types.SimpleNamespace(id=str(task.job_id), origin='benchmark')
+        if profile:
+            profile_dir = tempfile.TemporaryDirectory()
+            self.addCleanup(profile_dir.cleanup)
+            profiler.create_profile_db_and_connection(os.path.join(profile_dir.name, 'profile'))
+            self.addCleanup(profiler.close_profile_db)
+        with mock.patch('pulpcore.app.models.task.get_current_job', return_value=job), \
+                mock.patch('pulpcore.tasking.services.storage.get_current_job', return_value=job), \
+                override_settings(PROFILE_STAGES_API=profile):
+            start = time.monotonic()
+            DeclarativeVersion(first_stage, repository).create()
+            elapsed = time.monotonic() - start
+        if profile:
+            self.stage_utilization = self.utilization(elapsed)
+        self.assertEqual(repository.versions.latest('number').content.count(), units)
+        return elapsed
+
+    @staticmethod
+    def utilization(elapsed):
+        """
+        Return the share of `elapsed` each stage spent serving items, from the profile db.
+        """
+        rows = profiler.CONN.execute(
+            'SELECT stages.name, SUM(traffic.service_time) FROM traffic '
+            'JOIN stages ON stages.uuid = traffic.uuid GROUP BY stages.uuid ORDER BY stages.num'
+        )
+        return {name: busy / elapsed for name, busy in rows}
+
+    def test_sync(self):
+        existing = int(UNITS * EXISTING / 100)
+        if existing:
+            self.sync(existing)
+        elapsed = self.sync(UNITS, profile=True)
+
+        downloaded = (UNITS - existing) * ARTIFACTS * SIZE
+        print('\nSynced {units} units of {artifacts} artifacts of {size} bytes, {existing} units '
+              'already in Pulp, in {elapsed:.2f}s'.format(
+                  units=UNITS, artifacts=ARTIFACTS, size=SIZE, existing=existing,
+                  elapsed=elapsed))
+        print('{rate:.1f} units/sec, {bytes:.0f} bytes/sec'.format(
+            rate=UNITS / elapsed, bytes=downloaded / elapsed))
+        for name, utilization in self.stage_utilization.items():
+            print('{name:<70} {utilization:6.1%}'.format(name=name, utilization=utilization))
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import socket
+import tempfile
+
+import aiohttp
+import asynctest
+from aiohttp import web
+
+from pulpcore.plugin.download.http import HttpDownloader
+
+
+DATA = b'0123456789' * 1000
+
+
+class TestHttpResume(asynctest.TestCase):
+    """
+    Continue partial downloads from a local HTTP server answering range requests with `self.mode`.
+    """
+
+    async def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.resume_path = os.path.join(self.tmp.name, 'resume')
+        self.expected_digests = {'sha256': hashlib.sha256(DATA).hexdigest()}
+        self.mode = 206
+        self.ranges = []
+        app = web.Application()
+        app.router.add_get('/data', self.serve)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await web.SockSite(self.runner, sock).start()
+        self.url = 'http://127.0.0.1:{port}/data'.format(port=sock.getsockname()[1])
+        self.session = aiohttp.ClientSession()
+
+    async def tearDown(self):
+        await self.session.close()
+        await self.runner.cleanup()
+
+    async def serve(self, request):
+        range_header = request.headers.get('Range')
+        self.ranges.append(range_header)
+        if range_header is None or self.mode == 200:
+            return web.Response(body=DATA)
+        if self.mode == 416:
+            return web.Response(status=416)
+        start = int(range_header[len('bytes='):-1])
+        if self.mode == 'wrong range':
+            start = 0
+        return web.Response(status=206, body=DATA[start:], headers={
+            'Content-Range': 'bytes {start}-{end}/{size}'.format(
+                start=start, end=len(DATA) - 1, size=len(DATA)),
+        })
+
+    async def download(self, partial):
+        with open(self.resume_path + '.part', 'wb') as part:
+            part.write(partial)
+        downloader = HttpDownloader(self.url, session=self.session, resume_path=self.resume_path,
+                                    expected_digests=self.expected_digests)
+        result = await downloader.run()
+        self.assertEqual(result.artifact_attributes['sha256'], self.expected_digests['sha256'])
+        with open(self.resume_path, 'rb') as kept:
+            self.assertEqual(kept.read(), DATA)
+
+    async def test_partial_content_is_appended(self):
+        await self.download(DATA[:1234])
+        self.assertEqual(self.ranges, ['bytes=1234-'])
+
+    async def test_whole_file_replaces_partial_data(self):
+        self.mode = 200
+        await self.download(b'garbage')
+        self.assertEqual(self.ranges, ['bytes=7-'])
+
+    async def test_unsatisfiable_range_restarts(self):
+        self.mode = 416
+        await self.download(b'garbage')
+        self.assertEqual(self.ranges, ['bytes=7-', None])
+
+    async def test_wrong_content_range_restarts(self):
+        self.mode = 'wrong range'
+        await self.download(DATA[:1234])
+        self.assertEqual(self.ranges, ['bytes=1234-', None])
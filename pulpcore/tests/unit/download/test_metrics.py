@@ -0,0 +1,45 @@
+import hashlib
+import os
+import tempfile
+
+import asynctest
+
+from pulpcore.exceptions import DigestValidationError
+from pulpcore.plugin import metrics
+from pulpcore.plugin.download.file import FileDownloader
+
+
+DATA = b'0123456789' * 1000
+
+
+class TestDownloadMetrics(asynctest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        self.source = os.path.join(self.tmp.name, 'source')
+        with open(self.source, 'wb') as source:
+            source.write(DATA)
+        self.url = 'file://' + self.source
+        self.downloaded = metrics.download_bytes.labels('')
+        self.durations = metrics.download_duration.labels('')
+        self.failures = metrics.download_digest_failures.labels('')
+
+    async def test_download_is_counted(self):
+        downloaded = self.downloaded.value
+        durations = sum(self.durations.counts)
+        await FileDownloader(self.url).run()
+        self.assertEqual(self.downloaded.value - downloaded, len(DATA))
+        self.assertEqual(sum(self.durations.counts) - durations, 1)
+
+    async def test_digest_failure_is_counted(self):
+        failures = self.failures.value
+        downloader = FileDownloader(self.url, expected_digests={
+            'sha256': hashlib.sha256(b'other').hexdigest()
+        })
+        with self.assertRaises(DigestValidationError):
+            await downloader.run()
+        self.assertEqual(self.failures.value - failures, 1)
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import tempfile
+
+import asynctest
+
+from pulpcore.exceptions import DigestValidationError
+from pulpcore.plugin.download.file import FileDownloader
+
+
+DATA = b'0123456789' * 1000
+
+
+class TestResume(asynctest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'source')
+        with open(self.source, 'wb') as source:
+            source.write(DATA)
+        self.resume_path = os.path.join(self.tmp.name, 'resume')
+        self.url = 'file://' + self.source
+        self.expected_digests = {'sha256': hashlib.sha256(DATA).hexdigest()}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def downloader(self, **kwargs):
+        return FileDownloader(self.url, resume_path=self.resume_path,
+                              expected_digests=self.expected_digests, **kwargs)
+
+    async def test_complete_download_is_kept(self):
+        await self.downloader().run()
+        self.assertFalse(os.path.exists(self.resume_path + '.part'))
+        with open(self.resume_path, 'rb') as kept:
+            self.assertEqual(kept.read(), DATA)
+
+    async def test_complete_download_is_reused(self):
+        await self.downloader().run()
+        os.remove(self.source)
+        result = await self.downloader().run()
+        self.assertEqual(result.path, self.resume_path)
+        self.assertEqual(result.artifact_attributes['size'], len(DATA))
+        self.assertEqual(result.artifact_attributes['sha256'], self.expected_digests['sha256'])
+
+    async def test_partial_download_is_continued(self):
+        with open(self.resume_path + '.part', 'wb') as partial:
+            partial.write(DATA[:1234])
+        downloader = self.downloader()
+        result = await downloader.run()
+        self.assertEqual(result.artifact_attributes['sha256'], self.expected_digests['sha256'])
+        with open(self.resume_path, 'rb') as kept:
+            self.assertEqual(kept.read(), DATA)
+
+    async def test_invalid_partial_download_is_removed(self):
+        with open(self.resume_path + '.part', 'wb') as partial:
+            partial.write(b'garbage')
+        with self.assertRaises(DigestValidationError):
+            await self.downloader().run()
+        self.assertFalse(os.path.exists(self.resume_path + '.part'))
+        result = await self.downloader().run()
+        self.assertEqual(result.artifact_attributes['sha256'], self.expected_digests['sha256'])
+
+    async def test_locked_partial_download_is_not_shared(self):
+        first = self.downloader()
+        await first._resume()
+        second = self.downloader()
+        result = await second.run()
+        self.assertIsNone(second.resume_path)
+        self.assertNotEqual(second.path, first.path)
+        self.assertEqual(result.artifact_attributes['sha256'], self.expected_digests['sha256'])
+        os.remove(second.path)
+        first._writer.close()
+
+    async def test_restart(self):
+        with open(self.resume_path + '.part', 'wb') as partial:
+            partial.write(DATA[:1234])
+        downloader = self.downloader()
+        await downloader._resume()
+        self.assertEqual(downloader.resume_offset, 1234)
+        downloader.restart()
+        self.assertEqual(downloader.resume_offset, 0)
+        await downloader._run()
+        with open(self.resume_path, 'rb') as kept:
+            self.assertEqual(kept.read(), DATA)
@@ -0,0 +1,85 @@
+"""
+Tests of :func:`~pulpcore.plugin.models.bulk_create_content` against a database.
+
+They need a PostgreSQL development database, and pulp_file for a multi-table Content model::
+
+    pulp-manager test ./pulpcore/tests/unit/models/
+"""
+import uuid
+from unittest import skipIf
+
+from django.db import connection, IntegrityError
+from django.test import TestCase
+
+from pulpcore.plugin.models import bulk_create_content, Content
+
+try:
+    from pulp_file.app.models import FileContent
+except ImportError:
+    FileContent = None
+
+
+@skipIf(FileContent is None, 'pulp_file is required for a multi-table Content model')
+@skipIf(connection.vendor != 'postgresql', 'PostgreSQL is required to return bulk inserted pks')
+class TestBulkCreateContent(TestCase):
+
+    def make_units(self, *relative_paths):
+        return [FileContent(relative_path=relative_path, digest=self.digest)
+                for relative_path in relative_paths]
+
+    def setUp(self):
+        self.digest = uuid.uuid4().hex
+
+    def assert_no_orphans(self):
+        masters = Content.objects.filter(_type='file.file').values_list('pk', flat=True)
+        details = FileContent.objects.values_list('pk', flat=True)
+        self.assertEqual(set(masters), set(details))
+
+    def test_no_conflicts(self):
+        units = self.make_units('a', 'b', 'c')
+
+        inserted = bulk_create_content(units, batch_size=2)
+
+        self.assertEqual(inserted, units)
+        for unit in units:
+            self.assertIsNotNone(unit.pk)
+            self.assertEqual(unit.content_ptr_id, unit.pk)
+            self.assertFalse(unit._state.adding)
+        saved = FileContent.objects.filter(pk__in=[unit.pk for unit in units])
+        self.assertEqual(sorted(saved.values_list('relative_path', flat=True)), ['a', 'b', 'c'])
+        self.assertEqual(set(saved.values_list('_type', flat=True)), {'file.file'})
+        self.assert_no_orphans()
+
+    def test_partial_conflicts_are_skipped(self):
+        existing, = self.make_units('b')
+        existing.save()
+        units = self.make_units('a', 'b', 'c')
+
+        inserted = bulk_create_content(units, ignore_conflicts=True)
+
+        self.assertEqual([unit.relative_path for unit in inserted], ['a', 'c'])
+        conflicting = units[1]
+        self.assertIsNone(conflicting.pk)
+        self.assertIsNone(conflicting.content_ptr_id)
+        self.assertTrue(conflicting._state.adding)
+        self.assertEqual(FileContent.objects.get(conflicting.q()).pk, existing.pk)
+        self.assert_no_orphans()
+
+    def test_all_conflicts_are_skipped(self):
+        bulk_create_content(self.make_units('a', 'b'))
+
+        inserted = bulk_create_content(self.make_units('a', 'b'), ignore_conflicts=True)
+
+        self.assertEqual(inserted, [])
+        self.assertEqual(FileContent.objects.filter(digest=self.digest).count(), 2)
+        self.assert_no_orphans()
+
+    def test_conflict_raises_without_ignore_conflicts(self):
+        bulk_create_content(self.make_units('a'))
+
+        with self.assertRaises(IntegrityError):
+            bulk_create_content(self.make_units('a'))
+
+    def test_mixed_models_are_refused(self):
+        with self.assertRaises(ValueError):
+            bulk_create_content(self.make_units('a') + [Content()])
@@ -0,0 +1,36 @@
+def drain_queue(queue):
+    """
+    Get all items of `queue`, unpacking the lists of items passed on with `put_many()`.
+    """
+    items = []
+    while not queue.empty():
+        item = queue.get_nowait()
+        if isinstance(item, list):
+            items.extend(item)
+        else:
+            items.append(item)
+    return items
+
+
+class QMock:
+    """
+    A stand-in for `Q` objects that ORs in constant time.
+    """
+
+    def __or__(self, other):
+        return self
+
+
+class ArtifactMock:
+    """
+    A minimal stand-in for an Artifact with digest fields and a truthy `q()`.
+    """
+    DIGEST_FIELDS = ('sha512', 'sha384', 'sha256', 'sha224', 'sha1', 'md5')
+
+    def __init__(self, pk=None, **digests):
+        self.pk = pk
+        for digest_name in self.DIGEST_FIELDS:
+            setattr(self, digest_name, digests.get(digest_name))
+
+    def q(self):
+        return QMock()
@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from django.db.models.signals import post_delete
+
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import ArtifactCache
+
+from . import ArtifactMock
+
+
+class TestArtifactCache(TestCase):
+
+    def test_lookup_by_strongest_digest(self):
+        artifact = ArtifactMock(pk=1, sha256='a', md5='x')
+        artifact_cache = ArtifactCache()
+        artifact_cache.add([artifact])
+        self.assertIs(artifact_cache.get(ArtifactMock(sha256='a')), artifact)
+        self.assertIs(artifact_cache.get(ArtifactMock(md5='x')), artifact)
+        self.assertIsNone(artifact_cache.get(ArtifactMock(sha256='b', md5='x')))
+        self.assertEqual((artifact_cache.hits, artifact_cache.misses), (2, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        artifacts = [ArtifactMock(pk=i, sha256=str(i)) for i in range(3)]
+        artifact_cache = ArtifactCache(maxsize=2)
+        artifact_cache.add(artifacts[:2])
+        artifact_cache.get(ArtifactMock(sha256='0'))
+        artifact_cache.add(artifacts[2:])
+        self.assertEqual(len(artifact_cache), 2)
+        self.assertIs(artifact_cache.get(ArtifactMock(sha256='0')), artifacts[0])
+        self.assertIsNone(artifact_cache.get(ArtifactMock(sha256='1')))
+        self.assertIs(artifact_cache.get(ArtifactMock(sha256='2')), artifacts[2])
+
+    def test_invalidate(self):
+        artifact_cache = ArtifactCache()
+        artifact_cache.add([ArtifactMock(pk=1, sha256='a'), ArtifactMock(pk=2, sha256='b')])
+        artifact_cache.invalidate([1, 3])
+        self.assertIsNone(artifact_cache.get(ArtifactMock(sha256='a')))
+        self.assertIsNotNone(artifact_cache.get(ArtifactMock(sha256='b')))
+        artifact_cache.clear()
+        self.assertEqual(len(artifact_cache), 0)
+        self.assertIsNone(artifact_cache.get(ArtifactMock(sha256='b')))
+
+    def test_deleted_artifact_is_invalidated(self):
+        artifact = ArtifactMock(pk=1, sha256='a')
+        artifact_cache = ArtifactCache()
+        artifact_cache.add([artifact])
+        post_delete.send(sender=Artifact, instance=artifact)
+        self.assertEqual(len(artifact_cache), 0)
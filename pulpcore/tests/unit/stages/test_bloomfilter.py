@@ -0,0 +1,82 @@
+import hashlib
+from unittest import TestCase
+
+import mock
+
+from pulpcore.plugin.stages import ArtifactBloomFilter, bloom_filter as bloom_filter_module
+
+
+def digest(i):
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+
+class TestArtifactBloomFilter(TestCase):
+
+    def test_added_digests_are_contained(self):
+        bloom_filter = ArtifactBloomFilter(1000)
+        bloom_filter.update(digest(i) for i in range(1000))
+        self.assertEqual(bloom_filter.count, 1000)
+        self.assertTrue(all(bloom_filter.might_contain(digest(i)) for i in range(1000)))
+        self.assertEqual(bloom_filter.negatives, 0)
+
+    def test_false_positive_rate(self):
+        bloom_filter = ArtifactBloomFilter(10000, error_rate=0.01)
+        bloom_filter.update(digest(i) for i in range(10000))
+        positives = sum(bloom_filter.might_contain(digest(-i)) for i in range(1, 10001))
+        self.assertLess(positives, 300)
+        self.assertAlmostEqual(bloom_filter.false_positive_rate, 0.01, delta=0.005)
+        self.assertEqual(bloom_filter.checks, 10000)
+        self.assertEqual(bloom_filter.negatives, 10000 - positives)
+
+    def test_memory_size(self):
+        bloom_filter = ArtifactBloomFilter(100000, error_rate=0.01)
+        # about 9.6 bits per digest at a 1% false-positive rate
+        self.assertAlmostEqual(bloom_filter.memory_size, 120000, delta=1000)
+        self.assertEqual(bloom_filter.hash_count, 7)
+
+    def test_observed_false_positive_rate(self):
+        bloom_filter = ArtifactBloomFilter(1000)
+        self.assertIsNone(bloom_filter.observed_false_positive_rate)
+        bloom_filter.negatives = 9
+        bloom_filter.record_false_positives(1)
+        self.assertEqual(bloom_filter.observed_false_positive_rate, 0.1)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            ArtifactBloomFilter(0)
+        with self.assertRaises(ValueError):
+            ArtifactBloomFilter(1000, error_rate=1)
+
+    def test_stale_when_full(self):
+        bloom_filter = ArtifactBloomFilter(10)
+        bloom_filter.update(digest(i) for i in range(10))
+        self.assertFalse(bloom_filter.is_stale(3600))
+        bloom_filter.add(digest(10))
+        self.assertTrue(bloom_filter.is_stale(3600))
+
+    def test_stale_when_old(self):
+        bloom_filter = ArtifactBloomFilter(10)
+        self.assertFalse(bloom_filter.is_stale(0))
+        with mock.patch.object(bloom_filter_module.time, 'monotonic', return_value=1000.0):
+            bloom_filter.built_at = 100.0
+            self.assertFalse(bloom_filter.is_stale(3600))
+            self.assertTrue(bloom_filter.is_stale(600))
+
+
+class TestSharedArtifactBloomFilter(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(bloom_filter_module, '_shared_artifact_bloom_filter', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(ArtifactBloomFilter, 'from_database')
+    def test_rebuilt_when_stale(self, from_database):
+        first, second = ArtifactBloomFilter(10), ArtifactBloomFilter(10)
+        from_database.side_effect = [first, second]
+
+        self.assertIs(bloom_filter_module.shared_artifact_bloom_filter(), first)
+        self.assertIs(bloom_filter_module.shared_artifact_bloom_filter(), first)
+        first.update(digest(i) for i in range(11))
+        self.assertIs(bloom_filter_module.shared_artifact_bloom_filter(), second)
+        self.assertEqual(from_database.call_count, 2)
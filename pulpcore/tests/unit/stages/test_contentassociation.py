@@ -0,0 +1,75 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import ContentAssociation, DeclarativeContent
+
+from . import drain_queue
+
+
+class TestStagingTable(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        self.new_version = mock.Mock()
+        self.new_version.content.filter.return_value.values_list.return_value = [1]
+        to_delete = self.new_version.content.exclude.return_value
+        to_delete.values_list.return_value.iterator.return_value = iter(range(10, 15))
+        for pk in (1, 2):
+            self.in_q.put_nowait(DeclarativeContent(content=mock.Mock(pk=pk)))
+        self.in_q.put_nowait(None)
+
+    async def run_stage(self):
+        module = 'pulpcore.plugin.stages.association_stages'
+        with mock.patch(module + '.connection') as connection, \
+                mock.patch(module + '.Content') as content, \
+                mock.patch(module + '.ProgressBar') as pb:
+            connection.ops.quote_name.side_effect = lambda name: '"{name}"'.format(name=name)
+            content._meta.pk.rel_db_type.return_value = 'integer'
+            content.objects.filter.side_effect = lambda **kwargs: kwargs
+            self.pb = pb.return_value.__enter__.return_value
+            self.pb.done = 0
+            self.cursor = connection.cursor.return_value.__enter__.return_value
+            stage = ContentAssociation(self.new_version, use_staging_table=True,
+                                       staging_chunk_size=2)
+            stage._connect(self.in_q, self.out_q)
+            await stage()
+
+    def statements(self):
+        return [call[0][0] for call in self.cursor.execute.call_args_list]
+
+    async def test_units_are_staged_and_unassociated_in_chunks(self):
+        await self.run_stage()
+
+        create, insert, drop = self.statements()
+        table = create.split()[3]
+        self.assertTrue(table.startswith('"pulp_content_association_'))
+        self.assertEqual(
+            create, 'CREATE TEMPORARY TABLE {table} (content_id integer PRIMARY KEY)'.format(
+                table=table))
+        self.assertEqual(
+            insert, 'INSERT INTO {table} (content_id) VALUES (%s), (%s) '
+                    'ON CONFLICT DO NOTHING'.format(table=table))
+        self.assertEqual(sorted(self.cursor.execute.call_args_list[1][0][1]), [1, 2])
+        self.assertEqual(drop, 'DROP TABLE IF EXISTS {table}'.format(table=table))
+
+        self.new_version.add_content.assert_called_once_with({'pk__in': {2}})
+        self.assertEqual(self.pb.done, 1)
+        staged_pks = self.new_version.content.exclude.call_args[1]['pk__in']
+        self.assertEqual(staged_pks.sql, 'SELECT content_id FROM {table}'.format(table=table))
+        self.assertEqual(drain_queue(self.out_q), [
+            {'pk__in': [10, 11]}, {'pk__in': [12, 13]}, {'pk__in': [14]}, None,
+        ])
+
+    async def test_table_is_dropped_on_failure(self):
+        self.new_version.add_content.side_effect = RuntimeError()
+
+        with self.assertRaises(RuntimeError):
+            await self.run_stage()
+
+        statements = self.statements()
+        self.assertTrue(statements[0].startswith('CREATE TEMPORARY TABLE'))
+        self.assertTrue(statements[-1].startswith('DROP TABLE IF EXISTS'))
+        self.new_version.content.exclude.assert_not_called()
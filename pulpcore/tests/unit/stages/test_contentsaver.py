@@ -0,0 +1,147 @@
+import asyncio
+from contextlib import contextmanager
+import itertools
+import threading
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent
+from pulpcore.plugin.stages.content_stages import ContentSaver
+
+from . import drain_queue, QMock
+
+
+@contextmanager
+def atomic_mock(*args, **kwargs):
+    yield
+
+
+class ContentMock:
+    """
+    A minimal stand-in for a Content model keyed on `name`.
+    """
+    existing = {}
+    pks = itertools.count(100)
+    objects = mock.Mock()
+
+    def __init__(self, name, pk=None):
+        self.name = name
+        self.pk = pk
+
+    def natural_key(self):
+        return (self.name,)
+
+    def q(self):
+        return QMock()
+
+
+def bulk_create_content_mock(units, ignore_conflicts=False):
+    """
+    Insert all units whose name is not in `ContentMock.existing`.
+    """
+    inserted = []
+    for unit in units:
+        if unit.name not in ContentMock.existing:
+            unit.pk = next(ContentMock.pks)
+            inserted.append(unit)
+    return inserted
+
+
+class TestContentSaver(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        ContentMock.objects.reset_mock()
+        ContentMock.existing = {'b': ContentMock('b', pk=1)}
+        ContentMock.objects.filter.return_value = list(ContentMock.existing.values())
+
+    def queue_dc(self, content):
+        da = DeclarativeArtifact(artifact=mock.Mock(), url='http://example.com/',
+                                 relative_path=content.name, remote=mock.Mock())
+        d_content = DeclarativeContent(content=content, d_artifacts=[da])
+        self.in_q.put_nowait(d_content)
+        return d_content
+
+    async def run_stage(self, bulk, **kwargs):
+        module = 'pulpcore.plugin.stages.content_stages'
+        with mock.patch(module + '.ContentArtifact') as content_artifact, \
+                mock.patch(module + '.Q', return_value=QMock()), \
+                mock.patch(module + '.transaction.atomic', atomic_mock), \
+                mock.patch(module + '.bulk_create_content',
+                           wraps=bulk_create_content_mock) as bulk_create_content:
+            self.bulk_create_content = bulk_create_content
+            stage = ContentSaver(bulk=bulk, **kwargs)
+            stage._connect(self.in_q, self.out_q)
+            await stage()
+        return content_artifact
+
+    async def test_bulk_resolves_conflicts_and_duplicates(self):
+        first_a = self.queue_dc(ContentMock('a'))
+        second_a = self.queue_dc(ContentMock('a'))
+        b = self.queue_dc(ContentMock('b'))
+        c = self.queue_dc(ContentMock('c'))
+        self.in_q.put_nowait(None)
+
+        content_artifact = await self.run_stage(bulk=True)
+
+        self.assertIs(first_a.content, second_a.content)
+        self.assertIsNotNone(first_a.content.pk)
+        self.assertIs(b.content, ContentMock.existing['b'])
+        self.assertIsNotNone(c.content.pk)
+        self.assertEqual(self.bulk_create_content.call_count, 1)
+        self.assertEqual(ContentMock.objects.filter.call_count, 1)
+        # ContentArtifacts are only created for newly inserted units
+        self.assertEqual(content_artifact.call_count, 2)
+        self.assertEqual(len(drain_queue(self.out_q)), 5)
+
+    async def test_bulk_fetches_conflicts_missed_by_requery(self):
+        ContentMock.objects.filter.return_value = []
+        ContentMock.objects.get.return_value = ContentMock.existing['b']
+        b = self.queue_dc(ContentMock('b'))
+        self.in_q.put_nowait(None)
+
+        content_artifact = await self.run_stage(bulk=True)
+
+        self.assertIs(b.content, ContentMock.existing['b'])
+        ContentMock.objects.get.assert_called_once()
+        content_artifact.assert_not_called()
+
+    async def test_bulk_without_conflicts(self):
+        self.queue_dc(ContentMock('a'))
+        self.queue_dc(ContentMock('c'))
+        self.in_q.put_nowait(None)
+
+        content_artifact = await self.run_stage(bulk=True)
+
+        self.assertEqual(self.bulk_create_content.call_count, 1)
+        ContentMock.objects.filter.assert_not_called()
+        self.assertEqual(content_artifact.call_count, 2)
+
+    async def test_database_thread(self):
+        """The hooks run on the event loop, and only the batch is saved on the database thread."""
+        self.queue_dc(ContentMock('a'))
+        self.in_q.put_nowait(None)
+        threads = []
+        save_batch = ContentSaver._save_batch
+
+        async def hook(batch):
+            threads.append(threading.get_ident())
+
+        def save_batch_in_thread(stage, batch):
+            threads.append(threading.get_ident())
+            save_batch(stage, batch)
+
+        with mock.patch.object(ContentSaver, '_pre_save', side_effect=hook), \
+                mock.patch.object(ContentSaver, '_post_save', side_effect=hook), \
+                mock.patch.object(ContentSaver, '_save_batch', autospec=True,
+                                  side_effect=save_batch_in_thread):
+            content_artifact = await self.run_stage(bulk=True, database_thread=True)
+
+        pre_save_thread, save_thread, post_save_thread = threads
+        self.assertEqual(pre_save_thread, threading.get_ident())
+        self.assertNotEqual(save_thread, threading.get_ident())
+        self.assertEqual(post_save_thread, threading.get_ident())
+        self.assertEqual(content_artifact.call_count, 1)
+        self.assertEqual(len(drain_queue(self.out_q)), 2)
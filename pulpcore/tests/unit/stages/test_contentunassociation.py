@@ -0,0 +1,36 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import ContentUnassociation
+
+
+class TestContentUnassociation(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        self.new_version = mock.Mock(complete=False)
+
+    async def test_chunks_and_progress(self):
+        queryset = mock.Mock()
+        queryset.values_list.return_value.iterator.return_value = iter(range(2500))
+        self.in_q.put_nowait(queryset)
+        self.in_q.put_nowait(None)
+
+        module = 'pulpcore.plugin.stages.association_stages'
+        with mock.patch(module + '.ProgressBar') as pb, \
+                mock.patch(module + '.Content') as content:
+            pb.return_value.__enter__.return_value.done = 0
+            content.objects.filter.side_effect = lambda **kwargs: kwargs['pk__in']
+            stage = ContentUnassociation(self.new_version, chunk_size=1000)
+            stage._connect(self.in_q, self.out_q)
+            await stage()
+
+        chunks = [call[0][0] for call in self.new_version.remove_content.call_args_list]
+        self.assertEqual([len(chunk) for chunk in chunks], [1000, 1000, 500])
+        self.assertEqual(pb.return_value.__enter__.return_value.done, 2500)
+        self.assertEqual(pb.return_value.__enter__.return_value.save.call_count, 3)
+        queryset.count.assert_not_called()
+        self.assertIs(self.out_q.get_nowait(), queryset)
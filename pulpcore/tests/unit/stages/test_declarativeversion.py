@@ -0,0 +1,172 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from pulpcore.plugin.stages import ArtifactCache, DeclarativeVersion, RemoveDuplicates, Stage
+
+
+class FingerprintedStage(Stage):
+
+    def __init__(self, fingerprint):
+        super().__init__()
+        self._fingerprint = fingerprint
+        self.runs = 0
+
+    async def fingerprint(self):
+        return self._fingerprint
+
+    async def run(self):
+        self.runs += 1
+
+
+@mock.patch('pulpcore.plugin.stages.declarative_version.WorkingDirectory', mock.MagicMock())
+@mock.patch('pulpcore.plugin.stages.declarative_version.RepositoryVersion')
+class TestFingerprint(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repository = mock.Mock(pk=1)
+        self.versions = []
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def tearDown(self):
+        asyncio.get_event_loop().close()
+        self.tmp.cleanup()
+
+    def sync(self, repository_version, first_stage, stages=(), **kwargs):
+        def create(repository):
+            new_version = mock.Mock(number=len(self.versions) + 1)
+            self.versions.append(new_version)
+            context = mock.MagicMock()
+            context.__enter__.return_value = new_version
+            return context
+
+        repository_version.create.side_effect = create
+        latest = repository_version.objects.filter.return_value.order_by.return_value.first
+        latest.side_effect = lambda: self.versions[-1] if self.versions else None
+        version = DeclarativeVersion(first_stage, self.repository, **kwargs)
+        version.pipeline_stages = lambda new_version: [first_stage, *stages]
+
+        async def run_first_stage(stages, **kwargs):
+            await stages[0].run()
+
+        path = os.path.join(self.tmp.name, 'fingerprints', '1.json')
+        with mock.patch.object(version, 'fingerprint_path', return_value=path), \
+                mock.patch('pulpcore.plugin.stages.declarative_version.ContentAssociation') \
+                as self.content_association, \
+                mock.patch('pulpcore.plugin.stages.declarative_version.ContentUnassociation'), \
+                mock.patch('pulpcore.plugin.stages.declarative_version.create_pipeline') as pipe:
+            pipe.side_effect = run_first_stage
+            version.create()
+
+    def test_unchanged_fingerprint_skips_sync(self, repository_version):
+        first_stage = FingerprintedStage('etag-1')
+        self.sync(repository_version, first_stage)
+        self.sync(repository_version, first_stage)
+        self.assertEqual(first_stage.runs, 1)
+        self.assertEqual(len(self.versions), 1)
+
+    def test_changed_fingerprint_syncs(self, repository_version):
+        self.sync(repository_version, FingerprintedStage('etag-1'))
+        first_stage = FingerprintedStage('etag-2')
+        self.sync(repository_version, first_stage)
+        self.assertEqual(first_stage.runs, 1)
+        self.assertEqual(len(self.versions), 2)
+
+    def test_changed_options_sync(self, repository_version):
+        first_stage = FingerprintedStage('etag-1')
+        self.sync(repository_version, first_stage, mirror=False)
+        self.sync(repository_version, first_stage, mirror=True)
+        self.assertEqual(first_stage.runs, 2)
+
+    def test_changed_remote_syncs(self, repository_version):
+        first_stage = FingerprintedStage('etag-1')
+        first_stage.remote = mock.Mock(pk=1, url='http://example.com/a/')
+        self.sync(repository_version, first_stage)
+        first_stage.remote = mock.Mock(pk=1, url='http://example.com/b/')
+        self.sync(repository_version, first_stage)
+        first_stage.remote = mock.Mock(pk=2, url='http://example.com/b/')
+        self.sync(repository_version, first_stage)
+        self.sync(repository_version, first_stage)
+        self.assertEqual(first_stage.runs, 3)
+
+    def test_changed_remove_duplicates_syncs(self, repository_version):
+        model = mock.Mock()
+        model._meta.label = 'file.FileContent'
+        first_stage = FingerprintedStage('etag-1')
+        self.sync(repository_version, first_stage)
+        remove_duplicates = [{'model': model, 'field_names': ['relative_path']}]
+        self.sync(repository_version, first_stage, remove_duplicates=remove_duplicates)
+        self.sync(repository_version, first_stage, remove_duplicates=remove_duplicates)
+        self.assertEqual(first_stage.runs, 2)
+
+    def test_newer_version_syncs(self, repository_version):
+        first_stage = FingerprintedStage('etag-1')
+        self.sync(repository_version, first_stage)
+        self.versions.append(mock.Mock(number=2))
+        self.sync(repository_version, first_stage)
+        self.assertEqual(first_stage.runs, 2)
+
+    def test_no_fingerprint_syncs(self, repository_version):
+        first_stage = FingerprintedStage(None)
+        self.sync(repository_version, first_stage)
+        self.sync(repository_version, first_stage)
+        self.assertEqual(first_stage.runs, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'fingerprints')))
+
+    def test_superseded_duplicates_are_removed_after_the_pipeline(self, repository_version):
+        remove_duplicates = mock.Mock(spec=RemoveDuplicates)
+        self.sync(repository_version, FingerprintedStage(None), stages=[remove_duplicates])
+        remove_duplicates.remove_superseded.assert_called_once_with()
+
+    def test_staging_table_is_passed_to_content_association(self, repository_version):
+        with mock.patch.object(DeclarativeVersion, 'use_staging_table', True):
+            self.sync(repository_version, FingerprintedStage(None))
+        kwargs = self.content_association.call_args[1]
+        self.assertTrue(kwargs['use_staging_table'])
+
+
+class TestContentFirst(TestCase):
+
+    def stage_types(self, stages):
+        return [type(stage).__name__ for stage in stages]
+
+    def test_default_ordering(self):
+        version = DeclarativeVersion(FingerprintedStage(None), mock.Mock())
+        self.assertEqual(self.stage_types(version.pipeline_stages(mock.Mock()))[1:5], [
+            'QueryExistingArtifacts', 'ArtifactDownloader', 'ArtifactSaver',
+            'QueryExistingContents',
+        ])
+
+    def test_content_first_ordering(self):
+        version = DeclarativeVersion(FingerprintedStage(None), mock.Mock())
+        version.content_first = True
+        stages = version.pipeline_stages(mock.Mock())
+        self.assertEqual(self.stage_types(stages)[1:4], [
+            'QueryExistingContents', 'RoutingStage', 'ContentSaver',
+        ])
+        routing = stages[2]
+        self.assertEqual(routing.branches[True], [])
+        self.assertEqual(self.stage_types(routing.branches[False]), [
+            'QueryExistingArtifacts', 'ArtifactDownloader', 'ArtifactSaver',
+        ])
+        self.assertTrue(routing.route(mock.Mock(content=mock.Mock(pk=1))))
+        self.assertFalse(routing.route(mock.Mock(content=mock.Mock(pk=None))))
+
+    def test_artifact_cache_is_opt_in(self):
+        version = DeclarativeVersion(FingerprintedStage(None), mock.Mock())
+        stages = version.pipeline_stages(mock.Mock())
+        self.assertIsNone(stages[1].artifact_cache)
+        self.assertIsNone(stages[3].artifact_cache)
+
+    def test_artifact_cache_is_made_per_sync(self):
+        version = DeclarativeVersion(FingerprintedStage(None), mock.Mock())
+        version.use_artifact_cache = True
+        stages = version.pipeline_stages(mock.Mock())
+        self.assertIsInstance(stages[1].artifact_cache, ArtifactCache)
+        self.assertIs(stages[3].artifact_cache, stages[1].artifact_cache)
+        next_stages = version.pipeline_stages(mock.Mock())
+        self.assertIsNot(next_stages[1].artifact_cache, stages[1].artifact_cache)
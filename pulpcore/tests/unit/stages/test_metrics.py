@@ -0,0 +1,116 @@
+import asyncio
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+import asynctest
+from django.test import override_settings
+
+from pulpcore.plugin import metrics
+from pulpcore.plugin.stages import create_pipeline, DeclarativeContent, EndStage, Stage
+
+
+class TestMetricsRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_export(self):
+        counter = self.registry.counter('test_items', 'Items "seen".', ['stage'])
+        counter.labels('a\nb').inc(3)
+        histogram = self.registry.histogram('test_size', 'Sizes.', buckets=(1, 10))
+        for value in (1, 5, 50):
+            histogram.labels().observe(value)
+        gauge = self.registry.gauge('test_depth', 'Depth.')
+        self.registry.add_collector(lambda: gauge.labels().set(7))
+
+        self.assertEqual(self.registry.export(), '\n'.join([
+            '# TYPE test_depth gauge',
+            '# HELP test_depth Depth.',
+            'test_depth 7',
+            '# TYPE test_items counter',
+            '# HELP test_items Items \\"seen\\".',
+            'test_items_total{stage="a\\nb"} 3',
+            '# TYPE test_size histogram',
+            '# HELP test_size Sizes.',
+            'test_size_bucket{le="1"} 1',
+            'test_size_bucket{le="10"} 2',
+            'test_size_bucket{le="+Inf"} 3',
+            'test_size_count 3',
+            'test_size_sum 56',
+            '# EOF',
+        ]) + '\n')
+
+    def test_duplicate_name(self):
+        self.registry.counter('test_items', 'Items.')
+        with self.assertRaises(ValueError):
+            self.registry.gauge('test_items', 'Items.')
+
+    def test_wrong_label_count(self):
+        counter = self.registry.counter('test_items', 'Items.', ['stage'])
+        with self.assertRaises(ValueError):
+            counter.labels()
+
+    def test_write_textfile(self):
+        self.registry.counter('test_items', 'Items.').labels().inc()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics-{pid}.prom')
+            self.registry.write_textfile(path)
+            with open(path.format(pid=os.getpid())) as textfile:
+                self.assertEqual(textfile.read(), self.registry.export())
+
+    def test_overhead(self):
+        """Regression benchmark: counting an item must stay well under the cost of a queue put."""
+        counter = self.registry.counter('test_items', 'Items.', ['stage']).labels('stage')
+        histogram = self.registry.histogram('test_size', 'Sizes.', ['stage']).labels('stage')
+        start = time.perf_counter()
+        for _ in range(100000):
+            counter.inc()
+            histogram.observe(10)
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+
+class BatchingStage(Stage):
+
+    async def run(self):
+        async for batch in self.batches(minsize=1, maxsize=2):
+            await self.put_many(batch)
+
+
+class TestStageMetrics(asynctest.TestCase):
+
+    async def test_items_batches_and_queue_depths(self):
+        label = metrics.stage_label(BatchingStage())
+        items = metrics.stage_items.labels(label)
+        batch_sizes = metrics.stage_batch_size.labels(label)
+        items_before = items.value
+        batches_before = sum(batch_sizes.counts)
+        in_q = asyncio.Queue()
+        for _ in range(5):
+            in_q.put_nowait(DeclarativeContent(content=object()))
+        in_q.put_nowait(None)
+        out_q = asyncio.Queue()
+        stage = BatchingStage()
+        stage._connect(in_q, out_q)
+        metrics.track_queue(in_q, stage)
+
+        metrics.registry.export()
+        self.assertEqual(metrics.stage_queue_depth.labels(label).value, 6)
+        await stage()
+        metrics.registry.export()
+        self.assertEqual(metrics.stage_queue_depth.labels(label).value, 0)
+        self.assertEqual(items.value - items_before, 5)
+        self.assertEqual(sum(batch_sizes.counts) - batches_before, 3)
+
+    async def test_pipeline_writes_textfile(self):
+        class FirstStage(Stage):
+            async def run(self):
+                await self.put(DeclarativeContent(content=object()))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.prom')
+            with override_settings(METRICS_TEXTFILE=path):
+                await create_pipeline([FirstStage(), EndStage()])
+            with open(path) as textfile:
+                self.assertIn('pulp_stage_items_total{stage=', textfile.read())
@@ -0,0 +1,158 @@
+import asyncio
+import functools
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+import asynctest
+import mock
+from django.db import connection
+from django.test import override_settings
+
+from pulpcore.plugin.stages import DeclarativeContent, profiler, Stage
+from pulpcore.plugin.stages.profiler import ProfilingQueue
+
+
+class TestProfilingQueue(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.conn = profiler.create_profile_db_and_connection(os.path.join(self.tmp.name, 'db'))
+
+    def tearDown(self):
+        profiler.close_profile_db()
+        self.tmp.cleanup()
+
+    def pass_items(self, count):
+        """
+        Pass `count` items through two queues, as a stage between them would.
+        """
+        first = ProfilingQueue.make_and_record_queue(object(), 1, maxsize=0)
+        second = ProfilingQueue.make_and_record_queue(object(), 2, maxsize=0)
+        for _ in range(count):
+            first.put_nowait(DeclarativeContent(content=object()))
+        for _ in range(count):
+            second.put_nowait(first.get_nowait())
+        return first, second
+
+    def test_rows_are_written_on_flush(self):
+        first, second = self.pass_items(10)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM system').fetchone(), (0,))
+
+        profiler.flush_profile_db()
+
+        stages = self.conn.execute('SELECT uuid, num FROM stages ORDER BY num').fetchall()
+        self.assertEqual(stages, [(str(first.stage_uuid), 1), (str(second.stage_uuid), 2)])
+        traffic = self.conn.execute('SELECT uuid, waiting_time, service_time FROM traffic')
+        rows = traffic.fetchall()
+        self.assertEqual(len(rows), 10)
+        for stage_uuid, waiting_time, service_time in rows:
+            self.assertEqual(stage_uuid, str(first.stage_uuid))
+            self.assertGreaterEqual(waiting_time, 0)
+            self.assertGreaterEqual(service_time, 0)
+        system = self.conn.execute('SELECT uuid, COUNT(*) FROM system GROUP BY uuid')
+        self.assertEqual(dict(system), {str(first.stage_uuid): 10, str(second.stage_uuid): 10})
+
+    def test_rows_are_written_by_thread(self):
+        profiler.WRITER.interval = 0.01
+        self.pass_items(1)
+        deadline = time.monotonic() + 5
+        while self.conn.execute('SELECT COUNT(*) FROM traffic').fetchone() == (0,):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_full_buffer_overwrites_oldest_rows(self):
+        writer = profiler.ProfileWriter(self.conn, interval=60, buffer_size=2)
+        for length in range(3):
+            writer.record('system', ('uuid', length, 0.0))
+        writer.close()
+        lengths = self.conn.execute("SELECT length FROM system WHERE uuid = 'uuid'")
+        self.assertEqual([length for length, in lengths], [1, 2])
+        dropped = self.conn.execute('SELECT name, count FROM dropped_rows').fetchall()
+        self.assertEqual(dropped, [('system', 1)])
+
+    def test_samples_are_buffered_in_bounded_memory(self):
+        writer = profiler.ProfileWriter(self.conn, interval=60, buffer_size=1000)
+        with mock.patch.object(profiler, 'WRITER', writer):
+            queue = ProfilingQueue.make_and_record_queue(object(), 1, maxsize=0)
+            for _ in range(10000):
+                queue.put_nowait(DeclarativeContent(content=object()))
+        self.assertEqual(len(writer._buffers['system']), 1000)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM system').fetchone(), (0,))
+
+        writer.close()
+        lengths = self.conn.execute('SELECT length FROM system WHERE uuid = ?',
+                                    (str(queue.stage_uuid),))
+        self.assertEqual([length for length, in lengths], list(range(9000, 10000)))
+        self.assertEqual(writer.dropped['system'], 9000)
+        dropped = self.conn.execute('SELECT name, count FROM dropped_rows').fetchall()
+        self.assertEqual(dropped, [('system', 9000)])
+
+
+def execute_query():
+    """
+    Run a query through the execute wrappers of the connection, as a Django cursor would.
+    """
+    execute = lambda sql, params, many, context: None  # noqa
+    for wrapper in reversed(connection.execute_wrappers):
+        execute = functools.partial(wrapper, execute)
+    execute('SELECT 1', None, False, {})
+
+
+class QueryingStage(Stage):
+    """
+    A stage running `queries` queries per batch, letting other stages run in between.
+    """
+
+    def __init__(self, queries, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = queries
+
+    def query(self):
+        for _ in range(self.queries):
+            execute_query()
+
+    async def run(self):
+        async for batch in self.batches(minsize=1, maxsize=2):
+            for _ in range(self.queries):
+                execute_query()
+                await asyncio.sleep(0)
+            await self.run_database(self.query)
+
+
+class TestBatchQueries(asynctest.TestCase):
+
+    def setUp(self):
+        profiling = override_settings(PROFILE_STAGES_API=True)
+        profiling.enable()
+        self.addCleanup(profiling.disable)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.conn = profiler.create_profile_db_and_connection(os.path.join(self.tmp.name, 'db'))
+
+    def tearDown(self):
+        profiler.close_profile_db()
+        self.tmp.cleanup()
+
+    async def test_queries_are_counted_per_stage_and_batch(self):
+        stages = [QueryingStage(1), QueryingStage(2, database_thread=True)]
+        for stage in stages:
+            in_q = ProfilingQueue.make_and_record_queue(stage, 1, maxsize=0)
+            for _ in range(4):
+                in_q.put_nowait(DeclarativeContent(content=object()))
+            in_q.put_nowait(None)
+            stage._connect(in_q, asyncio.Queue())
+        await asyncio.gather(*[stage() for stage in stages])
+        self.assertEqual(connection.execute_wrappers, [])
+
+        profiler.flush_profile_db()
+        rows = self.conn.execute(
+            'SELECT uuid, size, queries, db_time FROM batch_queries ORDER BY queries'
+        ).fetchall()
+        self.assertEqual(len(rows), 4)
+        expected_stages = [stages[0]] * 2 + [stages[1]] * 2
+        for (stage_uuid, size, queries, db_time), stage in zip(rows, expected_stages):
+            self.assertEqual(stage_uuid, str(stage._in_q.stage_uuid))
+            self.assertEqual(size, 2)
+            self.assertEqual(queries, 2 * stage.queries)
+            self.assertGreaterEqual(db_time, 0)
@@ -0,0 +1,125 @@
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from pulpcore.plugin import profile_report
+from pulpcore.plugin.stages import profiler
+
+
+class TestProfileReport(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def make_profile(self, name, queues):
+        """
+        Write a profile db of a pipeline whose stages are fed by queues of constant behavior.
+
+        Args:
+            name (str): The file name of the db.
+            queues (list): One (length, interarrival time, waiting time, service time) tuple per
+                stage, in pipeline order. A waiting time of None records no traffic.
+        """
+        db_path = os.path.join(self.tmp.name, name)
+        profiler.create_profile_db_and_connection(db_path)
+        for num, (length, interarrival, waiting, service) in enumerate(queues, 1):
+            uuid = 'stage-{num}'.format(num=num)
+            profiler.WRITER.record('stages', (uuid, 'Stage{num}'.format(num=num), num))
+            for _ in range(100):
+                profiler.WRITER.record('system', (uuid, length, interarrival))
+                if waiting is not None:
+                    profiler.WRITER.record('traffic', (uuid, waiting, service))
+        profiler.close_profile_db()
+        return db_path
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(profile_report.percentile(values, 0.5), 50)
+        self.assertEqual(profile_report.percentile(values, 0.99), 99)
+        self.assertEqual(profile_report.percentile([3], 0.95), 3)
+        self.assertIsNone(profile_report.percentile([], 0.5))
+
+    def test_stage_statistics(self):
+        db_path = self.make_profile('db', [(5, 0.01, 0.05, 0.02)])
+        stage, = profile_report.analyze([db_path])['stages']
+        self.assertEqual((stage['num'], stage['name']), (1, 'Stage1'))
+        self.assertEqual(stage['items'], 100)
+        self.assertAlmostEqual(stage['duration'], 1.0)
+        self.assertAlmostEqual(stage['arrival_rate'], 100.0)
+        self.assertAlmostEqual(stage['utilization'], 2.0)
+        self.assertAlmostEqual(stage['waiting_time']['p95'], 0.05)
+        self.assertEqual(stage['queue_length']['p99'], 5)
+        self.assertAlmostEqual(stage['little_queue_length'], 5.0)
+        self.assertTrue(stage['little_consistent'])
+
+    def test_inconsistent_queue(self):
+        db_path = self.make_profile('db', [(50, 0.01, 0.05, 0.02)])
+        stage, = profile_report.analyze([db_path])['stages']
+        self.assertFalse(stage['little_consistent'])
+
+    def test_bottleneck_is_last_stage_with_long_queue(self):
+        """Stages upstream of the bottleneck are blocked by its full queue, so look as busy."""
+        db_path = self.make_profile('db', [
+            (10, 0.01, 0.1, 0.01),
+            (10, 0.01, 0.1, 0.01),
+            (0, 0.01, 0.0, 0.001),
+            (0, 0.01, None, None),
+        ])
+        report = profile_report.analyze([db_path])
+        self.assertEqual(report['bottleneck'], 'Stage2')
+        self.assertIsNone(report['stages'][3]['waiting_time']['mean'])
+
+    def test_profiles_are_merged(self):
+        db_paths = [self.make_profile(name, [(1, 0.01, 0.01, 0.01)]) for name in ('a', 'b')]
+        stage, = profile_report.analyze(db_paths)['stages']
+        self.assertEqual(stage['arrivals'], 200)
+        self.assertAlmostEqual(stage['duration'], 2.0)
+
+    def test_batch_queries(self):
+        db_path = self.make_profile('db', [(1, 0.01, 0.01, 0.01)])
+        conn = sqlite3.connect(db_path)
+        conn.executemany(profiler.INSERTS['batch_queries'], [
+            ('stage-1', 10, 11, 0.5, 1.0),
+            ('stage-1', 10, 31, 1.5, 3.0),
+        ])
+        conn.commit()
+        conn.close()
+        stage, = profile_report.analyze([db_path])['stages']
+        self.assertEqual(stage['batch_queries']['batches'], 2)
+        self.assertAlmostEqual(stage['batch_queries']['queries_per_item'], 2.1)
+        self.assertAlmostEqual(stage['batch_queries']['db_time_share'], 0.5)
+        self.assertIn('2.10 queries/item', profile_report.format_report(
+            profile_report.analyze([db_path])))
+
+    def test_dropped_rows(self):
+        db_paths = [self.make_profile(name, [(1, 0.01, 0.01, 0.01)]) for name in ('a', 'b')]
+        for db_path in db_paths:
+            conn = sqlite3.connect(db_path)
+            conn.execute(profiler.DROPPED_ROWS_INSERT, ('traffic', 5))
+            conn.commit()
+            conn.close()
+        report = profile_report.analyze(db_paths)
+        self.assertEqual(report['dropped_rows'], {'traffic': 10})
+        self.assertIn('the profiler dropped 10 rows of the traffic table',
+                      profile_report.format_report(report))
+
+        report = profile_report.analyze([self.make_profile('c', [(1, 0.01, 0.01, 0.01)])])
+        self.assertEqual(report['dropped_rows'], {})
+        self.assertNotIn('dropped', profile_report.format_report(report))
+
+    def test_main(self):
+        db_path = self.make_profile('db', [(1, 0.01, 0.01, 0.01), (0, 0.01, None, None)])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            profile_report.main([db_path, '--json'])
+        self.assertEqual(json.loads(output.getvalue())['bottleneck'], 'Stage1')
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            profile_report.main([db_path])
+        self.assertIn('Bottleneck: Stage1', output.getvalue())
@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import (
+    ArtifactBloomFilter,
+    ArtifactCache,
+    DeclarativeArtifact,
+    DeclarativeContent,
+)
+from pulpcore.plugin.stages.artifact_stages import QueryExistingArtifacts
+
+from . import ArtifactMock, drain_queue, QMock
+
+
+class TestQueryExistingArtifacts(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+
+    def queue_dc(self, artifact):
+        da = DeclarativeArtifact(artifact=artifact, url='http://example.com/',
+                                 relative_path='path', remote=mock.Mock())
+        self.in_q.put_nowait(DeclarativeContent(content=mock.Mock(), d_artifacts=[da]))
+        return da
+
+    async def run_stage(self, existing, artifact_cache=None, bloom_filter=None):
+        with mock.patch('pulpcore.plugin.stages.artifact_stages.Artifact') as artifact_model, \
+                mock.patch('pulpcore.plugin.stages.artifact_stages.Q', return_value=QMock()):
+            artifact_model.objects.filter.return_value = existing
+            stage = QueryExistingArtifacts(artifact_cache=artifact_cache,
+                                           bloom_filter=bloom_filter)
+            stage._connect(self.in_q, self.out_q)
+            await stage()
+        return artifact_model.objects.filter
+
+    async def test_matches_by_any_digest(self):
+        by_sha256 = ArtifactMock(pk=1, sha256='a', md5='x')
+        by_md5 = ArtifactMock(pk=2, sha256='b', md5='y')
+        da_sha256 = self.queue_dc(ArtifactMock(sha256='a'))
+        da_md5 = self.queue_dc(ArtifactMock(md5='y'))
+        da_new = self.queue_dc(ArtifactMock(sha256='c'))
+        self.in_q.put_nowait(None)
+
+        await self.run_stage([by_sha256, by_md5])
+
+        self.assertIs(da_sha256.artifact, by_sha256)
+        self.assertIs(da_md5.artifact, by_md5)
+        self.assertIsNone(da_new.artifact.pk)
+        self.assertEqual(len(drain_queue(self.out_q)), 4)
+
+    async def test_saved_artifacts_are_not_queried(self):
+        saved = ArtifactMock(pk=1, sha256='a')
+        self.queue_dc(saved)
+        self.in_q.put_nowait(None)
+
+        artifact_filter = await self.run_stage([])
+
+        artifact_filter.assert_not_called()
+
+    async def test_cached_artifacts_are_not_queried(self):
+        cached = ArtifactMock(pk=1, sha256='a')
+        artifact_cache = ArtifactCache()
+        artifact_cache.add([cached])
+        da = self.queue_dc(ArtifactMock(sha256='a'))
+        self.in_q.put_nowait(None)
+
+        artifact_filter = await self.run_stage([], artifact_cache=artifact_cache)
+
+        artifact_filter.assert_not_called()
+        self.assertIs(da.artifact, cached)
+        self.assertEqual((artifact_cache.hits, artifact_cache.misses), (1, 0))
+
+    async def test_queried_artifacts_are_cached(self):
+        existing = ArtifactMock(pk=1, sha256='a')
+        artifact_cache = ArtifactCache()
+        self.queue_dc(ArtifactMock(sha256='a'))
+        self.in_q.put_nowait(None)
+
+        await self.run_stage([existing], artifact_cache=artifact_cache)
+
+        self.assertIs(artifact_cache.get(ArtifactMock(sha256='a')), existing)
+        self.assertEqual((artifact_cache.hits, artifact_cache.misses), (1, 1))
+
+    async def test_filtered_artifacts_are_not_queried(self):
+        bloom_filter = ArtifactBloomFilter(1000)
+        bloom_filter.add('a' * 64)
+        da_absent = self.queue_dc(ArtifactMock(sha256='b' * 64))
+        self.in_q.put_nowait(None)
+
+        artifact_filter = await self.run_stage([], bloom_filter=bloom_filter)
+
+        artifact_filter.assert_not_called()
+        self.assertIsNone(da_absent.artifact.pk)
+        self.assertEqual(bloom_filter.negatives, 1)
+
+    async def test_false_positives_are_recorded(self):
+        existing = ArtifactMock(pk=1, sha256='a' * 64)
+        bloom_filter = ArtifactBloomFilter(1000)
+        bloom_filter.update(['a' * 64, 'c' * 64])
+        da_present = self.queue_dc(ArtifactMock(sha256='a' * 64))
+        self.queue_dc(ArtifactMock(sha256='c' * 64))
+        self.in_q.put_nowait(None)
+
+        await self.run_stage([existing], bloom_filter=bloom_filter)
+
+        self.assertIs(da_present.artifact, existing)
+        self.assertEqual(bloom_filter.false_positives, 1)
+
+    async def test_large_batch(self):
+        """Regression benchmark: a 10k item batch must be matched in linear time."""
+        num = 10000
+        existing = [ArtifactMock(pk=i, sha256=str(i)) for i in range(0, num, 2)]
+        d_artifacts = [self.queue_dc(ArtifactMock(sha256=str(i))) for i in range(num)]
+        self.in_q.put_nowait(None)
+
+        start = time.monotonic()
+        await self.run_stage(existing)
+        elapsed = time.monotonic() - start
+
+        for i, d_artifact in enumerate(d_artifacts):
+            if i % 2:
+                self.assertIsNone(d_artifact.artifact.pk)
+            else:
+                self.assertEqual(d_artifact.artifact.pk, i)
+        self.assertLess(elapsed, 5)
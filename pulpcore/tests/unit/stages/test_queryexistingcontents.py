@@ -0,0 +1,83 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import DeclarativeContent
+from pulpcore.plugin.stages.content_stages import QueryExistingContents
+
+from . import drain_queue, QMock
+
+
+class ContentMock:
+    """
+    A minimal stand-in for a Content model keyed on `name` and `version`.
+    """
+
+    def __init__(self, name, version, pk=None):
+        self.name = name
+        self.version = version
+        self.pk = pk
+
+    def natural_key(self):
+        return (self.name, self.version)
+
+    def q(self):
+        return QMock()
+
+
+class FooContent(ContentMock):
+    objects = mock.Mock()
+
+
+class BarContent(ContentMock):
+    objects = mock.Mock()
+
+
+class TestQueryExistingContents(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        FooContent.objects.reset_mock()
+        BarContent.objects.reset_mock()
+
+    def queue_dc(self, content):
+        d_content = DeclarativeContent(content=content)
+        self.in_q.put_nowait(d_content)
+        return d_content
+
+    async def run_stage(self):
+        with mock.patch('pulpcore.plugin.stages.content_stages.Q', return_value=QMock()):
+            stage = QueryExistingContents()
+            stage._connect(self.in_q, self.out_q)
+            await stage()
+
+    async def test_shared_natural_keys_resolve_together(self):
+        existing = FooContent('foo', '1.0', pk=1)
+        FooContent.objects.filter.return_value = [existing]
+        BarContent.objects.filter.return_value = []
+        first = self.queue_dc(FooContent('foo', '1.0'))
+        second = self.queue_dc(FooContent('foo', '1.0'))
+        other_version = self.queue_dc(FooContent('foo', '2.0'))
+        other_type = self.queue_dc(BarContent('foo', '1.0'))
+        self.in_q.put_nowait(None)
+
+        await self.run_stage()
+
+        self.assertIs(first.content, existing)
+        self.assertIs(second.content, existing)
+        self.assertIsNone(other_version.content.pk)
+        self.assertIsNone(other_type.content.pk)
+        self.assertEqual(FooContent.objects.filter.call_count, 1)
+        self.assertEqual(BarContent.objects.filter.call_count, 1)
+        self.assertEqual(len(drain_queue(self.out_q)), 5)
+
+    async def test_saved_content_is_not_queried(self):
+        saved = self.queue_dc(FooContent('foo', '1.0', pk=1))
+        self.in_q.put_nowait(None)
+
+        await self.run_stage()
+
+        FooContent.objects.filter.assert_not_called()
+        self.assertEqual(saved.content.pk, 1)
@@ -0,0 +1,92 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import (
+    DeclarativeArtifact,
+    DeclarativeContent,
+    estimate_size,
+    ItemBatch,
+    WeightedQueue,
+)
+from pulpcore.plugin.stages.queues import make_queue_like
+
+
+class TestWeightedQueue(asynctest.TestCase):
+
+    async def test_bounded_by_weight(self):
+        queue = WeightedQueue(maxweight=10, weigh=len)
+        queue.put_nowait('aaaa')
+        queue.put_nowait('bbbbbb')
+        self.assertTrue(queue.full())
+        with self.assertRaises(asyncio.QueueFull):
+            queue.put_nowait('c')
+        self.assertEqual(queue.get_nowait(), 'aaaa')
+        self.assertEqual(queue.weight, 6)
+        self.assertFalse(queue.full())
+
+    async def test_empty_queue_accepts_heavy_item(self):
+        queue = WeightedQueue(maxweight=10, weigh=len)
+        queue.put_nowait('a' * 100)
+        self.assertTrue(queue.full())
+        queue.get_nowait()
+        self.assertEqual(queue.weight, 0)
+
+    async def test_bounded_by_maxsize(self):
+        queue = WeightedQueue(maxsize=1, maxweight=10, weigh=len)
+        queue.put_nowait('a')
+        self.assertTrue(queue.full())
+
+    async def test_maxsize_counts_list_items(self):
+        queue = WeightedQueue(maxsize=10)
+        queue.put_nowait(ItemBatch(range(6)))
+        self.assertFalse(queue.full())
+        queue.put_nowait(ItemBatch(range(6)))
+        self.assertTrue(queue.full())
+        self.assertEqual(queue.length, 12)
+        queue.get_nowait()
+        self.assertEqual(queue.length, 6)
+        self.assertFalse(queue.full())
+
+    async def test_empty_queue_accepts_long_list(self):
+        queue = WeightedQueue(maxsize=10)
+        queue.put_nowait(ItemBatch(range(100)))
+        self.assertTrue(queue.full())
+
+    async def test_end_marker_is_weightless(self):
+        queue = WeightedQueue(maxweight=10, weigh=len)
+        queue.put_nowait(None)
+        self.assertEqual(queue.weight, 0)
+        self.assertIsNone(queue.get_nowait())
+
+    async def test_put_waits_for_weight(self):
+        queue = WeightedQueue(maxweight=10, weigh=len)
+        queue.put_nowait('a' * 10)
+        put = asyncio.ensure_future(queue.put('b'))
+        await asyncio.sleep(0)
+        self.assertFalse(put.done())
+        queue.get_nowait()
+        await put
+        self.assertEqual(queue.weight, 1)
+
+    def test_make_queue_like(self):
+        queue = make_queue_like(WeightedQueue(maxsize=3, maxweight=10, weigh=len))
+        self.assertEqual((queue.maxsize, queue.maxweight, queue.weigh), (3, 10, len))
+        queue = make_queue_like(asyncio.Queue(maxsize=3))
+        self.assertNotIsInstance(queue, WeightedQueue)
+        self.assertEqual(queue.maxsize, 3)
+
+
+class TestEstimateSize(asynctest.TestCase):
+
+    def test_declarative_content(self):
+        small = DeclarativeContent(content=mock.Mock())
+        large = DeclarativeContent(
+            content=mock.Mock(),
+            d_artifacts=[DeclarativeArtifact(mock.Mock(), 'url', 'path', mock.Mock())],
+            extra_data={'metadata': 'x' * 10000},
+        )
+        self.assertGreater(estimate_size(large), estimate_size(small) + 10000)
+        self.assertEqual(estimate_size(ItemBatch([small, large])),
+                         estimate_size(small) + estimate_size(large))
@@ -0,0 +1,125 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import DeclarativeContent, RemoveDuplicates
+
+from . import drain_queue
+
+
+class FileMock:
+    """
+    A minimal stand-in for a Content model with a `relative_path` field.
+    """
+    objects = mock.MagicMock()
+    _meta = mock.Mock(**{'get_field.return_value.attname': 'relative_path'})
+
+    def __init__(self, relative_path, pk):
+        self.relative_path = relative_path
+        self.pk = pk
+
+
+class TestRemoveDuplicates(asynctest.TestCase):
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+        self.new_version = mock.Mock()
+        FileMock.objects.reset_mock()
+        # (pk, relative_path) of the units in the new version
+        rows = [(1, 'a'), (2, 'b'), (3, 'c')]
+        FileMock.objects.filter.return_value.values_list.return_value.iterator.return_value = rows
+
+    async def run_stage(self, *contents):
+        for content in contents:
+            self.in_q.put_nowait(DeclarativeContent(content=content))
+        self.in_q.put_nowait(None)
+        stage = RemoveDuplicates(self.new_version, FileMock, ['relative_path'])
+        stage._connect(self.in_q, self.out_q)
+        await stage()
+
+    def removed_pks(self):
+        removed = []
+        for call in FileMock.objects.filter.call_args_list[1:]:
+            removed.append(call[1]['pk__in'])
+        return removed
+
+    async def test_removes_only_replaced_units(self):
+        await self.run_stage(
+            FileMock('a', pk=1), FileMock('b', pk=20), FileMock('d', pk=40), FileMock('c', pk=30)
+        )
+
+        self.assertEqual(self.removed_pks(), [{2, 3}])
+        self.assertEqual(self.new_version.remove_content.call_count, 1)
+        self.assertEqual(len(drain_queue(self.out_q)), 5)
+
+    async def test_later_units_replace_earlier_ones(self):
+        await self.run_stage(FileMock('d', pk=40), FileMock('d', pk=41))
+
+        self.assertEqual(self.removed_pks(), [{40}])
+
+    async def test_no_duplicates(self):
+        await self.run_stage(FileMock('d', pk=40), mock.Mock(pk=50))
+
+        self.new_version.remove_content.assert_not_called()
+        self.assertEqual(len(drain_queue(self.out_q)), 3)
+
+
+class VersionMock:
+    """
+    A stand-in for a RepositoryVersion keeping the primary keys of its content.
+    """
+
+    def __init__(self, pks):
+        self.content = set(pks)
+
+    def add_content(self, queryset):
+        self.content |= set(queryset.pks)
+
+    def remove_content(self, queryset):
+        self.content -= set(queryset.pks)
+
+
+class TestRemoveSuperseded(asynctest.TestCase):
+
+    def setUp(self):
+        self.new_version = VersionMock([1, 2])
+        FileMock.objects.reset_mock()
+
+        def filter(pk__in):
+            queryset = mock.MagicMock(pks=pk__in)
+            rows = [(1, 'a'), (2, 'b')]
+            queryset.values_list.return_value.iterator.return_value = rows
+            return queryset
+
+        FileMock.objects.filter.side_effect = filter
+        self.addCleanup(setattr, FileMock.objects.filter, 'side_effect', None)
+
+    async def run_stage(self, *contents):
+        in_q, out_q = asyncio.Queue(), asyncio.Queue()
+        for content in contents:
+            in_q.put_nowait(DeclarativeContent(content=content))
+        in_q.put_nowait(None)
+        stage = RemoveDuplicates(self.new_version, FileMock, ['relative_path'])
+        stage._connect(in_q, out_q)
+        await stage()
+        return stage
+
+    async def test_duplicate_before_association(self):
+        stage = await self.run_stage(FileMock('d', pk=40), FileMock('d', pk=41))
+        # Both units are associated after the stage removed the first one
+        self.new_version.content |= {40, 41}
+
+        stage.remove_superseded()
+
+        self.assertEqual(self.new_version.content, {1, 2, 41})
+
+    async def test_replaced_unit_coming_again(self):
+        stage = await self.run_stage(FileMock('a', pk=10), FileMock('a', pk=1))
+        self.assertEqual(self.new_version.content, {2})
+        self.new_version.content |= {10}
+
+        stage.remove_superseded()
+
+        self.assertEqual(self.new_version.content, {1, 2})
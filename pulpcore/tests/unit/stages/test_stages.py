@@ -1,9 +1,28 @@
 import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import asynctest
 import mock
 
-from pulpcore.plugin.stages import Stage, EndStage
+from pulpcore.plugin import metrics
+from pulpcore.plugin.stages import (
+    BatchSizeController,
+    create_pipeline,
+    DeclarativeContent,
+    EndStage,
+    estimate_size,
+    ItemBatch,
+    ProcessPoolStage,
+    ReplicatedStage,
+    RoutingStage,
+    Stage,
+    WeightedQueue,
+)
+
+from . import drain_queue
 
 
 class TestStage(asynctest.TestCase):
@@ -57,6 +76,561 @@ class TestStage(asynctest.TestCase):
         with self.assertRaises(StopAsyncIteration):
             await batch_it.__anext__()
 
+    async def test_maxsize(self):
+        contents = [mock.Mock(does_batch=True) for i in range(5)]
+        for c in contents:
+            self.in_q.put_nowait(c)
+        self.in_q.put_nowait(None)
+        batch_it = self.stage.batches(minsize=1, maxsize=2)
+        self.assertEqual(contents[0:2], await batch_it.__anext__())
+        self.assertEqual(contents[2:4], await batch_it.__anext__())
+        self.assertEqual(contents[4:5], await batch_it.__anext__())
+        with self.assertRaises(StopAsyncIteration):
+            await batch_it.__anext__()
+
+    async def test_max_wait(self):
+        c1 = mock.Mock(does_batch=True)
+        c2 = mock.Mock(does_batch=True)
+        self.in_q.put_nowait(c1)
+        batch_it = self.stage.batches(minsize=10, max_wait=0.01)
+        self.assertEqual([c1], await batch_it.__anext__())
+        self.in_q.put_nowait(c2)
+        self.in_q.put_nowait(None)
+        self.assertEqual([c2], await batch_it.__anext__())
+        with self.assertRaises(StopAsyncIteration):
+            await batch_it.__anext__()
+
+    async def test_stage_defaults(self):
+        stage = Stage(batch_minsize=1, batch_maxsize=2)
+        stage._connect(self.in_q, None)
+        contents = [mock.Mock(does_batch=True) for i in range(3)]
+        for c in contents:
+            self.in_q.put_nowait(c)
+        self.in_q.put_nowait(None)
+        batch_it = stage.batches()
+        self.assertEqual(contents[0:2], await batch_it.__anext__())
+        self.assertEqual(contents[2:3], await batch_it.__anext__())
+        with self.assertRaises(StopAsyncIteration):
+            await batch_it.__anext__()
+
+    async def test_put_many(self):
+        out_q = asyncio.Queue()
+        self.stage._connect(self.in_q, out_q)
+        contents = [mock.Mock(does_batch=True) for i in range(3)]
+        await self.stage.put_many(contents)
+        await self.stage.put_many(contents[:1])
+        await self.stage.put_many([])
+        self.assertEqual(out_q.qsize(), 2)
+        self.assertEqual(out_q.get_nowait(), contents)
+        self.assertIs(out_q.get_nowait(), contents[0])
+        with self.assertRaises(ValueError):
+            await self.stage.put_many([None])
+
+    async def test_items_unpacks_put_many(self):
+        contents = [mock.Mock(does_batch=True) for i in range(3)]
+        self.in_q.put_nowait(ItemBatch(contents[:2]))
+        self.in_q.put_nowait(contents[2])
+        self.in_q.put_nowait(None)
+        self.assertEqual([c async for c in self.stage.items()], contents)
+
+    async def test_batches_split_put_many(self):
+        contents = [mock.Mock(does_batch=True) for i in range(5)]
+        self.in_q.put_nowait(ItemBatch(contents))
+        self.in_q.put_nowait(None)
+        batch_it = self.stage.batches(minsize=1, maxsize=2)
+        self.assertEqual(contents[0:2], await batch_it.__anext__())
+        self.assertEqual(contents[2:4], await batch_it.__anext__())
+        self.assertEqual(contents[4:5], await batch_it.__anext__())
+        with self.assertRaises(StopAsyncIteration):
+            await batch_it.__anext__()
+
+    async def test_controller(self):
+        controller = mock.Mock(size=2)
+        contents = [mock.Mock(does_batch=True) for i in range(6)]
+        for c in contents:
+            self.in_q.put_nowait(c)
+        self.in_q.put_nowait(None)
+        batch_it = self.stage.batches(minsize=50, controller=controller)
+        self.assertEqual(contents[0:2], await batch_it.__anext__())
+        controller.size = 3
+        self.assertEqual(contents[2:5], await batch_it.__anext__())
+        self.assertEqual(contents[5:6], await batch_it.__anext__())
+        with self.assertRaises(StopAsyncIteration):
+            await batch_it.__anext__()
+        recorded_sizes = [call[0][0] for call in controller.record.call_args_list]
+        self.assertEqual(recorded_sizes, [2, 3, 1])
+
+    async def test_stage_without_init(self):
+        """Plugin stages not calling `Stage.__init__()` get the default batching."""
+        class PluginStage(Stage):
+            def __init__(self):
+                pass
+
+            async def run(self):
+                async for batch in self.batches():
+                    await self.put_many(await self.run_database(list, batch))
+
+        contents = [mock.Mock(does_batch=True) for _ in range(3)]
+        for content in contents:
+            self.in_q.put_nowait(content)
+        self.in_q.put_nowait(None)
+        out_q = asyncio.Queue()
+        stage = PluginStage()
+        stage._connect(self.in_q, out_q)
+        await stage()
+        self.assertEqual(drain_queue(out_q), contents + [None])
+
+    async def test_stage_without_connect(self):
+        """Plugin stages overriding `_connect()` without calling the base one still run."""
+        class PluginStage(Stage):
+            def _connect(self, in_q, out_q):
+                self._in_q = in_q
+                self._out_q = out_q
+
+            async def run(self):
+                async for batch in self.batches(maxsize=2):
+                    await self.put(batch[0])
+                    await self.put_many(batch[1:])
+
+        contents = [mock.Mock(does_batch=True) for _ in range(3)]
+        for content in contents:
+            self.in_q.put_nowait(content)
+        self.in_q.put_nowait(None)
+        out_q = asyncio.Queue()
+        stage = PluginStage()
+        stage._connect(self.in_q, out_q)
+        await stage()
+        self.assertEqual(drain_queue(out_q), contents + [None])
+
+    async def test_controller_ignores_blocked_puts(self):
+        class PassingStage(Stage):
+            async def run(self):
+                async for batch in self.batches():
+                    await self.put_many(batch)
+
+        for _ in range(3):
+            self.in_q.put_nowait(mock.Mock(does_batch=True))
+        self.in_q.put_nowait(None)
+        out_q = asyncio.Queue(maxsize=1)
+
+        async def consume():
+            item = True
+            while item is not None:
+                await asyncio.sleep(0.05)
+                item = await out_q.get()
+
+        controller = mock.Mock(size=1)
+        stage = PassingStage(batch_controller=controller)
+        stage._connect(self.in_q, out_q)
+        await asyncio.gather(stage(), consume())
+        service_times = [call[0][1] for call in controller.record.call_args_list]
+        self.assertEqual(len(service_times), 3)
+        self.assertGreater(stage._put_blocked_time, 0.05)
+        for service_time in service_times:
+            self.assertLess(service_time, 0.03)
+
+
+class TestRunDatabase(asynctest.TestCase):
+
+    class DatabaseStage(Stage):
+        async def run(self):
+            async for item in self.items():
+                item.thread = await self.run_database(threading.get_ident)
+                await self.put(item)
+
+    async def run_stage(self, stage):
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        content = mock.Mock()
+        in_q.put_nowait(content)
+        in_q.put_nowait(None)
+        stage._connect(in_q, out_q)
+        with mock.patch('pulpcore.plugin.stages.api.connections') as connections:
+            await stage()
+        return content, connections
+
+    async def test_inline(self):
+        content, connections = await self.run_stage(self.DatabaseStage())
+        self.assertEqual(content.thread, threading.get_ident())
+        connections.close_all.assert_not_called()
+
+    async def test_database_thread(self):
+        stage = self.DatabaseStage(database_thread=True)
+        content, connections = await self.run_stage(stage)
+        self.assertNotEqual(content.thread, threading.get_ident())
+        self.assertIsNone(stage._database_executor)
+        await asyncio.sleep(0.01)
+        connections.close_all.assert_called_once_with()
+
+
+def parse_words(chunk):
+    """Parse a chunk of space separated words, as a worker process."""
+    return [(word, os.getpid()) for word in chunk.split()]
+
+
+def parse_slowly(chunk):
+    """Sleep for `chunk` seconds, as a worker process."""
+    time.sleep(chunk)
+    return [chunk]
+
+
+class TestProcessPoolStage(asynctest.TestCase):
+
+    async def run_stage(self, stage, contents=()):
+        in_q = asyncio.Queue()
+        out_q = asyncio.Queue()
+        for c in contents:
+            in_q.put_nowait(c)
+        in_q.put_nowait(None)
+        stage._connect(in_q, out_q)
+        await stage()
+        return drain_queue(out_q)
+
+    async def test_chunks(self):
+        stage = ProcessPoolStage(parse_words, ['a b', 'c', '', 'd e'], max_workers=2)
+        output = await self.run_stage(stage)
+        self.assertIsNone(output[-1])
+        d_contents = output[:-1]
+        for d_content in d_contents:
+            self.assertIsInstance(d_content, DeclarativeContent)
+        self.assertEqual([d.content[0] for d in d_contents], ['a', 'b', 'c', 'd', 'e'])
+        self.assertNotIn(os.getpid(), [d.content[1] for d in d_contents])
+
+    async def test_input_queue_and_to_d_content(self):
+        stage = ProcessPoolStage(
+            parse_words, to_d_content=lambda result: DeclarativeContent(content=result[0] * 2),
+            max_workers=1, max_pending=1
+        )
+        output = await self.run_stage(stage, ['a b', 'c'])
+        self.assertEqual([d.content for d in output[:-1]], ['aa', 'bb', 'cc'])
+
+    async def test_workers_are_spawned(self):
+        stage = ProcessPoolStage(parse_words, ['a'], max_workers=1)
+        with mock.patch('pulpcore.plugin.stages.api.connections') as connections, \
+                mock.patch('pulpcore.plugin.stages.api.ProcessPoolExecutor',
+                           wraps=ProcessPoolExecutor) as executor:
+            await self.run_stage(stage)
+        self.assertEqual(executor.call_args[1]['mp_context'].get_start_method(), 'spawn')
+        connections.close_all.assert_not_called()
+
+    async def test_connections_are_closed_before_forking(self):
+        """Python 3.6 can only fork the workers."""
+        def fork_executor(max_workers, **kwargs):
+            if kwargs:
+                raise TypeError()
+            return ProcessPoolExecutor(max_workers=max_workers)
+
+        stage = ProcessPoolStage(parse_words, ['a'], max_workers=1)
+        with mock.patch('pulpcore.plugin.stages.api.connections') as connections, \
+                mock.patch('pulpcore.plugin.stages.api.ProcessPoolExecutor',
+                           side_effect=fork_executor) as executor:
+            connections.close_all.side_effect = lambda: self.assertEqual(executor.call_count, 1)
+            await self.run_stage(stage)
+        connections.close_all.assert_called_once_with()
+        self.assertEqual(executor.call_count, 2)
+
+    async def test_shutdown_does_not_block_loop(self):
+        def to_d_content(result):
+            raise RuntimeError()
+
+        stage = ProcessPoolStage(parse_slowly, [0, 0.5], to_d_content=to_d_content, max_workers=2)
+        loop = asyncio.get_event_loop()
+        ticks = [loop.time()]
+
+        async def tick():
+            while True:
+                await asyncio.sleep(0.01)
+                ticks.append(loop.time())
+
+        ticker = asyncio.ensure_future(tick())
+        with self.assertRaises(RuntimeError):
+            await self.run_stage(stage)
+        ticker.cancel()
+        self.assertGreater(ticks[-1] - ticks[0], 0.3)
+        self.assertLess(max(later - earlier for earlier, later in zip(ticks, ticks[1:])), 0.2)
+
+
+class TestBatchSizeController(asynctest.TestCase):
+
+    def test_converges_to_target_latency(self):
+        controller = BatchSizeController(target_latency=1.0, initial_size=10)
+        for i in range(20):
+            controller.record(controller.size, controller.size * 0.01)
+        self.assertEqual(controller.size, 100)
+
+    def test_bounds(self):
+        controller = BatchSizeController(target_latency=1.0, minsize=5, maxsize=20)
+        controller.record(10, 100.0)
+        self.assertEqual(controller.size, 5)
+        controller = BatchSizeController(target_latency=1.0, minsize=5, maxsize=20)
+        controller.record(10, 0.0)
+        self.assertEqual(controller.size, 20)
+
+    def test_invalid_bounds(self):
+        with self.assertRaises(ValueError):
+            BatchSizeController(target_latency=1.0, minsize=10, maxsize=5)
+
+
+class TestReplicatedStage(asynctest.TestCase):
+
+    class DelayStage(Stage):
+        """Pass items on, after sleeping `item.delay` seconds for each of them."""
+
+        async def run(self):
+            async for item in self.items():
+                await asyncio.sleep(item.delay)
+                await self.put(item)
+
+    class DroppingStage(Stage):
+        """Pass items on, except the ones with a true `drop`, replacing the ones to `replace`."""
+
+        async def run(self):
+            async for item in self.items():
+                await asyncio.sleep(item.delay)
+                if item.replace:
+                    await self.put(mock.Mock(replaced=item))
+                elif not item.drop:
+                    await self.put(item)
+
+    class FailingStage(Stage):
+        async def run(self):
+            async for item in self.items():
+                raise RuntimeError()
+
+    class BatchStage(Stage):
+        async def run(self):
+            async for batch in self.batches(minsize=3):
+                await self.put_many(batch)
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+
+    async def run_stage(self, stage, contents):
+        for c in contents:
+            self.in_q.put_nowait(c)
+        self.in_q.put_nowait(None)
+        stage._connect(self.in_q, self.out_q)
+        await stage()
+        output = []
+        while not self.out_q.empty():
+            output.append(self.out_q.get_nowait())
+        return output
+
+    async def test_unordered(self):
+        contents = [mock.Mock(delay=0.01 * (3 - i)) for i in range(3)]
+        stage = ReplicatedStage([self.DelayStage() for i in range(3)])
+        output = await self.run_stage(stage, contents)
+        self.assertEqual(output, list(reversed(contents)) + [None])
+
+    async def test_ordered(self):
+        contents = [mock.Mock(delay=0.01 * (3 - i)) for i in range(3)]
+        stage = ReplicatedStage([self.DelayStage() for i in range(3)], ordered=True)
+        output = await self.run_stage(stage, contents)
+        self.assertEqual(output, contents + [None])
+
+    async def test_ordered_put_many(self):
+        contents = [mock.Mock(delay=0.01 * (3 - i)) for i in range(3)]
+        self.in_q.put_nowait(ItemBatch(contents))
+        stage = ReplicatedStage([self.DelayStage() for i in range(3)], ordered=True)
+        output = await self.run_stage(stage, [])
+        self.assertEqual(output, contents + [None])
+
+    async def test_ordered_skips_dropped_items(self):
+        contents = [mock.Mock(delay=0, drop=drop, replace=False) for drop in (False, True, False)]
+        stage = ReplicatedStage([self.DroppingStage()], ordered=True)
+        for content in contents:
+            self.in_q.put_nowait(content)
+        stage._connect(self.in_q, self.out_q)
+        future = asyncio.ensure_future(stage())
+        await asyncio.sleep(0.01)
+        # the item after the dropped one is not held back until the end of the stream
+        self.assertEqual(drain_queue(self.out_q), [contents[0], contents[2]])
+        self.in_q.put_nowait(None)
+        await future
+        self.assertEqual(drain_queue(self.out_q), [None])
+        self.assertEqual(stage.replicas[0]._in_q._taken, {})
+
+    async def test_ordered_replaced_items(self):
+        contents = [
+            mock.Mock(delay=0.02, drop=False, replace=False),
+            mock.Mock(delay=0, drop=True, replace=False),
+            mock.Mock(delay=0, drop=False, replace=True),
+        ]
+        stage = ReplicatedStage([self.DroppingStage() for i in range(2)], ordered=True)
+        output = await self.run_stage(stage, contents)
+        self.assertEqual(len(output), 3)
+        self.assertIs(output[0], contents[0])
+        self.assertIs(output[1].replaced, contents[2])
+        self.assertIsNone(output[2])
+
+    async def test_unordered_put_many_counts_items(self):
+        contents = [mock.Mock(does_batch=True) for i in range(3)]
+        stage = ReplicatedStage([self.BatchStage()])
+        stage._connect(self.in_q, self.out_q)
+        items = metrics.stage_items.labels(metrics.stage_label(stage))
+        count = items.value
+        output = await self.run_stage(stage, contents)
+        self.assertEqual(output, [ItemBatch(contents), None])
+        self.assertEqual(items.value - count, 3)
+
+    async def test_replicas_run_concurrently(self):
+        contents = [mock.Mock(delay=0.05) for i in range(4)]
+        stage = ReplicatedStage([self.DelayStage() for i in range(4)])
+        start = asyncio.get_event_loop().time()
+        await self.run_stage(stage, contents)
+        self.assertLess(asyncio.get_event_loop().time() - start, 0.15)
+
+    async def test_failing_replica(self):
+        stage = ReplicatedStage([self.FailingStage(), self.DelayStage()])
+        with self.assertRaises(RuntimeError):
+            await self.run_stage(stage, [mock.Mock(delay=0)])
+
+    def test_unique_replicas(self):
+        replica = self.DelayStage()
+        with self.assertRaises(ValueError):
+            ReplicatedStage([replica, replica])
+
+
+class TestRoutingStage(asynctest.TestCase):
+
+    class TagStage(Stage):
+        """Pass items on, appending `tag` to their `tags`."""
+
+        def __init__(self, tag):
+            super().__init__()
+            self.tag = tag
+
+        async def run(self):
+            async for item in self.items():
+                item.tags.append(self.tag)
+                await self.put(item)
+
+    class A:
+        pass
+
+    class B:
+        pass
+
+    class C:
+        pass
+
+    def setUp(self):
+        self.in_q = asyncio.Queue()
+        self.out_q = asyncio.Queue()
+
+    async def run_stage(self, stage, contents):
+        for c in contents:
+            self.in_q.put_nowait(c)
+        self.in_q.put_nowait(None)
+        stage._connect(self.in_q, self.out_q)
+        await stage()
+        output = []
+        while not self.out_q.empty():
+            output.append(self.out_q.get_nowait())
+        return output
+
+    def content(self, model):
+        return mock.Mock(content=model(), tags=[])
+
+    async def test_routes_by_content_type(self):
+        a, b, c = self.content(self.A), self.content(self.B), self.content(self.C)
+        stage = RoutingStage({
+            self.A: [],
+            self.B: [self.TagStage('b1'), self.TagStage('b2')],
+            None: [self.TagStage('default')],
+        })
+        output = await self.run_stage(stage, [a, b, c])
+        self.assertEqual(output[-1], None)
+        self.assertCountEqual(output[:-1], [a, b, c])
+        self.assertEqual(a.tags, [])
+        self.assertEqual(b.tags, ['b1', 'b2'])
+        self.assertEqual(c.tags, ['default'])
+
+    async def test_custom_route(self):
+        a = self.content(self.A)
+        stage = RoutingStage({'x': [self.TagStage('x')]}, route=lambda item: 'x')
+        output = await self.run_stage(stage, [a])
+        self.assertEqual(output, [a, None])
+        self.assertEqual(a.tags, ['x'])
+
+    async def test_no_branch(self):
+        stage = RoutingStage({self.A: [self.TagStage('a')]})
+        with self.assertRaises(ValueError):
+            await self.run_stage(stage, [self.content(self.B)])
+
+    async def test_joined_put_many_counts_items(self):
+        contents = [self.content(self.A) for i in range(3)]
+        for content in contents:
+            content.does_batch = True
+        stage = RoutingStage({self.A: [TestReplicatedStage.BatchStage()]})
+        stage._connect(self.in_q, self.out_q)
+        items = metrics.stage_items.labels(metrics.stage_label(stage))
+        count = items.value
+        output = await self.run_stage(stage, contents)
+        self.assertEqual(output, [ItemBatch(contents), None])
+        self.assertEqual(items.value - count, 3)
+
+    def test_unique_stages(self):
+        stage = self.TagStage('a')
+        with self.assertRaises(ValueError):
+            RoutingStage({self.A: [stage], self.B: [stage]})
+
+
+class TestCreatePipeline(asynctest.TestCase):
+
+    class FirstStage(Stage):
+        async def run(self):
+            await self.put(DeclarativeContent(content=mock.Mock()))
+
+    class QueueStage(Stage):
+        """Record the input queue of this stage."""
+
+        async def run(self):
+            self.queue = self._in_q
+            async for item in self.items():
+                await self.put(item)
+
+    async def test_queue_options(self):
+        weighted, overridden = self.QueueStage(), self.QueueStage()
+        stages = [self.FirstStage(), weighted, overridden, EndStage()]
+        await create_pipeline(
+            stages, maxsize=10, maxweight=1000, weigh=estimate_size,
+            queue_options={overridden: {'maxsize': 5, 'maxweight': None}}
+        )
+        self.assertIsInstance(weighted.queue, WeightedQueue)
+        self.assertEqual((weighted.queue.maxsize, weighted.queue.maxweight), (10, 1000))
+        self.assertIs(weighted.queue.weigh, estimate_size)
+        self.assertEqual((overridden.queue.maxsize, overridden.queue.maxweight), (5, None))
+
+    async def test_maxsize_counts_put_many_items(self):
+        class BatchStage(Stage):
+            produced = 0
+
+            async def run(self):
+                for _ in range(100):
+                    await self.put_many([DeclarativeContent(content=mock.Mock())
+                                         for _ in range(10)])
+                    self.produced += 10
+
+        class BlockedStage(Stage):
+            async def run(self):
+                await self.release.wait()
+                async for item in self.items():
+                    await self.put(item)
+
+        producer, blocked = BatchStage(), BlockedStage()
+        blocked.release = asyncio.Event()
+        pipeline = asyncio.ensure_future(create_pipeline([producer, blocked, EndStage()]))
+        for _ in range(20):
+            await asyncio.sleep(0)
+        self.assertEqual(producer.produced, 100)
+        self.assertEqual(blocked._in_q.qsize(), 10)
+
+        blocked.release.set()
+        await pipeline
+        self.assertEqual(producer.produced, 1000)
+
 
 class TestMultipleStages(asynctest.TestCase):
 
@@ -0,0 +1,117 @@
+import asyncio
+from collections import defaultdict
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import asynctest
+import mock
+
+from pulpcore.plugin.download.file import FileDownloader
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import (
+    create_pipeline,
+    DeclarativeArtifact,
+    DeclarativeContent,
+    EndStage,
+    Stage,
+    start_tracing,
+    stop_tracing,
+    Tracer,
+    tracing,
+)
+
+
+class TestTracer(TestCase):
+
+    def test_sampling(self):
+        self.assertIsNone(Tracer(0).start_trace('item'))
+        tracer = Tracer(1)
+        self.assertEqual([tracer.start_trace('item').trace_id for _ in range(3)], [1, 2, 3])
+        self.assertEqual(tracer.traces, 3)
+
+    def test_max_events(self):
+        tracer = Tracer(1, max_events=2)
+        trace = tracer.start_trace('item')
+        tracer.record(trace, 'first', 0, 1)
+        tracer.record(trace, 'second', 1, 2)
+        self.assertEqual(tracer.dropped, 1)
+        events = tracer.export()['traceEvents']
+        self.assertEqual([event['name'] for event in events], ['thread_name', 'first'])
+
+    def test_untraced_items_are_not_sampled(self):
+        self.assertIsNone(DeclarativeContent(content=object()).trace)
+
+
+class FirstStage(Stage):
+
+    async def run(self):
+        for _ in range(3):
+            await self.put(DeclarativeContent(content=object()))
+
+
+class BatchingStage(Stage):
+
+    async def run(self):
+        async for batch in self.batches(minsize=3):
+            await asyncio.sleep(0.01)
+            await self.put_many(batch)
+
+
+class TestPipelineTracing(asynctest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'trace.json')
+        start_tracing(1)
+        self.addCleanup(stop_tracing, self.path)
+
+    def spans(self):
+        stop_tracing(self.path)
+        with open(self.path) as trace_file:
+            events = json.load(trace_file)['traceEvents']
+        spans = defaultdict(list)
+        for event in events:
+            if event['ph'] == 'X':
+                spans[event['tid']].append(event)
+        return events, spans
+
+    async def test_spans_of_items(self):
+        await create_pipeline([FirstStage(), BatchingStage(), EndStage()])
+        events, spans = self.spans()
+        names = [event['args']['name'] for event in events if event['ph'] == 'M']
+        self.assertEqual(names, ['object #1', 'object #2', 'object #3'])
+        self.assertEqual(len(spans), 3)
+        for trace_spans in spans.values():
+            self.assertEqual([span['name'] for span in trace_spans],
+                             ['wait', 'BatchingStage', 'wait'])
+            self.assertEqual([span['args']['stage'] for span in trace_spans if 'args' in span],
+                             ['BatchingStage', 'EndStage'])
+            service = trace_spans[1]
+            self.assertGreaterEqual(service['dur'], 10000)
+            self.assertGreaterEqual(service['ts'], trace_spans[0]['ts'] + trace_spans[0]['dur'])
+
+    async def test_download_span(self):
+        source = os.path.join(self.tmp.name, 'source')
+        with open(source, 'wb') as source_file:
+            source_file.write(b'data')
+        remote = mock.Mock(get_downloader=lambda url, **kwargs: FileDownloader(url, **kwargs))
+        d_artifact = DeclarativeArtifact(artifact=Artifact(), url='file://' + source,
+                                         relative_path='source', remote=remote)
+        d_content = DeclarativeContent(content=object(), d_artifacts=[d_artifact])
+        self.assertIs(d_artifact.trace, d_content.trace)
+        cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        await d_artifact.download()
+        events, spans = self.spans()
+        download, = spans[d_content.trace.trace_id]
+        self.assertEqual(download['cat'], 'download')
+        self.assertEqual(download['args'], {'url': 'file://' + source, 'size': 4})
+
+    def test_stop_without_tracing(self):
+        stop_tracing(self.path)
+        self.assertIsNone(tracing.TRACER)
+        self.assertIsNone(stop_tracing(self.path))